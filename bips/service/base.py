@@ -1,8 +1,11 @@
 #REST webservice
+import hashlib
 import json
 import os
 import shutil
 from socket import gethostname
+import tempfile
+import threading
 import webbrowser
 
 import cherrypy
@@ -12,9 +15,16 @@ import numpy as np
 
 import lg_authority
 
-from ..workflows import get_workflows, get_workflow
-from scripts.form_scripts import get_form
-from .demos.dicomconvert import unzip_and_extract
+from ..workflows import get_workflow, get_index, workflow_record
+from scripts.form_scripts import FormCache
+from .demos.dicomconvert import convert_upload
+from .images import CHUNK_SIZE, header_info, slice_png
+from .jobs import JobQueue
+from .catalog import Catalog
+from .runner import QuotaExceeded, WorkflowRunner
+from .volumes import VolumeCache
+from .thumbnails import (ThumbnailCache, generate_thumbnails, thumbnail_name,
+                         ORIENTATIONS, SIZES)
 
 from mako.lookup import TemplateLookup, Template
 from mako import exceptions
@@ -32,6 +42,47 @@ if 'bips' in gethostname():
 else:
     url_prefix = ''
 
+def save_upload(fileobj, outfile):
+    """Copy an uploaded file to outfile in chunks and return its md5
+    """
+    md5 = hashlib.md5()
+    with open(outfile, 'wb') as fp:
+        chunk = fileobj.read(CHUNK_SIZE)
+        while chunk:
+            md5.update(chunk)
+            fp.write(chunk)
+            chunk = fileobj.read(CHUNK_SIZE)
+    return md5.hexdigest()
+
+def _env_dirs(name):
+    """Directories listed in the environment variable name
+    """
+    return [root for root in os.environ.get(name, '').split(os.pathsep)
+            if root]
+
+def _below(path, roots):
+    """Whether the real path of path is inside one of roots
+    """
+    path = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        if path == root or path.startswith(root + os.sep):
+            return True
+    return False
+
+# clients whose requests run as the service user when lg_authority is off
+LOCAL_ADDRESSES = ['127.0.0.1', '::1']
+
+class _LocalUser(object):
+    """The user running the service, who owns the runs of the single user
+    mode (lg_authority off, requests from this machine only)
+    """
+
+    def __init__(self):
+        import getpass
+        self.name = getpass.getuser()
+        self.groups = [os.environ.get('BIPS_TRUSTED_GROUP', 'admin')]
+
 class MyEncoder(json.JSONEncoder):
     def default(self, o):
         """Implement this method in a subclass such that it returns
@@ -60,21 +111,14 @@ class MyEncoder(json.JSONEncoder):
 class BIPS(object):
     auth = lg_authority.AuthRoot()
 
-    def __init__(self, *args, **kwargs):
-        tags = []
-        mapper = {}
-        workflows = {}
-        for wf, value in get_workflows():
-            wf_tags = sorted(np.unique([tag.lower() for tag in value['object'].tags]).tolist())
-            for tag in wf_tags:
-                if tag not in mapper:
-                    mapper[tag] = []
-                mapper[tag].append(wf)
-            tags.extend(wf_tags)
-            workflows[wf] = value['object'].help.split('\n')[1]
-        self.tags_ = mapper.keys()
-        self.mapper_ = mapper
-        self.wf_ = workflows
+    def __init__(self, jobs=None, thumbnail_cache=None, runner=None,
+                 volumes=None):
+        self.jobs = jobs
+        self.thumbnail_cache = thumbnail_cache
+        self.runner = runner
+        self.volumes = volumes
+        self.catalog = Catalog()
+        self.forms = FormCache()
 
     @expose
     def index(self):
@@ -92,29 +136,40 @@ class BIPS(object):
 
     @expose
     def edit_config(self,uuid='7757e3168af611e1b9d5001e4fb1404c'):
-        conf = get_workflow(uuid).config_ui()
+        # rendering first picks up an edited workflow module
+        form = self.forms.render(uuid)
         mwf = get_workflow(uuid)
         title=mwf.help.split('\n')[1]
         desc = '\n'.join(mwf.help.split('\n')[3:])
         configTmpl = lookup.get_template("edit_config.html")
-        return configTmpl.render(**{'form':get_form(conf,mwf),'WorkflowName':title,'WorkflowDesc':desc})
+        return configTmpl.render(**{'form':form,'WorkflowName':title,'WorkflowDesc':desc})
 
 
-    @expose
-    def queryworkflows(self, tags=None):
-        print tags
+    def _cached_json(self, key, build):
+        """Serve a catalog response from the cache, answering
+        If-None-Match with 304 when the client has it already
+        """
+        body, etag = self.catalog.get(key, build)
         cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        if etag in [tag.strip() for tag in
+                    cherrypy.request.headers.get('If-None-Match', '').split(',')]:
+            cherrypy.response.status = 304
+            return ''
+        return body
+
+    def _queryworkflows(self, tags, mode):
+        index = get_index()
         if tags:
-            wfs = []
-            for tag in tags.split():
-                wfs.extend(self.mapper_[tag])
-            return json.dumps([{'uuid': wf, 'desc': self.wf_[wf]} for wf in wfs])
+            uuids = [uuid for uuid, _ in index.query(tags, mode)]
         else:
-            return json.dumps([{'uuid': uuid, 'desc': desc} for uuid, desc in self.wf_.items()])
+            uuids = sorted(index.records)
+        return json.dumps([{'uuid': uuid, 'desc': workflow_record(uuid)['desc']}
+                           for uuid in uuids])
 
-    @expose
-    def tags(self, query):
-        tags = self.tags_
+    def _tags(self, query):
+        tags = get_index().tags
         if query:
             query = query.split()
             if len(query):
@@ -125,21 +180,64 @@ class BIPS(object):
             else:
                 query = ' '
                 pre=''
-            tags = [pre + tag for tag in self.tags_ if query.lower() in tag]
-        cherrypy.response.headers['Content-Type'] = 'application/json'
+            tags = [pre + tag for tag in get_index().match_tags(query)]
         return json.dumps(tags)
 
-    @expose
-    def info(self, uuid):
+    def _info(self, uuid):
         wf = get_workflow(uuid)
         val = wf.get()
         json_str =  val #json.dumps(val, cls=MyEncoder)
         config_str = wf.config_ui().get() #json.dumps(wf.config_ui().get(), cls=MyEncoder)
-        img_file = ''
-        cherrypy.response.headers['Content-Type'] = 'application/json'
         return json.dumps({'jsonconfig': json_str, 'workflowconfig': config_str},
                           cls=MyEncoder)
 
+    def warm_catalog(self):
+        """Serialize the workflow list, the tags and the info of every
+        workflow ahead of the first requests
+        """
+        requests = [(('queryworkflows', None, 'or'),
+                     lambda: self._queryworkflows(None, 'or')),
+                    (('tags', ''), lambda: self._tags(''))]
+        for uuid in sorted(get_index().records):
+            requests.append((('info', uuid),
+                             lambda uuid=uuid: self._info(uuid)))
+        self.catalog.warm(requests)
+
+    @expose
+    def queryworkflows(self, tags=None, mode='or'):
+        return self._cached_json(('queryworkflows', tags or None, mode),
+                                 lambda: self._queryworkflows(tags, mode))
+
+    @expose
+    def tags(self, query):
+        return self._cached_json(('tags', query),
+                                 lambda: self._tags(query))
+
+    @expose
+    def info(self, uuid):
+        return self._cached_json(('info', uuid), lambda: self._info(uuid))
+
+    @expose
+    def filematches(self, base_directory, template):
+        """Files below base_directory matching a glob template, answered
+        from the datagrabber file index
+
+        base_directory must be inside FILE_DIR or a directory listed in
+        $BIPS_DATA_DIRS. The index is kept in the service's own cache.
+        """
+        from ..utils.file_index import FileIndex
+        if not _below(base_directory, [FILE_DIR] + _env_dirs('BIPS_DATA_DIRS')):
+            raise cherrypy.HTTPError(403, 'Not a data directory: %s'
+                                          % base_directory)
+        if os.path.isabs(template) or \
+                os.pardir in template.replace('\\', '/').split('/'):
+            raise cherrypy.HTTPError(400, 'Invalid template: %s' % template)
+        index = FileIndex(base_directory)
+        files = index.glob(os.path.join(base_directory, template))
+        index.save()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(files)
+
     @expose
     def configure(self, uuid):
         wf = get_workflow(uuid)
@@ -162,80 +260,316 @@ class BIPS(object):
         if 'files[]' not in kwargs:
             return
         myFile = kwargs['files[]']
-        outfile = os.path.join(FILE_DIR, myFile.filename)
-        with open(outfile, 'wb') as fp:
-            shutil.copyfileobj(myFile.file, fp)
+        # the client names the file, keep it inside FILE_DIR
+        name = os.path.basename(myFile.filename)
+        outfile = os.path.join(FILE_DIR, name)
+        key = save_upload(myFile.file, outfile)
         cherrypy.log('Saved file: %s' % outfile)
         if os.path.isfile(outfile):
-            print "getting info: %s" % outfile
             size = os.path.getsize(outfile)
-            from nibabel import load
-            import Image
-            import numpy as np
-            data = load(outfile).get_data()
-            if len(data.shape) == 4:
-                slice = data[data.shape[0]/2,:,:,0]
-            else:
-                slice = data[data.shape[0]/2,:,:]
-            print slice.shape
-            im = Image.fromarray(np.squeeze(255.*slice/np.max(np.abs(slice))).astype(np.uint8))
-            outpng = outfile+'.png'
-            im.save(outpng)
-            out = {"name": myFile.filename,
+            info = header_info(outfile)
+            # an earlier upload of this name had other content
+            self.thumbnail_cache.invalidate(outfile, keep=key)
+            self.thumbnail_cache.add_source(key, outfile)
+            self.jobs.submit(generate_thumbnails,
+                             self.thumbnail_cache.cache_dir, key, outfile,
+                             self.thumbnail_cache.max_bytes)
+            thumbnails = {}
+            for orientation in ORIENTATIONS:
+                thumbnails[orientation] = dict(
+                    [(px, "%sthumbnails\/%s\/%s" % (url_prefix, key,
+                                                   thumbnail_name(orientation, px)))
+                     for px in SIZES])
+            out = {"name": name,
                    "size": size,
-                   "url": "%sfiles\/%s" % (url_prefix, myFile.filename),
-                   "thumbnail_url":"%sthumbnails\/%s.png" % (url_prefix, myFile.filename),
-                   "delete_url": "%sdeletehandler?file=%s" % (url_prefix, myFile.filename),
-                   "delete_type": "DELETE"
+                   "url": "%sfiles\/%s" % (url_prefix, name),
+                   "thumbnail_url": thumbnails['sagittal'][128],
+                   "thumbnails": thumbnails,
+                   "delete_url": "%sdeletehandler?file=%s" % (url_prefix, name),
+                   "delete_type": "DELETE",
+                   "shape": info['shape'],
+                   "voxel_size": info['voxel_size'],
+                   "tr": info['tr']
             }
         else:
             out = {}
         cherrypy.response.headers['Content-Type'] = 'application/json'
         return json.dumps([[out]])
 
+    @expose
+    def thumbnails(self, key, name):
+        """Serve a thumbnail from the cache
+
+        Thumbnails are keyed by content, so they never change and clients
+        may cache them indefinitely.
+        """
+        path = self.thumbnail_cache.get(key, name)
+        if path is None:
+            cherrypy.response.headers['Cache-Control'] = 'no-store'
+            raise cherrypy.HTTPError(404, 'No thumbnail %s/%s' % (key, name))
+        etag = '"%s-%s"' % (key, name)
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'public, max-age=31536000'
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return ''
+        return serve_file(path, content_type='image/png')
+
+    def _slice_path(self, file):
+        """Full path of an image below FILE_DIR, a directory in
+        $BIPS_SLICE_DIRS or a sink directory of a finished run of the
+        current user that is itself inside a directory of $BIPS_SINK_ROOTS
+        """
+        path = os.path.realpath(os.path.join(FILE_DIR, file))
+        if not os.path.isfile(path):
+            raise cherrypy.HTTPError(404, 'No image %s' % file)
+        if _below(path, [FILE_DIR] + _env_dirs('BIPS_SLICE_DIRS')):
+            return path
+        user = self._current_user()
+        if user is not None and self.runner is not None:
+            # sink_dir comes from the submitted config, only directories
+            # the server operator allows are trusted
+            roots = _env_dirs('BIPS_SINK_ROOTS')
+            sink_dirs = [sink_dir for sink_dir
+                         in self.runner.sink_dirs(user.name)
+                         if _below(sink_dir, roots)]
+            if _below(path, sink_dirs):
+                return path
+        raise cherrypy.HTTPError(404, 'No image %s' % file)
+
+    @expose
+    def slice(self, file, axis=2, index=None, volume=0, format='png',
+              vmin=None, vmax=None):
+        """One 2D slice of a volume of an image
+
+        format is png (scaled from vmin to vmax, defaulting to 0 and the
+        slice maximum) or raw (float32 values in C order, of the shape
+        given by the X-Slice-Shape header).
+        """
+        path = self._slice_path(file)
+        if format not in ['png', 'raw']:
+            raise cherrypy.HTTPError(400, 'Unknown format %s' % format)
+        try:
+            axis, volume = int(axis), int(volume)
+            if index is not None:
+                index = int(index)
+            if vmin is not None:
+                vmin = float(vmin)
+            if vmax is not None:
+                vmax = float(vmax)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        st = os.stat(path)
+        etag = '"%s"' % hashlib.md5(repr((path, st.st_mtime, st.st_size,
+                                          axis, index, volume, format,
+                                          vmin, vmax))).hexdigest()
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return ''
+        try:
+            data = self.volumes.get(path).slice(axis, index, volume)
+        except IndexError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        cherrypy.response.headers['X-Slice-Shape'] = '%d,%d' % data.shape
+        if format == 'raw':
+            cherrypy.response.headers['Content-Type'] = \
+                'application/octet-stream'
+            return data.astype('<f4').tostring()
+        cherrypy.response.headers['Content-Type'] = 'image/png'
+        return slice_png(data, vmin, vmax)
+
     @expose
     def dicomuploadhandler(self, **kwargs):
         cherrypy.log('dcmhandler: %s' % str(kwargs))
         if 'files[]' not in kwargs:
             return
         myFile = kwargs['files[]']
-        outfile = os.path.join(FILE_DIR, myFile.filename)
-        with open(outfile, 'wb') as fp:
-            shutil.copyfileobj(myFile.file, fp)
+        # a name of its own, the conversion job removes it when done; the
+        # original name is kept as the suffix for the archive format
+        fd, outfile = tempfile.mkstemp(
+            dir=FILE_DIR, prefix='upload_',
+            suffix='_' + os.path.basename(myFile.filename))
+        with os.fdopen(fd, 'wb') as fp:
+            shutil.copyfileobj(myFile.file, fp, CHUNK_SIZE)
         cherrypy.log('Saved file: %s' % outfile)
         if os.path.isfile(outfile):
-            print "getting info: %s" % outfile
-            info = unzip_and_extract(outfile, FILE_DIR)
-            os.unlink(outfile)
-            print info
-            out = []
-            for key, value in sorted(info.items()):
-                info = value
-                out.append({"index": info['idx'],
-                            "name": info['name'],
-                            "metaname": info['metapath'],
-                            'error': info['err_status'] == 'err',
-                            "size": ' x '.join([str(val) for val in info['size']]),
-                            "url": "%sfiles\/%s" % (url_prefix, info['filepath']),
-                            "metaurl": "%sfiles\/%s" % (url_prefix, info['metapath']),
-                            "delete_url": "%sdeletehandler?file=%s" % (url_prefix, info['filepath']),
-                            "delete_type": "DELETE"
-                })
-            out = [out]
+            job_id = self.jobs.submit(convert_upload, outfile, FILE_DIR)
+            cherrypy.log('Queued conversion %s of %s' % (job_id, outfile))
+            out = [[{"name": myFile.filename,
+                     "job_id": job_id,
+                     "status_url": "%sdicomjobstatus?job_id=%s" % (url_prefix,
+                                                                   job_id)
+            }]]
         else:
             out = {}
-        print 'out', out
         cherrypy.response.headers['Content-Type'] = 'application/json'
         return json.dumps(out)
 
+    @expose
+    def dicomjobstatus(self, job_id):
+        """Status, progress and (when done) the converted series of a
+        dicom conversion job
+        """
+        status = self.jobs.status(job_id)
+        if status is None:
+            raise cherrypy.HTTPError(404, 'Unknown job %s' % job_id)
+        out = {"job_id": job_id,
+               "status": status['status'],
+               "progress": status.get('progress'),
+               "error": status.get('error')}
+        if status['status'] == 'done':
+            files = []
+            for key, info in sorted(status['result'].items(),
+                                    key=lambda item: int(item[0])):
+                files.append({"index": info['idx'],
+                              "name": info['name'],
+                              "metaname": info['metapath'],
+                              'error': info['err_status'] == 'err',
+                              "size": ' x '.join([str(val) for val in info['size']]),
+                              "url": "%sfiles\/%s" % (url_prefix, info['filepath']),
+                              "metaurl": "%sfiles\/%s" % (url_prefix, info['metapath']),
+                              "delete_url": "%sdeletehandler?file=%s" % (url_prefix, info['filepath']),
+                              "delete_type": "DELETE"
+                })
+            out["files"] = files
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(out)
+
+    def _current_user(self):
+        """The logged in lg_authority user or, in single user mode (with
+        lg_authority off), the user running the service for requests from
+        this machine; None otherwise
+        """
+        user = getattr(cherrypy.serving, 'user', None) or \
+            getattr(cherrypy, 'user', None)
+        if getattr(user, 'name', None):
+            return user
+        config = cherrypy.request.config or {}
+        if not config.get('tools.lg_authority.on', False) and \
+                cherrypy.request.remote.ip in LOCAL_ADDRESSES:
+            return _LocalUser()
+        return None
+
+    def _login(self):
+        """The current user; 403 when there is none
+        """
+        user = self._current_user()
+        if user is None:
+            raise cherrypy.HTTPError(403, 'Log in to run workflows')
+        return user
+
+    def _user(self):
+        return self._login().name
+
+    def _trusted(self, user):
+        """Whether user may run configs with advanced scripts, i.e. is in
+        the group $BIPS_TRUSTED_GROUP (default: admin)
+        """
+        group = os.environ.get('BIPS_TRUSTED_GROUP', 'admin')
+        return group in (getattr(user, 'groups', None) or [])
+
+    def _run_info(self, status):
+        job_id = status['job_id']
+        return {"job_id": job_id,
+                "uuid": status.get('uuid'),
+                "status": status['status'],
+                "submitted": status.get('submitted'),
+                "started": status.get('started'),
+                "finished": status.get('finished'),
+                "returncode": status.get('returncode'),
+                "error": status.get('error'),
+                "status_url": "%srunstatus?job_id=%s" % (url_prefix, job_id),
+                "log_url": "%srunlog?job_id=%s" % (url_prefix, job_id),
+                "cancel_url": "%scancelrun?job_id=%s" % (url_prefix, job_id)}
+
+    def _own_run(self, job_id):
+        user = self._user()
+        status = self.runner.status(job_id)
+        if status is None or status.get('user') != user:
+            raise cherrypy.HTTPError(404, 'Unknown run %s' % job_id)
+        return status
+
+    @expose
+    def runworkflow(self, config):
+        """Queue a workflow config (the JSON a config file holds) for
+        execution on this machine
+
+        Runs are only accepted from logged in users, and configs with
+        advanced options only from users in the trusted group.
+        """
+        try:
+            config = json.loads(config)
+            get_workflow(str(config['uuid']))
+        except (ValueError, KeyError, TypeError) as e:
+            raise cherrypy.HTTPError(400, 'Invalid config: %s' % e)
+        user = self._login()
+        # advanced scripts are exec'd by the workflows
+        if (config.get('advanced_script') or
+                config.get('use_advanced_options')) and \
+                not self._trusted(user):
+            raise cherrypy.HTTPError(403, 'Configs with advanced options may '
+                                          'only be run by trusted users')
+        try:
+            job_id = self.runner.submit(config, user.name)
+        except QuotaExceeded as e:
+            raise cherrypy.HTTPError(429, str(e))
+        cherrypy.log('Queued run %s of %s' % (job_id, config['uuid']))
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(self._run_info(self.runner.status(job_id)))
+
+    @expose
+    def runs(self, active='false'):
+        """The runs of the current user, oldest first; only the queued and
+        running ones if active is true (or 1, yes)
+        """
+        if str(active).lower() in ['true', '1', 'yes']:
+            active = True
+        elif str(active).lower() in ['false', '0', 'no', '']:
+            active = False
+        else:
+            raise cherrypy.HTTPError(400, 'Invalid value of active: %s'
+                                     % active)
+        jobs = self.runner.jobs(self._user(), active=active)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps([self._run_info(status) for status in jobs])
+
+    @expose
+    def runstatus(self, job_id):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(self._run_info(self._own_run(job_id)))
+
+    @expose
+    def runlog(self, job_id, offset=0):
+        """The log of a run from offset on; clients follow a run by
+        requesting again from the returned offset until it has finished
+        """
+        status = self._own_run(job_id)
+        text, offset = self.runner.log(job_id, int(offset))
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({"job_id": job_id,
+                           "status": status['status'],
+                           "text": text.decode('utf-8', 'replace'),
+                           "offset": offset})
+
+    @expose
+    def cancelrun(self, job_id):
+        self._own_run(job_id)
+        cancelled = self.runner.cancel(job_id)
+        if cancelled:
+            cherrypy.log('Cancelled run %s' % job_id)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({"job_id": job_id, "cancelled": cancelled})
+
     @expose
     def deletehandler(self, file):
         outfile = os.path.join(FILE_DIR, file)
         if os.path.isfile(outfile):
             cherrypy.log('Deleting file: %s' % outfile)
             os.unlink(outfile)
-            if os.path.exists(outfile + '.png'):
-                os.unlink(outfile+'.png')
+            if self.thumbnail_cache is not None:
+                self.thumbnail_cache.invalidate(outfile)
             if os.path.exists(outfile + '.json'):
                 os.unlink(outfile+'.json')
 
@@ -243,10 +577,34 @@ def open_page():
     #pass
     webbrowser.open("http://127.0.0.1:8080")
 
-def start_service():
+def start_service(n_workers=None):
+    """Start the web service
+
+    n_workers bounds the number of uploads converted at the same time
+    (defaults to $BIPS_SERVICE_WORKERS or the number of cpus). Submitted
+    workflows run one at a time unless $BIPS_RUN_WORKERS says otherwise,
+    and each user may have $BIPS_RUN_QUOTA (default 2) of them queued or
+    running.
+
+    lg_authority is off by default, which is the single user mode: requests
+    from this machine run workflows as the user running the service, and
+    requests from elsewhere are refused. Outputs of finished runs can be
+    viewed if their sink_dir is inside a directory of $BIPS_SINK_ROOTS.
+    """
     #configure ip address and port for web service
     if not os.path.exists(FILE_DIR):
         os.mkdir(FILE_DIR)
+    if n_workers is None and os.environ.get('BIPS_SERVICE_WORKERS'):
+        n_workers = int(os.environ['BIPS_SERVICE_WORKERS'])
+    # start the workers before cherrypy starts its threads
+    jobs = JobQueue(os.path.join(FILE_DIR, '.jobs'), n_workers)
+    cherrypy.engine.subscribe('stop', jobs.close)
+    thumbnail_cache = ThumbnailCache(os.path.join(FILE_DIR, '.thumbnails'))
+    runner = WorkflowRunner(os.path.join(FILE_DIR, '.runs'))
+    cherrypy.engine.subscribe('start', runner.start)
+    cherrypy.engine.subscribe('stop', runner.stop)
+    volumes = VolumeCache(tmp_dir=os.path.join(FILE_DIR, '.volumes'))
+    cherrypy.engine.subscribe('stop', volumes.clear)
     config = {'/': {'tools.staticdir.on': True,
                     'tools.staticdir.dir': os.getcwd(),
                     'tools.lg_authority.on': False,
@@ -262,8 +620,6 @@ def start_service():
                         'tools.staticdir.dir': os.path.join(MEDIA_DIR, 'cors')},
               '/img': {'tools.staticdir.on': True,
                        'tools.staticdir.dir': os.path.join(MEDIA_DIR, 'img')},
-              '/thumbnails': {'tools.staticdir.on': True,
-                       'tools.staticdir.dir': FILE_DIR},
               '/files': {'tools.staticdir.on': True,
                          'tools.staticdir.dir': FILE_DIR},
               '/scripts': {'tools.staticdir.on': True,
@@ -277,7 +633,11 @@ def start_service():
     else:
         cherrypy.log('Cert info unavailable')
     cherrypy.engine.subscribe('start', open_page)
-    cherrypy.tree.mount(BIPS(), '/', config=config)
+    app = BIPS(jobs, thumbnail_cache, runner, volumes)
+    warm = threading.Thread(target=app.warm_catalog)
+    warm.daemon = True
+    cherrypy.engine.subscribe('start', warm.start)
+    cherrypy.tree.mount(app, '/', config=config)
     cherrypy.engine.start()
     cherrypy.engine.block()
     #cherrypy.quickstart(BIPS())
@@ -0,0 +1,53 @@
+"""Cached JSON responses of the workflow catalog endpoints
+
+The workflow browser polls ``queryworkflows``, ``tags`` and ``info``, whose
+answers only change when the workflow registry does. ``Catalog`` keeps the
+serialized response of every request it has answered, with an ETag, until
+the registry version changes. Entries are dropped least recently used
+first beyond max_entries, as query strings are arbitrary.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class Catalog(object):
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Return (body, etag) of a response, calling build() for the body
+        on a miss
+        """
+        from ..workflows import registry_version
+        version = registry_version()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                return value
+        body = build()
+        value = (body, '"%s"' % hashlib.md5(body).hexdigest())
+        with self._lock:
+            if self._version == version:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def warm(self, requests):
+        """Build the responses of (key, build) pairs ahead of time
+        """
+        for key, build in requests:
+            try:
+                self.get(key, build)
+            except Exception:
+                # the request will report the error when it is made
+                pass
@@ -14,13 +14,15 @@ def sanitize_path_comp(path_comp):
             result.append(char)
     return ''.join(result)
 
-def get_dicom_info(dicom_dir, dest):
+def get_dicom_info(dicom_dir, dest, progress=None):
     """Return a freesurfer style dicom info generator
+
+    progress(done, total) is called after each series is converted
     """
     fl = sorted(glob(os.path.join(dicom_dir, '*.dcm')))
     stack = parse_and_stack(fl, force=True, warn_on_except=True)
     info = {}
-    for key in sorted(stack):
+    for count, key in enumerate(sorted(stack)):
         key_fields = key.split('-')
         idx = int(key_fields[0])
         name = key_fields[1]
@@ -52,9 +54,11 @@ def get_dicom_info(dicom_dir, dest):
                          metapath=meta_fn)
         size = [str(val) for val in size]
         print '\t'.join([str(idx), name, err_status] + size + [filename])
+        if progress:
+            progress(count + 1, len(stack))
     return info
 
-def unzip_and_extract(filename, dest):
+def unzip_and_extract(filename, dest, progress=None):
     outdir = mkdtemp()
     if '.tgz' in filename or '.tar.gz' in filename:
         import tarfile
@@ -75,6 +79,16 @@ def unzip_and_extract(filename, dest):
                 dcmdir = r
                 break
     print dcmdir
-    info = get_dicom_info(dcmdir, dest)
+    info = get_dicom_info(dcmdir, dest, progress)
     return info
 
+def convert_upload(filename, dest, progress=None):
+    """Convert an uploaded archive of dicoms and remove it
+
+    Runs in a worker of the service's job queue.
+    """
+    try:
+        return unzip_and_extract(filename, dest, progress)
+    finally:
+        os.unlink(filename)
+
@@ -0,0 +1,116 @@
+"""Header information and single slices of uploaded images
+
+Slices of NIfTI files are read plane by plane straight from the (possibly
+gzipped) file, so memory use does not depend on the size of the image and
+only the first volume of a 4D file is ever read. Other formats nibabel
+understands fall back to loading the volume.
+"""
+import gzip
+
+import numpy as np
+
+CHUNK_SIZE = 2 ** 20
+
+TIME_UNITS = {'sec': 1., 'msec': 1e-3, 'usec': 1e-6}
+
+
+def header_info(filename):
+    """Shape, voxel size and repetition time of an image, from its header
+    """
+    from nibabel import load
+    hdr = load(filename).get_header()
+    shape = [int(dim) for dim in hdr.get_data_shape()]
+    zooms = [float(zoom) for zoom in hdr.get_zooms()]
+    tr = None
+    if len(shape) > 3 and len(zooms) > 3:
+        tr = zooms[3]
+        if hasattr(hdr, 'get_xyzt_units'):
+            tr *= TIME_UNITS.get(hdr.get_xyzt_units()[1], 1.)
+    return {'shape': shape,
+            'voxel_size': zooms[:3],
+            'tr': tr,
+            'dtype': str(hdr.get_data_dtype())}
+
+
+def _is_nifti(filename, hdr):
+    return hasattr(hdr, 'get_data_offset') and \
+        (filename.endswith('.nii') or filename.endswith('.nii.gz'))
+
+
+def _planes(filename, hdr, volume=0, start=0, stop=None):
+    """Generate the z planes [start, stop) of one volume of a NIfTI file
+    """
+    shape = hdr.get_data_shape()
+    nx, ny, nz = shape[0], shape[1], shape[2]
+    dtype = hdr.get_data_dtype()
+    plane_bytes = nx * ny * dtype.itemsize
+    if stop is None:
+        stop = nz
+    slope, inter = hdr.get_slope_inter()
+    offset = hdr.get_data_offset() + plane_bytes * (volume * nz + start)
+    opener = gzip.open if filename.endswith('.gz') else open
+    fp = opener(filename, 'rb')
+    try:
+        fp.seek(offset)
+        for _ in range(start, stop):
+            plane = np.frombuffer(fp.read(plane_bytes), dtype=dtype)
+            plane = plane.reshape((nx, ny), order='F')
+            if slope is not None and not np.isnan(slope) and slope != 0:
+                plane = plane * slope + (inter or 0)
+            yield plane
+    finally:
+        fp.close()
+
+
+def read_slice(filename, axis=0, index=None, volume=0):
+    """The slice through index (default: the middle) along axis of one
+    volume of an image, as a 2D array
+    """
+    from nibabel import load
+    img = load(filename)
+    hdr = img.get_header()
+    shape = hdr.get_data_shape()
+    if index is None:
+        index = shape[axis] // 2
+    if len(shape) < 3 or not _is_nifti(filename, hdr):
+        data = img.get_data()
+        if len(data.shape) > 3:
+            data = data[..., volume]
+        return np.squeeze(np.take(data, index, axis=axis))
+    if axis == 2:
+        return list(_planes(filename, hdr, volume, index, index + 1))[0]
+    if axis == 0:
+        return np.array([plane[index, :] for plane in
+                         _planes(filename, hdr, volume)]).T
+    return np.array([plane[:, index] for plane in
+                     _planes(filename, hdr, volume)]).T
+
+
+def _to_image(slice, vmin=None, vmax=None):
+    import Image
+    if vmin is None:
+        vmin = 0.
+    if vmax is None:
+        vmax = np.max(np.abs(slice))
+    scale = vmax - vmin
+    if not scale:
+        scale = 1.
+    return Image.fromarray(np.clip(255. * (slice - vmin) / scale, 0,
+                                   255).astype(np.uint8))
+
+
+def save_thumbnail(slice, filename):
+    """Save a 2D array as a grey scale PNG scaled to its maximum
+    """
+    _to_image(slice).save(filename)
+    return filename
+
+
+def slice_png(slice, vmin=None, vmax=None):
+    """A 2D array as grey scale PNG data, mapping vmin (default 0) to black
+    and vmax (default: the maximum) to white
+    """
+    from cStringIO import StringIO
+    buf = StringIO()
+    _to_image(slice, vmin, vmax).save(buf, 'PNG')
+    return buf.getvalue()
@@ -0,0 +1,132 @@
+"""Background jobs of the web service
+
+Long running work (such as converting an uploaded DICOM archive) is run in
+a pool of worker processes so that requests return immediately. Each job
+writes its state to a small JSON file, which the service reads when a
+client polls for the job:
+
+status
+    queued, running, done or error
+progress
+    {'done': n, 'total': m} as reported by the job
+result
+    the return value of the job function, once it is done
+error
+    the traceback of a failed job
+"""
+import json
+import os
+import tempfile
+import time
+import traceback
+import uuid
+
+
+def _write_status(status_file, **kwargs):
+    try:
+        with open(status_file) as fp:
+            status = json.load(fp)
+    except (IOError, ValueError):
+        status = {}
+    status.update(kwargs)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(status_file),
+                                   suffix='.json')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(status, fp)
+    os.rename(tmpname, status_file)
+
+
+def _run_job(status_file, function, args):
+    """Run function(*args, progress=...) in a worker, recording its state
+    """
+    def progress(done, total):
+        _write_status(status_file, progress={'done': done, 'total': total})
+
+    _write_status(status_file, status='running', started=time.time())
+    try:
+        result = function(*args, progress=progress)
+    except Exception:
+        _write_status(status_file, status='error', finished=time.time(),
+                      error=traceback.format_exc())
+        return
+    _write_status(status_file, status='done', finished=time.time(),
+                  result=result)
+
+
+class JobQueue(object):
+    """Run functions in a pool of n_workers processes
+
+    Parameters
+    ----------
+
+    job_dir : directory for the job status files
+    n_workers : number of jobs running at the same time (defaults to the
+                number of cpus)
+
+    Job functions must be importable and accept a ``progress(done, total)``
+    keyword argument; their return value must be JSON serializable.
+    """
+
+    def __init__(self, job_dir, n_workers=None):
+        from multiprocessing import Pool
+        self.job_dir = os.path.abspath(job_dir)
+        if not os.path.exists(self.job_dir):
+            os.makedirs(self.job_dir)
+        self.pool = Pool(n_workers)
+        self._results = {}
+
+    def _status_file(self, job_id):
+        return os.path.join(self.job_dir, '%s.json' % job_id)
+
+    def _prune(self):
+        """Forget the workers of finished jobs, as not every job is polled
+        until it is done (e.g. thumbnails)
+        """
+        for job_id, result in list(self._results.items()):
+            if result.ready():
+                # records the outcome if the worker died
+                self.status(job_id)
+                self._results.pop(job_id, None)
+
+    def submit(self, function, *args):
+        """Queue function(*args) and return the job id
+        """
+        self._prune()
+        job_id = uuid.uuid4().hex
+        status_file = self._status_file(job_id)
+        _write_status(status_file, status='queued', submitted=time.time(),
+                      progress={'done': 0, 'total': None})
+        self._results[job_id] = self.pool.apply_async(
+            _run_job, (status_file, function, args))
+        return job_id
+
+    def status(self, job_id):
+        """State of a job, or None for unknown job ids
+        """
+        if not job_id.isalnum():
+            return None
+        # check the worker before reading its last status
+        result = self._results.get(job_id)
+        finished = result is not None and result.ready()
+        try:
+            with open(self._status_file(job_id)) as fp:
+                status = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if finished and status['status'] not in ['done', 'error']:
+            # the worker died before it could record the outcome
+            error = 'worker exited'
+            try:
+                result.get()
+            except Exception:
+                error = traceback.format_exc()
+            _write_status(self._status_file(job_id), status='error',
+                          finished=time.time(), error=error)
+            status.update(status='error', error=error)
+        if status['status'] in ['done', 'error']:
+            self._results.pop(job_id, None)
+        return status
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
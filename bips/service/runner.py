@@ -0,0 +1,271 @@
+"""Local execution of workflows submitted to the web service
+
+Every submitted config is run by ``bips.workflows.run_workflow`` (i.e. the
+``workflow_main_function`` of its workflow, exactly as ``bips -r`` does) in
+its own process, so a run can be cancelled and its output kept apart. At
+most n_workers runs execute at the same time; the others wait in
+submission order. Each user may have at most quota runs queued or running.
+
+Runs live in one directory each below run_dir:
+
+    <run_dir>/<job_id>/config.json   the submitted config
+    <run_dir>/<job_id>/log.txt       stdout and stderr of the run
+    <run_dir>/<job_id>/status.json   state of the run (see below)
+
+status
+    queued, running, done, error or cancelled
+user, uuid
+    who submitted the run and its workflow
+submitted, started, finished
+    times of the transitions
+returncode
+    exit code of the run process
+
+Nothing but the local machine is needed, so the service can run workflows
+without a cluster.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid as _uuid
+
+from .jobs import _write_status
+
+_run = 'import sys; from bips.workflows import run_workflow; ' \
+       'run_workflow(sys.argv[1])'
+
+FINISHED = ['done', 'error', 'cancelled']
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _kill(proc, timeout=10.):
+    """Terminate the session of a run, killing it if it lingers
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+        deadline = time.time() + timeout
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.returncode is not None:
+            return
+
+
+class WorkflowRunner(object):
+    """Run workflow configs in local worker processes
+
+    Parameters
+    ----------
+
+    run_dir : directory for the runs
+    n_workers : number of runs executing at the same time (defaults to
+                $BIPS_RUN_WORKERS or 1)
+    quota : number of runs a user may have queued or running (defaults to
+            $BIPS_RUN_QUOTA or 2, 0 means no limit)
+    poll : seconds between checks of the running processes
+    """
+
+    def __init__(self, run_dir, n_workers=None, quota=None, poll=1.):
+        self.run_dir = os.path.abspath(run_dir)
+        if not os.path.exists(self.run_dir):
+            os.makedirs(self.run_dir)
+        if n_workers is None:
+            n_workers = int(os.environ.get('BIPS_RUN_WORKERS', 1))
+        if quota is None:
+            quota = int(os.environ.get('BIPS_RUN_QUOTA', 2))
+        self.n_workers = n_workers
+        self.quota = quota
+        self.poll = poll
+        self._queue = []
+        self._procs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._recover()
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.run_dir, job_id)
+
+    def _status_file(self, job_id):
+        return os.path.join(self._job_dir(job_id), 'status.json')
+
+    def _recover(self):
+        """Fail the runs a previous service left unfinished
+        """
+        for job_id in os.listdir(self.run_dir):
+            status = self.status(job_id)
+            if status is None:
+                continue
+            if status['status'] not in FINISHED:
+                _write_status(self._status_file(job_id), status='error',
+                              finished=time.time(),
+                              error='the service stopped during the run')
+
+    def sink_dirs(self, user):
+        """The sink directories of the runs of user that finished without
+        an error
+        """
+        sink_dirs = []
+        for status in self.jobs(user):
+            if status['status'] != 'done':
+                continue
+            try:
+                with open(os.path.join(self._job_dir(status['job_id']),
+                                       'config.json')) as fp:
+                    sink_dir = json.load(fp).get('sink_dir')
+            except (IOError, ValueError):
+                continue
+            if sink_dir:
+                sink_dirs.append(sink_dir)
+        return sink_dirs
+
+    def start(self):
+        """Start scheduling runs
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop scheduling runs and cancel the running ones
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for job_id in list(self._procs):
+            self.cancel(job_id)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.schedule()
+            self._stop.wait(self.poll)
+
+    def schedule(self):
+        """Record finished runs and start queued ones on free workers
+        """
+        with self._lock:
+            for job_id, proc in list(self._procs.items()):
+                returncode = proc.poll()
+                if returncode is None:
+                    continue
+                del self._procs[job_id]
+                status = 'done' if returncode == 0 else 'error'
+                _write_status(self._status_file(job_id), status=status,
+                              finished=time.time(), returncode=returncode)
+            while self._queue and len(self._procs) < self.n_workers:
+                self._start(self._queue.pop(0))
+
+    def _start(self, job_id):
+        job_dir = self._job_dir(job_id)
+        log = open(os.path.join(job_dir, 'log.txt'), 'ab')
+        try:
+            # a session of its own, so that cancelling also stops the
+            # processes the workflow starts
+            proc = subprocess.Popen([sys.executable, '-c', _run,
+                                     os.path.join(job_dir, 'config.json')],
+                                    stdout=log, stderr=subprocess.STDOUT,
+                                    cwd=job_dir, preexec_fn=os.setsid)
+        except OSError as e:
+            _write_status(self._status_file(job_id), status='error',
+                          finished=time.time(), error=str(e))
+            return
+        finally:
+            log.close()
+        self._procs[job_id] = proc
+        _write_status(self._status_file(job_id), status='running',
+                      started=time.time(), pid=proc.pid)
+
+    def submit(self, config, user):
+        """Queue a config (a dict) for user and return the job id
+
+        Raises QuotaExceeded when user has too many runs already.
+        """
+        with self._lock:
+            if self.quota and \
+                    len(self.jobs(user, active=True)) >= self.quota:
+                raise QuotaExceeded('%s already has %d runs queued or running'
+                                    % (user, self.quota))
+            job_id = _uuid.uuid4().hex
+            job_dir = self._job_dir(job_id)
+            os.makedirs(job_dir)
+            with open(os.path.join(job_dir, 'config.json'), 'w') as fp:
+                json.dump(config, fp, indent=1)
+            _write_status(self._status_file(job_id), status='queued',
+                          user=user, uuid=config.get('uuid'),
+                          submitted=time.time())
+            self._queue.append(job_id)
+        return job_id
+
+    def status(self, job_id):
+        """State of a run, or None for unknown job ids
+        """
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._status_file(job_id)) as fp:
+                status = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        status['job_id'] = job_id
+        return status
+
+    def jobs(self, user=None, active=False):
+        """States of the runs of user (of all users when None), oldest
+        first, only the queued and running ones if active
+        """
+        jobs = []
+        for job_id in os.listdir(self.run_dir):
+            status = self.status(job_id)
+            if status is None or (user is not None and
+                                  status.get('user') != user):
+                continue
+            if active and status['status'] in FINISHED:
+                continue
+            jobs.append(status)
+        return sorted(jobs, key=lambda status: status['submitted'])
+
+    def log(self, job_id, offset=0, max_bytes=2 ** 16):
+        """Up to max_bytes of the log of a run from offset, and the offset
+        to continue from
+        """
+        if not job_id.isalnum():
+            return '', offset
+        try:
+            with open(os.path.join(self._job_dir(job_id), 'log.txt'),
+                      'rb') as fp:
+                fp.seek(offset)
+                text = fp.read(max_bytes)
+        except IOError:
+            text = ''
+        return text, offset + len(text)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running run, returning False if it had
+        finished already
+        """
+        proc = None
+        with self._lock:
+            if job_id in self._queue:
+                self._queue.remove(job_id)
+            elif job_id in self._procs:
+                # no longer scheduled; killing may take a while, so it
+                # happens outside of the lock
+                proc = self._procs.pop(job_id)
+            else:
+                return False
+        if proc is not None:
+            _kill(proc)
+        _write_status(self._status_file(job_id), status='cancelled',
+                      finished=time.time())
+        return True
@@ -1,9 +1,18 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sys
+import threading
+
 import colander
 from colander import Schema
 from deform import Form
 import deform
 import traits.api as traits
 
+from bips.workflows import get_workflow
+
 class Schema(colander.MappingSchema):
     pass 
 
@@ -41,7 +50,10 @@ def getNode(_type,tr,config):
         col_type = colander.SchemaNode(colander.String(),name=tr)
     return col_type
 
-def get_form(config,mwf):
+def build_form(config,mwf):
+    """Return the deform Form of a workflow config and the appstruct to
+    render it with (None for workflows with their own html_view)
+    """
     from nipype.interfaces.traits_extension import isdefined
     if not isdefined(mwf.html_view):
         schema = colander.Schema()    
@@ -58,10 +70,113 @@ def get_form(config,mwf):
     
         form = Form(schema,buttons = ('submit',),action='')   
     
-        return form.render(appstruct=config.get())
+        return form, config.get()
     else:
         form = Form(mwf.html_view(),buttons = ('submit',),action='')
+        return form, None
+
+def get_form(config,mwf):
+    form, appstruct = build_form(config, mwf)
+    if appstruct is None:
         return form.render()
+    return form.render(appstruct=appstruct)
+
+def _config_hash(appstruct):
+    def encode(obj):
+        if hasattr(obj, 'get_fields'):
+            return obj.get_fields()
+        return repr(obj)
+    return hashlib.md5(json.dumps(appstruct, sort_keys=True,
+                                  default=encode)).hexdigest()
+
+class FormCache(object):
+    """Compiled forms per workflow and rendered html per (workflow, config)
+
+    The form of a workflow is rebuilt when the registry changes or when the
+    source of the workflow's module changes; a changed module is reloaded
+    first, so the service picks up edits to a workflow without a restart.
+    At most max_entries rendered pages are kept, least recently used
+    first.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._forms = {}
+        self._html = OrderedDict()
+        # guards the dicts; forms are built under the lock of their
+        # workflow, so one slow build does not hold up the others
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    def _module_stamp(self, uuid):
+        """(module, source mtime and size) of the module defining a workflow
+        """
+        from bips.workflows.registry import _defining_module
+        module = sys.modules.get(_defining_module(get_workflow(uuid)))
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            return module, None
+        if filename.endswith('.pyc'):
+            filename = filename[:-1]
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return module, None
+        return module, (filename, st.st_mtime, st.st_size)
+
+    def _form(self, uuid):
+        with self._lock:
+            build_lock = self._build_locks.setdefault(uuid, threading.Lock())
+        with build_lock:
+            return self._build(uuid)
+
+    def _build(self, uuid):
+        from bips.workflows import registry_version
+        module, stamp = self._module_stamp(uuid)
+        with self._lock:
+            entry = self._forms.get(uuid)
+        if entry is not None and entry['stamp'] != stamp and \
+                module is not None:
+            # the workflow was edited since its form was built
+            try:
+                reload(module)
+            except Exception, e:
+                print "Could not reload %s: %s" % (module.__name__, e)
+        key = (registry_version(), stamp)
+        if entry is None or entry['key'] != key:
+            mwf = get_workflow(uuid)
+            form, appstruct = build_form(mwf.config_ui(), mwf)
+            entry = {'key': key, 'stamp': stamp, 'form': form,
+                     'appstruct': appstruct, 'lock': threading.Lock()}
+            with self._lock:
+                self._forms[uuid] = entry
+        return entry
+
+    def render(self, uuid, config=None):
+        """Html of the form of a workflow, filled in with config (defaults
+        to the default config of the workflow)
+        """
+        entry = self._form(uuid)
+        appstruct = entry['appstruct']
+        if config is not None and appstruct is not None:
+            appstruct = config.get()
+        key = (uuid, entry['key'], _config_hash(appstruct))
+        with self._lock:
+            if key in self._html:
+                html = self._html.pop(key)
+                self._html[key] = html
+                return html
+        # deform keeps the last rendered values on the form
+        with entry['lock']:
+            if appstruct is None:
+                html = entry['form'].render()
+            else:
+                html = entry['form'].render(appstruct=appstruct)
+        with self._lock:
+            self._html[key] = html
+            while len(self._html) > self.max_entries:
+                self._html.popitem(last=False)
+        return html
 
 def validator(form,value):
     pass
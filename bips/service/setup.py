@@ -8,6 +8,7 @@ def configuration(parent_package='',top_path=None):
     config.add_subpackage('scripts')
     config.add_subpackage('demos')
     config.add_data_dir('scripts')
+    config.add_data_dir('tests')
 
     # List all data directories to be loaded here
     return config
@@ -0,0 +1,45 @@
+from numpy.testing import assert_equal
+
+from bips.service.catalog import Catalog
+from bips.workflows import registry
+
+
+def _builder(calls):
+    def build():
+        calls.append(None)
+        return '{"calls": %d}' % len(calls)
+    return build
+
+
+def test_responses_are_cached():
+    calls = []
+    catalog = Catalog()
+    body, etag = catalog.get('tags', _builder(calls))
+    assert_equal(catalog.get('tags', _builder(calls)), (body, etag))
+    assert_equal(len(calls), 1)
+
+
+def test_registry_change_invalidates():
+    calls = []
+    catalog = Catalog()
+    body, etag = catalog.get('tags', _builder(calls))
+    registry._version[0] += 1
+    try:
+        new_body, new_etag = catalog.get('tags', _builder(calls))
+    finally:
+        registry._version[0] -= 1
+    assert_equal(len(calls), 2)
+    assert_equal(new_body == body, False)
+    assert_equal(new_etag == etag, False)
+
+
+def test_least_recently_used_entries_are_dropped():
+    calls = []
+    catalog = Catalog(max_entries=2)
+    for key in ['a', 'b', 'a', 'c']:
+        catalog.get(key, _builder(calls))
+    assert_equal(len(calls), 3)
+    catalog.get('a', _builder(calls))
+    assert_equal(len(calls), 3)
+    catalog.get('b', _builder(calls))
+    assert_equal(len(calls), 4)
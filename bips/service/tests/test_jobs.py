@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+import time
+
+from numpy.testing import assert_equal
+
+from bips.service.jobs import JobQueue
+
+
+def _add(a, b, progress=None):
+    progress(1, 1)
+    return a + b
+
+
+def _fail(progress=None):
+    raise ValueError('no luck')
+
+
+def _wait(jobs, job_id, timeout=30):
+    deadline = time.time() + timeout
+    status = jobs.status(job_id)
+    while status['status'] not in ['done', 'error'] and \
+            time.time() < deadline:
+        time.sleep(0.05)
+        status = jobs.status(job_id)
+    return status
+
+
+def test_job_lifecycle():
+    job_dir = tempfile.mkdtemp()
+    jobs = JobQueue(job_dir, n_workers=1)
+    try:
+        job_id = jobs.submit(_add, 1, 2)
+        assert_equal(jobs.status(job_id)['status'] in
+                     ['queued', 'running', 'done'], True)
+        status = _wait(jobs, job_id)
+        assert_equal(status['status'], 'done')
+        assert_equal(status['result'], 3)
+        assert_equal(status['progress'], {'done': 1, 'total': 1})
+        # finished jobs keep their state
+        assert_equal(jobs.status(job_id)['result'], 3)
+    finally:
+        jobs.close()
+        shutil.rmtree(job_dir)
+
+
+def test_failed_job():
+    job_dir = tempfile.mkdtemp()
+    jobs = JobQueue(job_dir, n_workers=1)
+    try:
+        status = _wait(jobs, jobs.submit(_fail))
+        assert_equal(status['status'], 'error')
+        assert_equal('no luck' in status['error'], True)
+    finally:
+        jobs.close()
+        shutil.rmtree(job_dir)
+
+
+def test_unknown_jobs():
+    job_dir = tempfile.mkdtemp()
+    jobs = JobQueue(job_dir, n_workers=1)
+    try:
+        assert_equal(jobs.status('0' * 32), None)
+        assert_equal(jobs.status('../secret'), None)
+    finally:
+        jobs.close()
+        shutil.rmtree(job_dir)
+
+
+def test_finished_jobs_are_forgotten():
+    job_dir = tempfile.mkdtemp()
+    jobs = JobQueue(job_dir, n_workers=1)
+    try:
+        job_id = jobs.submit(_add, 1, 2)
+        deadline = time.time() + 30
+        while not jobs._results[job_id].ready() and time.time() < deadline:
+            time.sleep(0.05)
+        # without polling the first job
+        other = jobs.submit(_add, 2, 3)
+        assert_equal(job_id in jobs._results, False)
+        assert_equal(jobs.status(job_id)['result'], 3)
+        assert_equal(_wait(jobs, other)['result'], 5)
+    finally:
+        jobs.close()
+        shutil.rmtree(job_dir)
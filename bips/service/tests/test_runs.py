@@ -0,0 +1,80 @@
+import json
+import shutil
+import tempfile
+import time
+
+import cherrypy
+from cherrypy._cprequest import Request, Response
+from cherrypy.lib.httputil import Host
+from numpy.testing import assert_equal, assert_raises
+
+from bips.service.base import BIPS
+from bips.service.runner import FINISHED, WorkflowRunner
+
+# dicom conversion, which needs nothing but a config to be started
+UUID = 'df490522b5ad11e19a4d001e4fb1404c'
+
+
+def _request(ip='127.0.0.1', lg_authority=False):
+    request = Request(Host('127.0.0.1', 8080), Host(ip, 50000))
+    request.config = {'tools.lg_authority.on': lg_authority}
+    cherrypy.serving.load(request, Response())
+
+
+def _service():
+    run_dir = tempfile.mkdtemp()
+    return BIPS(runner=WorkflowRunner(run_dir, n_workers=1, quota=0)), \
+        run_dir
+
+
+def test_local_run():
+    app, run_dir = _service()
+    try:
+        _request()
+        info = json.loads(app.runworkflow(json.dumps({'uuid': UUID})))
+        assert_equal(info['status'], 'queued')
+        job_id = info['job_id']
+        assert_equal([run['job_id'] for run in json.loads(app.runs())],
+                     [job_id])
+        app.runner.schedule()
+        assert_equal(json.loads(app.runstatus(job_id))['status'] in
+                     ['running'] + FINISHED, True)
+        deadline = time.time() + 60
+        while json.loads(app.runstatus(job_id))['status'] not in FINISHED \
+                and time.time() < deadline:
+            time.sleep(0.2)
+            app.runner.schedule()
+        log = json.loads(app.runlog(job_id))
+        assert_equal(log['status'] in FINISHED, True)
+        assert_equal(log['offset'], len(log['text'].encode('utf-8')))
+    finally:
+        app.runner.stop()
+        shutil.rmtree(run_dir)
+
+
+def test_cancel_queued_run():
+    app, run_dir = _service()
+    try:
+        _request()
+        job_id = json.loads(app.runworkflow(json.dumps({'uuid': UUID})))[
+            'job_id']
+        assert_equal(json.loads(app.cancelrun(job_id))['cancelled'], True)
+        assert_equal(json.loads(app.runstatus(job_id))['status'],
+                     'cancelled')
+        assert_equal(json.loads(app.runs(active='true')), [])
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def test_anonymous_runs_refused():
+    app, run_dir = _service()
+    try:
+        # from elsewhere without lg_authority, and with lg_authority but
+        # nobody logged in
+        for ip, lg_authority in [('10.0.0.1', False), ('127.0.0.1', True)]:
+            _request(ip, lg_authority)
+            assert_raises(cherrypy.HTTPError, app.runworkflow,
+                          json.dumps({'uuid': UUID}))
+        assert_equal(app.runner.jobs(), [])
+    finally:
+        shutil.rmtree(run_dir)
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_equal, assert_raises, assert_array_equal
+
+from bips.service.volumes import Volume, VolumeCache
+
+
+def _image(tmpdir, name, shape=(2, 3, 4)):
+    import nibabel as nib
+    data = np.arange(np.prod(shape), dtype=np.int16).reshape(shape)
+    filename = os.path.join(tmpdir, name)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), filename)
+    return filename, data
+
+
+def test_slice():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename, data = _image(tmpdir, 'vol.nii')
+        volume = Volume(filename)
+        assert_equal(volume.shape, (2, 3, 4))
+        assert_array_equal(volume.slice(2, 1), data[:, :, 1])
+        assert_array_equal(volume.slice(0, 1), data[1, :, :])
+        # the middle slice by default
+        assert_array_equal(volume.slice(1), data[:, 1, :])
+        assert_equal(volume.slice(2, 0).dtype, np.float32)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_slice_bounds():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename, _ = _image(tmpdir, 'vol.nii')
+        volume = Volume(filename)
+        assert_raises(IndexError, volume.slice, 2, 4)
+        assert_raises(IndexError, volume.slice, 2, -1)
+        assert_raises(IndexError, volume.slice, 3, 0)
+        assert_raises(IndexError, volume.slice, 2, 0, 1)
+        filename, data = _image(tmpdir, 'vol4d.nii', (2, 3, 4, 2))
+        volume = Volume(filename)
+        assert_equal(volume.n_volumes, 2)
+        assert_array_equal(volume.slice(2, 3, 1), data[:, :, 3, 1])
+        assert_raises(IndexError, volume.slice, 2, 3, 2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_gzipped_copy_is_removed():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename, data = _image(tmpdir, 'vol.nii.gz')
+        copies = os.path.join(tmpdir, 'copies')
+        os.mkdir(copies)
+        volume = Volume(filename, copies)
+        assert_array_equal(volume.slice(2, 2), data[:, :, 2])
+        assert_equal(len(os.listdir(copies)), 1)
+        volume.close()
+        assert_equal(os.listdir(copies), [])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_cache_reopens_changed_files_and_evicts():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        first, _ = _image(tmpdir, 'first.nii.gz')
+        second, _ = _image(tmpdir, 'second.nii.gz')
+        copies = os.path.join(tmpdir, 'copies')
+        cache = VolumeCache(max_volumes=1, tmp_dir=copies)
+        volume = cache.get(first)
+        assert_equal(cache.get(first) is volume, True)
+        st = os.stat(first)
+        os.utime(first, (st.st_atime, st.st_mtime + 10))
+        assert_equal(cache.get(first) is volume, False)
+        cache.get(second)
+        # the copy of the evicted first image is gone
+        assert_equal(len(os.listdir(copies)), 1)
+        cache.clear()
+        assert_equal(os.listdir(copies), [])
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,186 @@
+"""Thumbnail cache of the web service
+
+Thumbnails of the middle sagittal, coronal and axial slice of an image are
+stored at several sizes under a key derived from the content of the image:
+
+    <cache_dir>/<key[:2]>/<key>/<orientation>_<size>.png
+
+so re-uploading the same file reuses its thumbnails and they can be served
+with long lived cache headers. Thumbnails are normally generated by a
+background job right after an upload; a thumbnail that is requested before
+its job has run is generated on demand from the source image recorded for
+the key. The keys of an image are removed when it is deleted or replaced
+by an upload of the same name, and the cache is kept below a size limit by
+removing the least recently used keys.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+ORIENTATIONS = {'sagittal': 0, 'coronal': 1, 'axial': 2}
+SIZES = [64, 128, 256]
+
+DEFAULT_MAX_BYTES = 500 * 1024 ** 2
+
+
+def thumbnail_name(orientation, size):
+    return '%s_%d.png' % (orientation, size)
+
+
+class ThumbnailCache(object):
+    """Content addressed thumbnail directory
+
+    Parameters
+    ----------
+
+    cache_dir : directory holding the thumbnails
+    max_bytes : size limit of the cache (defaults to
+                $BIPS_THUMBNAIL_CACHE_MB or 500 MB)
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if max_bytes is None:
+            max_bytes = DEFAULT_MAX_BYTES
+            if os.environ.get('BIPS_THUMBNAIL_CACHE_MB'):
+                max_bytes = float(os.environ['BIPS_THUMBNAIL_CACHE_MB']) * \
+                    1024 ** 2
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def path(self, key, name):
+        return os.path.join(self.key_dir(key), name)
+
+    def add_source(self, key, filename):
+        """Record the image the thumbnails of key are made from
+        """
+        key_dir = self.key_dir(key)
+        if not os.path.exists(key_dir):
+            os.makedirs(key_dir)
+        with open(os.path.join(key_dir, 'source'), 'w') as fp:
+            fp.write(os.path.abspath(filename))
+
+    def _key_dirs(self):
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                yield os.path.join(prefix_dir, key)
+
+    def invalidate(self, filename, keep=None):
+        """Remove the keys (but keep) whose source is filename, as it was
+        deleted or replaced by another image; returns the removed keys
+        """
+        filename = os.path.abspath(filename)
+        removed = []
+        for key_dir in list(self._key_dirs()):
+            key = os.path.basename(key_dir)
+            if key != keep and self.source(key) == filename:
+                shutil.rmtree(key_dir, ignore_errors=True)
+                removed.append(key)
+        return removed
+
+    def source(self, key):
+        try:
+            with open(os.path.join(self.key_dir(key), 'source')) as fp:
+                return fp.read().strip()
+        except IOError:
+            return None
+
+    def generate(self, key, filename, orientations=None, sizes=None):
+        """Write the missing thumbnails of an image and return their names
+        """
+        import Image
+        from .images import read_slice, save_thumbnail
+        if orientations is None:
+            orientations = sorted(ORIENTATIONS)
+        sizes = sizes or SIZES
+        key_dir = self.key_dir(key)
+        if not os.path.exists(key_dir):
+            os.makedirs(key_dir)
+        names = []
+        for orientation in orientations:
+            missing = [size for size in sizes if not os.path.exists(
+                self.path(key, thumbnail_name(orientation, size)))]
+            if not missing:
+                continue
+            fd, full = tempfile.mkstemp(dir=key_dir, suffix='.png')
+            os.close(fd)
+            try:
+                save_thumbnail(read_slice(filename,
+                                          axis=ORIENTATIONS[orientation]),
+                               full)
+                for size in missing:
+                    im = Image.open(full)
+                    im.thumbnail((size, size), Image.ANTIALIAS)
+                    name = thumbnail_name(orientation, size)
+                    tmpname = full + name
+                    im.save(tmpname, 'PNG')
+                    os.rename(tmpname, self.path(key, name))
+                    names.append(name)
+            finally:
+                os.remove(full)
+        return names
+
+    def get(self, key, name):
+        """Path of a thumbnail, generating it if needed, or None
+
+        Marks the key as recently used.
+        """
+        if not key.isalnum() or os.path.basename(name) != name:
+            return None
+        path = self.path(key, name)
+        if not os.path.exists(path):
+            source = self.source(key)
+            stem = os.path.splitext(name)[0]
+            if '_' not in stem or source is None or \
+                    not os.path.exists(source):
+                return None
+            orientation, size = stem.rsplit('_', 1)
+            if orientation not in ORIENTATIONS or not size.isdigit() or \
+                    int(size) not in SIZES:
+                return None
+            self.generate(key, source, [orientation], [int(size)])
+        try:
+            os.utime(self.key_dir(key), None)
+        except OSError:
+            pass
+        return path
+
+    def evict(self):
+        """Remove least recently used keys until the cache fits max_bytes
+        """
+        entries = []
+        total = 0
+        for key_dir in self._key_dirs():
+            size = sum([os.path.getsize(os.path.join(key_dir, f))
+                        for f in os.listdir(key_dir)])
+            entries.append((os.path.getmtime(key_dir), size, key_dir))
+            total += size
+        for _, size, key_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(key_dir, ignore_errors=True)
+            total -= size
+        return total
+
+
+def generate_thumbnails(cache_dir, key, filename, max_bytes=None,
+                        progress=None):
+    """Generate all thumbnails of an image (run as a background job)
+    """
+    cache = ThumbnailCache(cache_dir, max_bytes)
+    names = []
+    orientations = sorted(ORIENTATIONS)
+    for count, orientation in enumerate(orientations):
+        names.extend(cache.generate(key, filename, [orientation]))
+        if progress:
+            progress(count + 1, len(orientations))
+    cache.evict()
+    return {'key': key, 'generated': names, 'finished': time.time()}
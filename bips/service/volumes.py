@@ -0,0 +1,153 @@
+"""Recently used volumes kept open for slice requests
+
+NIfTI images are opened as memory-mapped arrays, so a slice only reads the
+pages it covers and the operating system caches them across requests.
+Gzipped NIfTI files cannot be mapped; they are decompressed once into
+tmp_dir and the copy is mapped (and removed when the volume is dropped
+from the cache). Other formats nibabel understands are loaded into memory.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .images import CHUNK_SIZE, _is_nifti
+
+
+class Volume(object):
+    """An image opened for slicing
+
+    Parameters
+    ----------
+
+    filename : the image
+    tmp_dir : directory for decompressed copies of gzipped images
+    """
+
+    def __init__(self, filename, tmp_dir=None):
+        from nibabel import load
+        self.filename = filename
+        self._copy = None
+        img = load(filename)
+        hdr = img.get_header()
+        self.shape = tuple([int(dim) for dim in hdr.get_data_shape()])
+        if _is_nifti(filename, hdr) and len(self.shape) >= 3:
+            path = filename
+            if filename.endswith('.gz'):
+                path = self._decompress(filename, tmp_dir)
+            self.data = np.memmap(path, dtype=hdr.get_data_dtype(), mode='r',
+                                  offset=hdr.get_data_offset(),
+                                  shape=self.shape, order='F')
+            slope, inter = hdr.get_slope_inter()
+            if slope is None or np.isnan(slope) or slope == 0:
+                slope, inter = 1., 0.
+            self.slope, self.inter = slope, inter or 0.
+        else:
+            self.data = img.get_data()
+            self.slope, self.inter = 1., 0.
+
+    def _decompress(self, filename, tmp_dir):
+        fd, self._copy = tempfile.mkstemp(dir=tmp_dir, suffix='.nii')
+        with os.fdopen(fd, 'wb') as out:
+            fp = gzip.open(filename, 'rb')
+            try:
+                shutil.copyfileobj(fp, out, CHUNK_SIZE)
+            finally:
+                fp.close()
+        return self._copy
+
+    @property
+    def n_volumes(self):
+        if len(self.shape) > 3:
+            return self.shape[3]
+        return 1
+
+    def slice(self, axis=2, index=None, volume=0):
+        """The slice through index (default: the middle) along axis of one
+        volume, as a 2D float32 array
+
+        Raises IndexError for slices outside the image.
+        """
+        if axis not in [0, 1, 2] or axis >= len(self.shape):
+            raise IndexError('no axis %s in an image of shape %s'
+                             % (axis, self.shape))
+        if index is None:
+            index = self.shape[axis] // 2
+        if not 0 <= index < self.shape[axis]:
+            raise IndexError('slice %d outside of 0-%d' %
+                             (index, self.shape[axis] - 1))
+        if not 0 <= volume < self.n_volumes:
+            raise IndexError('volume %d outside of 0-%d' %
+                             (volume, self.n_volumes - 1))
+        data = self.data
+        if len(data.shape) > 3:
+            data = data[:, :, :, volume]
+        plane = np.take(data, index, axis=axis).astype(np.float32)
+        if self.slope != 1 or self.inter:
+            plane = plane * self.slope + self.inter
+        return plane
+
+    def close(self):
+        # requests still slicing keep their mapping of a removed copy
+        if self._copy is not None:
+            try:
+                os.remove(self._copy)
+            except OSError:
+                pass
+            self._copy = None
+
+
+class VolumeCache(object):
+    """The max_volumes most recently sliced images, reopened when their
+    file changes
+
+    Parameters
+    ----------
+
+    max_volumes : number of images kept open (defaults to
+                  $BIPS_VOLUME_CACHE_SIZE or 8)
+    tmp_dir : directory for decompressed copies of gzipped images
+    """
+
+    def __init__(self, max_volumes=None, tmp_dir=None):
+        if max_volumes is None:
+            max_volumes = int(os.environ.get('BIPS_VOLUME_CACHE_SIZE', 8))
+        self.max_volumes = max_volumes
+        self.tmp_dir = tmp_dir
+        if tmp_dir and not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        self._volumes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """The open Volume of an image
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        with self._lock:
+            if filename in self._volumes:
+                entry = self._volumes.pop(filename)
+                if entry[0] == stamp:
+                    self._volumes[filename] = entry
+                    return entry[1]
+                entry[1].close()
+        # open outside of the lock, decompressing may take a while
+        volume = Volume(filename, self.tmp_dir)
+        with self._lock:
+            if filename in self._volumes:
+                self._volumes.pop(filename)[1].close()
+            self._volumes[filename] = (stamp, volume)
+            while len(self._volumes) > self.max_volumes:
+                self._volumes.popitem(last=False)[1][1].close()
+        return volume
+
+    def clear(self):
+        with self._lock:
+            for _, volume in self._volumes.values():
+                volume.close()
+            self._volumes.clear()
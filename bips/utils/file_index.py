@@ -0,0 +1,214 @@
+"""Cached directory listings for datagrabber templates
+
+Globbing templates such as ``%s/preproc/output/bandpassed/*.nii*`` lists the
+same directories for every subject and every field, which is slow on network
+file systems. ``FileIndex`` keeps the listing of every directory it has seen
+under a base directory, together with the directory's mtime, in a pickle
+file. Glob patterns are answered from the stored listings; each directory is
+stat'ed once per process and only listed again when its mtime changed (or
+when it was listed so soon after a change that the mtime may not have
+ticked yet).
+
+A FileIndex may be shared by threads: each directory is still checked once,
+and different directories are listed concurrently.
+"""
+import cPickle
+import fcntl
+from fnmatch import fnmatch
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# directories listed less than this many seconds after their mtime are
+# listed again on the next check, as coarse mtimes may hide later changes
+MTIME_SLACK = 2.
+
+
+def default_index_file(base_directory):
+    """Index file used for base_directory when none is given
+    """
+    base_directory = os.path.abspath(base_directory)
+    name = hashlib.md5(base_directory).hexdigest() + '.pklz'
+    return os.path.join(os.path.expanduser('~'), '.bips', 'file_index', name)
+
+
+def _has_magic(name):
+    return any([char in name for char in '*?['])
+
+
+class FileIndex(object):
+    """Index of the directories below base_directory
+
+    Parameters
+    ----------
+
+    base_directory : root of the indexed tree
+    index_file : pickle file holding the index (see default_index_file)
+    """
+
+    def __init__(self, base_directory, index_file=None):
+        self.base_directory = os.path.abspath(base_directory)
+        self.index_file = index_file or default_index_file(base_directory)
+        # relative directory: (mtime, time listed, {name: is_dir})
+        self.dirs = {}
+        self._checked = set()
+        self._dirty = False
+        # guards dirs and _checked; the per directory locks make threads
+        # wait for a listing in progress instead of listing it again
+        self._lock = threading.RLock()
+        self._dir_locks = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, 'rb') as fp:
+                index = cPickle.load(fp)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return
+        if index.get('base_directory') == self.base_directory:
+            self.dirs = index['dirs']
+
+    def save(self):
+        """Write the index if it changed
+
+        Listings saved by other processes in the meantime are merged in, so
+        concurrent datagrabbers do not drop each other's directories; the
+        merge and write happen under a lock on <index_file>.lock.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            index_dir = os.path.dirname(self.index_file)
+            if not os.path.exists(index_dir):
+                try:
+                    os.makedirs(index_dir)
+                except OSError:
+                    pass
+            with open(self.index_file + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._save()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self):
+        dirs = self.dirs
+        self.dirs = {}
+        self.load()
+        for rel, entry in dirs.items():
+            if rel in self._checked or rel not in self.dirs or \
+                    self.dirs[rel][1] < entry[1]:
+                self.dirs[rel] = entry
+        for rel in list(self.dirs):
+            if rel in self._checked and rel not in dirs:
+                del self.dirs[rel]
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.index_file),
+                                       suffix='.pklz')
+        with os.fdopen(fd, 'wb') as fp:
+            cPickle.dump({'base_directory': self.base_directory,
+                          'dirs': self.dirs}, fp, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.index_file)
+        self._dirty = False
+
+    def _drop(self, rel):
+        prefix = rel + os.sep if rel else ''
+        for key in list(self.dirs):
+            if key == rel or key.startswith(prefix):
+                del self.dirs[key]
+                self._checked.add(key)
+        self._dirty = True
+
+    def _checked_listing(self, rel):
+        entry = self.dirs.get(rel)
+        return entry[2] if entry else None
+
+    def listing(self, rel):
+        """{name: is_dir} of a directory relative to base_directory, or None
+        if it does not exist
+        """
+        with self._lock:
+            if rel in self._checked:
+                return self._checked_listing(rel)
+            dir_lock = self._dir_locks.setdefault(rel, threading.Lock())
+        with dir_lock:
+            with self._lock:
+                if rel in self._checked:
+                    return self._checked_listing(rel)
+                entry = self.dirs.get(rel)
+            path = os.path.join(self.base_directory, rel)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                with self._lock:
+                    if entry is not None:
+                        self._drop(rel)
+                    self._checked.add(rel)
+                return None
+            if entry is None or entry[0] != mtime or \
+                    entry[1] - mtime < MTIME_SLACK:
+                listed = time.time()
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    with self._lock:
+                        self._checked.add(rel)
+                    return None
+                entry = (mtime, listed,
+                         dict([(name, os.path.isdir(os.path.join(path, name)))
+                               for name in names]))
+                with self._lock:
+                    self.dirs[rel] = entry
+                    self._dirty = True
+            # only marked checked once its listing is in place
+            with self._lock:
+                self._checked.add(rel)
+            return entry[2]
+
+    def scan(self):
+        """Check every directory below base_directory, listing those that
+        changed
+        """
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            names = self.listing(rel)
+            if names:
+                stack.extend([os.path.join(rel, name)
+                              for name, is_dir in names.items() if is_dir and
+                              not os.path.islink(os.path.join(
+                                  self.base_directory, rel, name))])
+
+    def glob(self, pattern):
+        """glob.glob answered from the index
+
+        Patterns outside base_directory are passed to glob.glob.
+        """
+        pattern = os.path.abspath(pattern)
+        rel = os.path.relpath(pattern, self.base_directory)
+        if rel == os.curdir:
+            return [pattern] if self.listing('') is not None else []
+        if rel.startswith(os.pardir) or _has_magic(self.base_directory):
+            return glob.glob(pattern)
+        parts = rel.split(os.sep)
+        matches = ['']
+        for depth, part in enumerate(parts):
+            last = depth == len(parts) - 1
+            found = []
+            for parent in matches:
+                names = self.listing(parent)
+                if not names:
+                    continue
+                if _has_magic(part):
+                    found.extend([os.path.join(parent, name)
+                                  for name in sorted(names)
+                                  if fnmatch(name, part) and
+                                  (last or names[name]) and
+                                  (part.startswith('.') or
+                                   not name.startswith('.'))])
+                elif part in names and (last or names[part]):
+                    found.append(os.path.join(parent, part))
+            matches = found
+        return [os.path.join(self.base_directory, match) for match in matches]
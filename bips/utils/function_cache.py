@@ -0,0 +1,369 @@
+"""Shared result cache for Function nodes
+
+Nipype caches node results per working directory, so identical Function
+nodes in different workflows (e.g. plot_motion in fmri_preprocessing and
+fmri_QA) are recomputed for every workflow. ``CachedFunction`` is a drop-in
+replacement for ``nipype.interfaces.utility.Function`` that looks results up
+in a cache shared by all workflows before running the function.
+
+The cache key is the hash of the function source, its output names and the
+inputs, where input files are represented by their name and a hash of their
+content. Output files are stored in the cache and linked (or copied) into the
+node directory on a hit; outputs that are input files passed through are
+not stored, a hit returns the input file of the node instead. The cache is
+evicted in least recently used order once it grows beyond its size limit.
+
+The cache may live on a shared (e.g. NFS) file system: its SQLite index is
+only opened under a POSIX lock (lockf) on cache.lock, which works over NFS
+where SQLite's own locking does not.
+
+The cache is enabled by the function_cache_dir input of a CachedFunction
+node. ``set_function_cache`` sets it on every CachedFunction node of a
+workflow (bips does so for the function_cache_dir option of
+BaseWorkflowConfig), so it travels with the node to cluster jobs; it does
+not change the node hash.
+Nodes without it fall back to the BIPS_FUNCTION_CACHE environment variable.
+BIPS_FUNCTION_CACHE_SIZE sets the size limit in GB (default 50). Without a
+cache directory CachedFunction behaves exactly like Function.
+"""
+import cPickle
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from nipype.interfaces.utility import Function
+from nipype.interfaces.base import isdefined, traits
+
+DEFAULT_SIZE_GB = 50.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, function TEXT,
+                                    size INTEGER, last_used REAL);
+CREATE TABLE IF NOT EXISTS counts (function TEXT PRIMARY KEY,
+                                   hits INTEGER, misses INTEGER);
+"""
+
+# content hashes of input files, keyed by (path, size, mtime)
+_file_hashes = {}
+
+
+def _file_hash(path):
+    st = os.stat(path)
+    stamp = (path, st.st_size, st.st_mtime)
+    if stamp not in _file_hashes:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fp:
+            block = fp.read(2 ** 20)
+            while block:
+                md5.update(block)
+                block = fp.read(2 ** 20)
+        _file_hashes[stamp] = md5.hexdigest()
+    return _file_hashes[stamp]
+
+
+def _fingerprint(value):
+    """Hashable description of an input value, using file contents
+    """
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint(val) for val in value]
+    if isinstance(value, dict):
+        return sorted([(key, _fingerprint(val)) for key, val in value.items()])
+    if isinstance(value, basestring) and os.path.isfile(value):
+        return ('file', os.path.basename(value), _file_hash(value))
+    return repr(value)
+
+
+def _input_files(args):
+    """Real paths of the files in the inputs (a dict), in an order that is
+    the same for all inputs with the same key
+    """
+    files = []
+
+    def add(value):
+        if isinstance(value, dict):
+            for key in sorted(value):
+                add(value[key])
+        elif isinstance(value, (list, tuple)):
+            for val in value:
+                add(val)
+        elif isinstance(value, basestring) and os.path.isfile(value):
+            files.append(os.path.realpath(value))
+    add(args)
+    return files
+
+
+def _store_files(value, files_dir, inputs=(), counter=None):
+    """Copy the files in an output value to files_dir
+
+    Returns the value with every file replaced by ('__file__', relpath),
+    or by ('__input__', i) if it is inputs[i].
+    """
+    if counter is None:
+        counter = [0]
+    if isinstance(value, dict):
+        return dict([(key, _store_files(val, files_dir, inputs, counter))
+                     for key, val in value.items()])
+    if isinstance(value, (list, tuple)):
+        return type(value)([_store_files(val, files_dir, inputs, counter)
+                            for val in value])
+    if isinstance(value, basestring) and os.path.isfile(value):
+        if os.path.realpath(value) in inputs:
+            return ('__input__', list(inputs).index(os.path.realpath(value)))
+        relpath = os.path.join(str(counter[0]), os.path.basename(value))
+        counter[0] += 1
+        os.mkdir(os.path.join(files_dir, os.path.dirname(relpath)))
+        shutil.copy2(value, os.path.join(files_dir, relpath))
+        return ('__file__', relpath)
+    return value
+
+
+def _restore_files(value, files_dir, cwd, inputs=(), used=None):
+    """Inverse of _store_files: link the cached files into cwd
+    """
+    if used is None:
+        used = set()
+    if isinstance(value, tuple) and len(value) == 2 and \
+            value[0] == '__input__':
+        return inputs[value[1]]
+    if isinstance(value, tuple) and len(value) == 2 and \
+            value[0] == '__file__':
+        src = os.path.join(files_dir, value[1])
+        dst = os.path.join(cwd, os.path.basename(value[1]))
+        if dst in used:
+            # two outputs with the same name, keep them apart
+            dst = os.path.join(cwd, value[1])
+            if not os.path.exists(os.path.dirname(dst)):
+                os.mkdir(os.path.dirname(dst))
+        used.add(dst)
+        if os.path.exists(dst):
+            os.unlink(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        return dst
+    if isinstance(value, dict):
+        return dict([(key, _restore_files(val, files_dir, cwd, inputs, used))
+                     for key, val in value.items()])
+    if isinstance(value, (list, tuple)):
+        return type(value)([_restore_files(val, files_dir, cwd, inputs, used)
+                            for val in value])
+    return value
+
+
+def _dir_size(path):
+    return sum([os.path.getsize(os.path.join(root, f))
+                for root, _, files in os.walk(path) for f in files])
+
+
+class FunctionCache(object):
+    """On-disk cache of function results
+
+    Parameters
+    ----------
+
+    cache_dir : directory holding the cache
+    max_size : size limit in bytes
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if max_size is None:
+            max_size = float(os.environ.get('BIPS_FUNCTION_CACHE_SIZE',
+                                            DEFAULT_SIZE_GB)) * 1024 ** 3
+        self.max_size = max_size
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+
+    @contextmanager
+    def _connect(self):
+        """Connection to the index, held by one process at a time and
+        committed when the block ends without an error
+        """
+        with open(os.path.join(self.cache_dir, 'cache.lock'), 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                conn = sqlite3.connect(os.path.join(self.cache_dir,
+                                                    'cache.db'), timeout=60)
+                try:
+                    conn.executescript(SCHEMA)
+                    yield conn
+                    conn.commit()
+                finally:
+                    conn.close()
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _count(self, conn, function, hit):
+        conn.execute('INSERT OR IGNORE INTO counts VALUES (?, 0, 0)',
+                     (function,))
+        column = 'hits' if hit else 'misses'
+        conn.execute('UPDATE counts SET %s=%s+1 WHERE function=?'
+                     % (column, column), (function,))
+
+    def key(self, function_str, args, output_names=None):
+        """Cache key of a function source, its output names and its keyword
+        arguments
+        """
+        fingerprint = [function_str, list(output_names or []),
+                       sorted([(name, _fingerprint(val))
+                               for name, val in args.items()])]
+        return hashlib.sha1(repr(fingerprint)).hexdigest()
+
+    def get(self, key, function, cwd, args=None):
+        """Return the cached outputs for key with files linked into cwd (and
+        input files passed through taken from args), or None on a miss
+        """
+        entry = self._entry_dir(key)
+        outputs = None
+        if os.path.exists(os.path.join(entry, 'outputs.pklz')):
+            try:
+                with open(os.path.join(entry, 'outputs.pklz'), 'rb') as fp:
+                    outputs = _restore_files(cPickle.load(fp),
+                                             os.path.join(entry, 'files'),
+                                             cwd, _input_files(args or {}))
+            except (IOError, OSError, EOFError):
+                # evicted while we were reading it
+                outputs = None
+        with self._connect() as conn:
+            if outputs is not None:
+                conn.execute('UPDATE entries SET last_used=? WHERE key=?',
+                             (time.time(), key))
+            self._count(conn, function, outputs is not None)
+        return outputs
+
+    def put(self, key, function, outputs, args=None):
+        """Store outputs (a dict) of the inputs args under key and evict old
+        entries
+        """
+        entry = self._entry_dir(key)
+        if os.path.exists(entry):
+            return
+        if not os.path.exists(os.path.dirname(entry)):
+            try:
+                os.makedirs(os.path.dirname(entry))
+            except OSError:
+                pass
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        os.mkdir(os.path.join(tmpdir, 'files'))
+        stored = _store_files(outputs, os.path.join(tmpdir, 'files'),
+                              _input_files(args or {}))
+        with open(os.path.join(tmpdir, 'outputs.pklz'), 'wb') as fp:
+            cPickle.dump(stored, fp, cPickle.HIGHEST_PROTOCOL)
+        size = _dir_size(tmpdir)
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            # stored concurrently by another process
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                         (key, function, size, time.time()))
+            self.evict(conn)
+
+    def evict(self, conn=None):
+        """Remove least recently used entries until the cache fits max_size
+        """
+        if conn is None:
+            with self._connect() as conn:
+                return self.evict(conn)
+        total = conn.execute('SELECT SUM(size) FROM entries').fetchone()[0]
+        total = total or 0
+        if total > self.max_size:
+            for key, size in conn.execute('SELECT key, size FROM entries '
+                                          'ORDER BY last_used').fetchall():
+                if total <= self.max_size:
+                    break
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                total -= size
+
+    def stats(self):
+        """Return {function: (hits, misses)}
+        """
+        with self._connect() as conn:
+            return dict([(function, (hits, misses))
+                         for function, hits, misses
+                         in conn.execute('SELECT * FROM counts')])
+
+
+class CachedFunction(Function):
+    """Function interface whose results are shared between workflows
+
+    Use it like nipype.interfaces.utility.Function. The function must be
+    pure: its outputs may only depend on its inputs and the contents of its
+    input files.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedFunction, self).__init__(*args, **kwargs)
+        self.inputs.add_trait('function_cache_dir', traits.Directory(
+            nohash=True, desc='directory of the shared result cache'))
+
+    def _run_interface(self, runtime):
+        cache_dir = self.inputs.function_cache_dir
+        if not isdefined(cache_dir):
+            cache_dir = os.environ.get('BIPS_FUNCTION_CACHE')
+        if not cache_dir:
+            return super(CachedFunction, self)._run_interface(runtime)
+        args = {}
+        for name in self._input_names:
+            value = getattr(self.inputs, name)
+            if isdefined(value):
+                args[name] = value
+        function_str = self.inputs.function_str
+        # the function name, for the hit/miss counters
+        function = function_str.split('def ', 1)[-1].split('(', 1)[0].strip()
+        cache = FunctionCache(cache_dir)
+        key = cache.key(function_str, args, self._output_names)
+        outputs = cache.get(key, function, os.getcwd(), args)
+        if outputs is not None:
+            self._out = outputs
+            return runtime
+        runtime = super(CachedFunction, self)._run_interface(runtime)
+        cache.put(key, function, dict(self._out), args)
+        return runtime
+
+
+def set_function_cache(wf, cache_dir):
+    """Make the CachedFunction nodes of a workflow use the cache in cache_dir
+    """
+    for node in wf._get_all_nodes():
+        if isinstance(node._interface, CachedFunction):
+            node.set_input('function_cache_dir', cache_dir)
+
+
+class function_cache(object):
+    """Context manager that sets the cache of the CachedFunction nodes of
+    every workflow run inside it (nothing happens if cache_dir is empty)
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def __enter__(self):
+        import nipype.pipeline.engine as pe
+        self._run = wf_run = pe.Workflow.run
+        cache_dir = self.cache_dir
+        if cache_dir:
+            def run(wf, *args, **kwargs):
+                set_function_cache(wf, cache_dir)
+                return wf_run(wf, *args, **kwargs)
+            pe.Workflow.run = run
+        return self
+
+    def __exit__(self, *args):
+        import nipype.pipeline.engine as pe
+        pe.Workflow.run = self._run
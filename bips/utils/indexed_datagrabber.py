@@ -0,0 +1,121 @@
+"""DataGrabber that answers its templates from a FileIndex
+"""
+import os
+from warnings import warn
+
+import nipype.interfaces.io as nio
+from nipype.interfaces.base import File, isdefined
+from nipype.utils.filemanip import list_to_filename
+
+from .file_index import FileIndex
+
+
+class IndexedDataGrabberInputSpec(nio.DataGrabberInputSpec):
+    index_file = File(desc='File index of base_directory (defaults to one '
+                           'in ~/.bips/file_index)')
+
+
+class IndexedDataGrabber(nio.DataGrabber):
+    """nipype DataGrabber whose glob patterns are answered by a FileIndex
+
+    Behaves exactly like DataGrabber, but lists each directory at most once
+    per run and only again in later runs when its mtime changed.
+    """
+    input_spec = IndexedDataGrabberInputSpec
+
+    def file_index(self):
+        index_file = None
+        if isdefined(self.inputs.index_file):
+            index_file = self.inputs.index_file
+        return FileIndex(self.inputs.base_directory, index_file)
+
+    def _sorted(self, filelist):
+        if self.inputs.sort_filelist:
+            try:
+                from nipype.utils.misc import human_order_sorted
+            except ImportError:
+                return sorted(filelist)
+            return human_order_sorted(filelist)
+        return filelist
+
+    def _no_files(self, key, template):
+        msg = 'Output key: %s Template: %s returned no files' % (key,
+                                                                 template)
+        if getattr(self.inputs, 'raise_on_empty', True):
+            raise IOError(msg)
+        warn(msg)
+
+    def _list_outputs(self, index=None):
+        """DataGrabber._list_outputs with the templates globbed by index
+        (by a FileIndex of base_directory saved afterwards when None)
+        """
+        if not isdefined(self.inputs.base_directory):
+            return super(IndexedDataGrabber, self)._list_outputs()
+        for key in self._infields or []:
+            if not isdefined(getattr(self.inputs, key)):
+                raise ValueError("%s requires a value for input '%s' because "
+                                 "it was listed in 'infields'"
+                                 % (self.__class__.__name__, key))
+        save = index is None
+        if index is None:
+            index = self.file_index()
+        outputs = {}
+        for key, args in self.inputs.template_args.items():
+            outputs[key] = []
+            template = self.inputs.template
+            if isdefined(self.inputs.field_template) and \
+                    key in self.inputs.field_template:
+                template = self.inputs.field_template[key]
+            template = os.path.join(
+                os.path.abspath(self.inputs.base_directory), template)
+            if not args:
+                filelist = index.glob(template)
+                if not filelist:
+                    self._no_files(key, template)
+                else:
+                    outputs[key] = list_to_filename(self._sorted(filelist))
+            for arglist in args:
+                maxlen = 1
+                for arg in arglist:
+                    if isinstance(arg, basestring) and \
+                            hasattr(self.inputs, arg):
+                        arg = getattr(self.inputs, arg)
+                    if isinstance(arg, list):
+                        if maxlen > 1 and len(arg) != maxlen:
+                            raise ValueError('incompatible number of '
+                                             'arguments for %s' % key)
+                        maxlen = max(maxlen, len(arg))
+                for i in range(maxlen):
+                    argtuple = []
+                    for arg in arglist:
+                        if isinstance(arg, basestring) and \
+                                hasattr(self.inputs, arg):
+                            arg = getattr(self.inputs, arg)
+                        if isinstance(arg, list):
+                            argtuple.append(arg[i])
+                        else:
+                            argtuple.append(arg)
+                    filledtemplate = template
+                    if argtuple:
+                        try:
+                            filledtemplate = template % tuple(argtuple)
+                        except TypeError as e:
+                            raise TypeError('%s: Template %s failed to '
+                                            'convert with args %s'
+                                            % (e, template, tuple(argtuple)))
+                    outfiles = index.glob(filledtemplate)
+                    if not outfiles:
+                        self._no_files(key, filledtemplate)
+                        outputs[key].append(None)
+                    else:
+                        outputs[key].append(
+                            list_to_filename(self._sorted(outfiles)))
+            if any([val is None for val in outputs[key]]):
+                outputs[key] = []
+            if len(outputs[key]) == 0:
+                outputs[key] = None
+            elif len(outputs[key]) == 1:
+                outputs[key] = outputs[key][0]
+        if save:
+            index.save()
+        return outputs
@@ -0,0 +1,182 @@
+"""Datagrabber reading file names from a table instead of globbing
+
+The table is a CSV or TSV file (tab separated when its extension is .tsv or
+.txt) with a header row. Some columns identify a row (subject, session,
+run, ...) and the others hold absolute file names, one column per outfield.
+Rows with the same iterable values are collected in table order, so e.g.
+several runs of a subject give a list of files.
+"""
+import csv
+import os
+
+import nipype.interfaces.io as nio
+from nipype.interfaces.base import (traits, DynamicTraitedSpec,
+                                    BaseInterfaceInputSpec, File, Undefined,
+                                    isdefined)
+from nipype.utils.filemanip import list_to_filename
+
+# parsed tables, keyed by (file name, size, mtime)
+_tables = {}
+
+
+def read_table(filename):
+    """Return the header and the rows (as dicts) of a CSV or TSV file
+
+    Tables are read once per process and again only when they change.
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = (filename, st.st_size, st.st_mtime)
+    if stamp not in _tables:
+        with open(filename, 'rb') as fp:
+            if os.path.splitext(filename)[1].lower() in ['.tsv', '.txt']:
+                dialect = csv.excel_tab
+            else:
+                try:
+                    dialect = csv.Sniffer().sniff(fp.readline(), ',\t;')
+                except csv.Error:
+                    dialect = csv.excel
+                fp.seek(0)
+            reader = csv.DictReader(fp, dialect=dialect)
+            rows = [dict([(key.strip(), (val or '').strip())
+                          for key, val in row.items() if key is not None])
+                    for row in reader]
+            header = [name.strip() for name in reader.fieldnames or []]
+        _tables[stamp] = (header, rows)
+    return _tables[stamp]
+
+
+def check_table(filename, keys, columns, check_files=True):
+    """Validate a table, raising ValueError listing all problems
+
+    Parameters
+    ----------
+
+    filename : the table
+    keys : columns identifying a row
+    columns : columns holding file names
+    check_files : also check that every file exists
+    """
+    header, rows = read_table(filename)
+    problems = ['missing column %s' % name for name in keys + columns
+                if name not in header]
+    if not problems:
+        for lineno, row in enumerate(rows):
+            for name in keys:
+                if not row[name]:
+                    problems.append('line %d: no %s' % (lineno + 2, name))
+            for name in columns:
+                path = row[name]
+                if not path:
+                    continue
+                if not os.path.isabs(path):
+                    problems.append('line %d: %s is not an absolute path'
+                                    % (lineno + 2, path))
+                elif check_files and not os.path.exists(path):
+                    problems.append('line %d: %s does not exist'
+                                    % (lineno + 2, path))
+    if problems:
+        raise ValueError('%s:\n%s' % (filename, '\n'.join(problems)))
+    return header, rows
+
+
+def select_files(rows, values, columns, filters=None):
+    """Files of every outfield of the rows matching values and filters
+
+    Parameters
+    ----------
+
+    rows : rows of a table
+    values : {column: value} a row must match
+    columns : {outfield: column}
+    filters : {column: list of allowed values}
+
+    Returns {outfield: list of files}.
+    """
+    filters = filters or {}
+    files = dict([(key, []) for key in columns])
+    for row in rows:
+        if any([row.get(name) != str(value) for name, value in values.items()]):
+            continue
+        if any([row.get(name) not in [str(val) for val in allowed]
+                for name, allowed in filters.items()]):
+            continue
+        for key, column in columns.items():
+            if row.get(column):
+                files[key].append(row[column])
+    return files
+
+
+def unique_values(rows, column):
+    """Values of a column in table order, without repeats
+    """
+    values = []
+    seen = set()
+    for row in rows:
+        if row[column] not in seen:
+            seen.add(row[column])
+            values.append(row[column])
+    return values
+
+
+class ManifestGrabberInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
+    manifest_file = File(exists=True, mandatory=True,
+                         desc='CSV or TSV table of file names')
+    columns = traits.Dict(desc='Column of each outfield (defaults to the '
+                               'outfield name)')
+    filters = traits.Dict(desc='Allowed values of columns that are not '
+                               'infields')
+    raise_on_empty = traits.Bool(True, usedefault=True,
+                                 desc='Raise an error if an outfield has '
+                                      'no files')
+
+
+class ManifestGrabber(nio.IOBase):
+    """Grab the files of the rows of a table matching the infields
+
+    Outputs a single file name per outfield when one row matches and a list
+    when several do.
+    """
+    input_spec = ManifestGrabberInputSpec
+    output_spec = DynamicTraitedSpec
+
+    def __init__(self, infields=None, outfields=None, **kwargs):
+        super(ManifestGrabber, self).__init__(**kwargs)
+        self._infields = infields or []
+        self._outfields = outfields or []
+        undefined_traits = {}
+        for key in self._infields:
+            self.inputs.add_trait(key, traits.Any)
+            undefined_traits[key] = Undefined
+        self.inputs.trait_set(trait_change_notify=False, **undefined_traits)
+
+    def _add_output_traits(self, base):
+        return nio.add_traits(base, self._outfields)
+
+    def _list_outputs(self):
+        values = {}
+        for key in self._infields:
+            value = getattr(self.inputs, key)
+            if not isdefined(value):
+                raise ValueError("%s requires a value for input '%s' because "
+                                 "it was listed in 'infields'"
+                                 % (self.__class__.__name__, key))
+            values[key] = value
+        columns = dict([(key, key) for key in self._outfields])
+        if isdefined(self.inputs.columns):
+            columns.update(self.inputs.columns)
+        filters = None
+        if isdefined(self.inputs.filters):
+            filters = self.inputs.filters
+        _, rows = read_table(self.inputs.manifest_file)
+        files = select_files(rows, values, columns, filters)
+        outputs = {}
+        for key in self._outfields:
+            if not files[key]:
+                msg = 'Output key: %s %s returned no files' % (key, values)
+                if self.inputs.raise_on_empty:
+                    raise IOError(msg)
+                outputs[key] = None
+            else:
+                outputs[key] = list_to_filename(files[key])
+        return outputs
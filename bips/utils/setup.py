@@ -8,6 +8,7 @@ def configuration(parent_package='',top_path=None):
     config.add_subpackage('reportsink')
 
     # List all data directories to be loaded here
+    config.add_data_dir('tests')
     return config
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_equal
+
+from bips.utils.function_cache import FunctionCache
+
+FUNCTION = 'def smooth(in_file, fwhm):\n    pass\n'
+
+
+def _write(path, text):
+    with open(path, 'w') as fp:
+        fp.write(text)
+    return path
+
+
+def _dirs():
+    tmpdir = tempfile.mkdtemp()
+    for name in ['cache', 'work1', 'work2', 'inputs']:
+        os.mkdir(os.path.join(tmpdir, name))
+    return tmpdir, [os.path.join(tmpdir, name)
+                    for name in ['cache', 'work1', 'work2', 'inputs']]
+
+
+def test_key():
+    tmpdir, (cache_dir, work1, work2, inputs) = _dirs()
+    try:
+        cache = FunctionCache(cache_dir)
+        in1 = _write(os.path.join(work1, 'in.nii'), 'data')
+        in2 = _write(os.path.join(work2, 'in.nii'), 'data')
+        key = cache.key(FUNCTION, {'in_file': in1, 'fwhm': 5}, ['out_file'])
+        # files count by name and content, not by location
+        assert_equal(cache.key(FUNCTION, {'in_file': in2, 'fwhm': 5},
+                               ['out_file']), key)
+        assert_equal(cache.key(FUNCTION, {'in_file': in1, 'fwhm': 6},
+                               ['out_file']) == key, False)
+        assert_equal(cache.key(FUNCTION, {'in_file': in1, 'fwhm': 5},
+                               ['out_file', 'log']) == key, False)
+        _write(in2, 'other data')
+        assert_equal(cache.key(FUNCTION, {'in_file': in2, 'fwhm': 5},
+                               ['out_file']) == key, False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_hit_and_miss():
+    tmpdir, (cache_dir, work1, work2, inputs) = _dirs()
+    try:
+        cache = FunctionCache(cache_dir)
+        in_file = _write(os.path.join(inputs, 'in.nii'), 'data')
+        args = {'in_file': in_file, 'fwhm': 5}
+        key = cache.key(FUNCTION, args, ['out_file', 'in_file'])
+        assert_equal(cache.get(key, 'smooth', work1, args), None)
+        out_file = _write(os.path.join(work1, 'out.nii'), 'smoothed')
+        cache.put(key, 'smooth', {'out_file': out_file, 'in_file': in_file,
+                                  'fwhm': 5}, args)
+        outputs = cache.get(key, 'smooth', work2, args)
+        assert_equal(outputs['out_file'], os.path.join(work2, 'out.nii'))
+        assert_equal(open(outputs['out_file']).read(), 'smoothed')
+        # passed through inputs are not stored
+        assert_equal(outputs['in_file'], os.path.realpath(in_file))
+        assert_equal(outputs['fwhm'], 5)
+        entry = os.path.join(cache_dir, key[:2], key, 'files')
+        assert_equal([name for _, _, files in os.walk(entry)
+                      for name in files], ['out.nii'])
+        assert_equal(cache.stats(), {'smooth': (1, 1)})
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_eviction():
+    tmpdir, (cache_dir, work1, work2, inputs) = _dirs()
+    try:
+        out_file = _write(os.path.join(work1, 'out.nii'), 'x' * 1000)
+        cache = FunctionCache(cache_dir, max_size=2500)
+        keys = []
+        for fwhm in range(3):
+            args = {'fwhm': fwhm}
+            keys.append(cache.key(FUNCTION, args, ['out_file']))
+            cache.put(keys[-1], 'smooth', {'out_file': out_file}, args)
+            # the first entry stays the most recently used one
+            assert_equal(cache.get(keys[0], 'smooth', work2,
+                                   {'fwhm': 0}) is None, False)
+        assert_equal(cache.get(keys[1], 'smooth', work2, {'fwhm': 1}), None)
+        assert_equal(cache.get(keys[2], 'smooth', work2,
+                               {'fwhm': 2}) is None, False)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -4,9 +4,11 @@ import os
 from nipype.utils.filemanip import save_json
 from nipype.interfaces.base import traits
 from traits.api import (HasTraits, HasStrictTraits, Str, Bool, Button, TraitError)
-from .flexible_datagrabber import Data
+from .flexible_datagrabber import Data, ManifestData
 from traits.api import HasTraits, Directory, Bool
-_workflow = {}
+from .registry import (_workflow, register_workflow, get_workflow,
+                       get_workflows, list_workflows, configure_workflow,
+                       run_workflow, display_workflow_info, query_workflows)
 
 def _decode_list(data):
     rv = []
@@ -53,7 +55,10 @@ def load_config(configfile, config_class):
             dg = getattr(c,item)
             if isinstance(dg,Data):
                 try:
-                    foo = Data(val["outfields"])
+                    if 'manifest_file' in val:
+                        foo = ManifestData(val["outfields"])
+                    else:
+                        foo = Data(val["outfields"])
                     foo.set_fields(val)
                     d = {}
                     d[item] = foo
@@ -266,52 +271,10 @@ def create_bips_config(workflow):
     config.configure_traits(view=view)
 
 
-def register_workflow(wf):
-    _workflow[wf.uuid] = dict(object = wf)
-
-
-def get_workflow(uuid):
-    if uuid in _workflow:
-        return _workflow[uuid]['object']
-    wf_found = [key for key in _workflow if key.startswith(uuid)]
-    if not len(wf_found):
-        raise ValueError('No workflow with uuid %s found' % uuid)
-    if len(wf_found) > 1:
-        raise Exception('Multiple workflows found with partial uuid %s' % uuid)
-    return get_workflow(wf_found[0])
-
 def get_config(uuid):
     wf = get_workflow(uuid)
     return wf.config_ui()
 
-def get_workflows():
-    return sorted(_workflow.items())
-
-def list_workflows():
-    for wf, value in get_workflows():
-        print('%s %s' % (wf,
-                         value['object'].help.split('\n')[1]))
-
-def configure_workflow(uuid):
-    wf = get_workflow(uuid)
-    create_bips_config(wf)
-
-
-def run_workflow(configfile):
-    config = load_json(configfile)
-    wf = get_workflow(config['uuid'])
-    wf.workflow_main_function(configfile)
-
-
-def display_workflow_info(uuid):
-    wf = get_workflow(uuid)
-    import pprint
-    pprint.pprint(wf.get())
-
-
-def query_workflows(query_str):
-    pass
-
 def save_config(config,path=os.path.abspath('config.json')):
     data = config.get()
     d = {}
@@ -364,6 +327,20 @@ class BaseWorkflowConfig(HasTraits):
         desc='Affects whether where and if the workflow keeps its \
                             intermediary files. True to keep intermediary files. ')
     timeout = traits.Float(14.0)
+    n_shards = traits.Int(1, usedefault=True,
+        desc="Split the subjects into this many configs that run as \
+                            separate jobs")
+    shard_by = traits.Enum('count', 'size', usedefault=True,
+        desc="Balance shards by number of subjects or by input image size")
+
+    # Profiling
+    profiling = Bool(False, usedefault=True,
+        desc="Record per-node timing, memory and cache use in profile_db")
+    profile_db = traits.File(desc="SQLite database for profiling results. \
+                             Defaults to bips_profile.db in working_dir")
+    function_cache_dir = traits.Directory(desc="Directory of the cache of \
+                                          Function node results shared by all \
+                                          workflows")
     
     # Advanced Options
     use_advanced_options = traits.Bool()
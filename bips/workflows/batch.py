@@ -0,0 +1,263 @@
+"""Run many workflow configurations in one process
+
+Each config is run through its workflow's main function exactly as
+``bips -r config.json`` would, except that ``Workflow.run`` is intercepted:
+the workflows are only collected. Their execution graphs are then merged and
+executed by a single MultiProc plugin, so all configs share one bounded pool
+of local workers while every node keeps the working_dir, crash_dir and the
+rest of the config of its own workflow. The workflows one config runs one
+after the other (e.g. the info and convert workflows of dicom_conversion)
+still run in that order: the first nodes of each wait for the last nodes of
+the previous one. A workflow run more than once by a main function is run
+once, as it was last configured.
+
+Building the execution graphs relies on nipype internals (see
+check_nipype), and main functions that need the results of one workflow to
+build the next, or that never call Workflow.run (such as dicom_conversion
+with watch on), cannot be batched.
+"""
+import os
+import time
+from glob import glob
+
+
+def expand_config_files(paths):
+    """Expand directories and glob patterns into a list of config files
+    """
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            configs.extend(sorted(glob(os.path.join(path, '*.json'))))
+        elif any(char in path for char in '*?['):
+            configs.extend(sorted(glob(path)))
+        else:
+            configs.append(path)
+    return [os.path.abspath(config) for config in configs]
+
+
+def count_subjects(c):
+    """Number of subjects a config runs on
+
+    Uses the ``subjects`` list, or the longest iterable field of a
+    datagrabber, and falls back to 1.
+    """
+    from .flexible_datagrabber import Data
+    if getattr(c, 'test_mode', False):
+        return 1
+    subjects = getattr(c, 'subjects', None)
+    if isinstance(subjects, list) and subjects:
+        return len(subjects)
+    counts = [1]
+    for item in c.get().values():
+        if isinstance(item, Data):
+            counts.extend([len(field.values) for field in item.fields
+                           if field.iterable])
+    return max(counts)
+
+
+# the internals of nipype's Workflow.run that _execution_graph repeats
+WORKFLOW_INTERNALS = ['_create_flat_graph', '_set_needed_outputs',
+                      '_configure_exec_nodes', '_write_report_info']
+
+
+def check_nipype():
+    """Raise a RuntimeError if the installed nipype lacks the internals
+    the execution graphs are built with
+    """
+    import nipype
+    import nipype.pipeline.engine as pe
+    missing = [name for name in WORKFLOW_INTERNALS
+               if not hasattr(pe.Workflow, name)]
+    try:
+        from nipype.pipeline.utils import generate_expanded_graph, merge_dict
+    except ImportError:
+        missing.append('nipype.pipeline.utils')
+    if missing:
+        raise RuntimeError('Batch mode builds execution graphs the way '
+                           'Workflow.run does, but nipype %s has no %s; run '
+                           'the configs one at a time with bips -r instead'
+                           % (getattr(nipype, '__version__', '?'),
+                              ', '.join(missing)))
+
+
+class _RunCollector(object):
+    """Replace Workflow.run with a method that records the workflow and its
+    execution graph, and returns the graph without running it
+
+    A workflow that is run again replaces its earlier record.
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.graphs = []
+
+    def __enter__(self):
+        import nipype.pipeline.engine as pe
+        check_nipype()
+        collector = self
+
+        def run(wf, plugin=None, plugin_args=None, updatehash=False):
+            execgraph = _execution_graph(wf)
+            for index, (collected, _) in enumerate(collector.runs):
+                if collected is wf:
+                    collector.runs[index] = (wf, updatehash)
+                    collector.graphs[index] = execgraph
+                    return execgraph
+            collector.runs.append((wf, updatehash))
+            collector.graphs.append(execgraph)
+            return execgraph
+
+        self._run = pe.Workflow.run
+        pe.Workflow.run = run
+        return self
+
+    def __exit__(self, *args):
+        import nipype.pipeline.engine as pe
+        pe.Workflow.run = self._run
+
+
+def _execution_graph(wf):
+    """Build the execution graph of a workflow as Workflow.run does, with
+    the config of the workflow applied to its nodes
+    """
+    from copy import deepcopy
+    from nipype import config
+    from nipype.pipeline.utils import generate_expanded_graph, merge_dict
+
+    if 'crashdump_dir' in wf.config:
+        # deprecated location, still honoured by Workflow.run
+        wf.config.setdefault('execution', {})['crashdump_dir'] = \
+            wf.config.pop('crashdump_dir')
+    flatgraph = wf._create_flat_graph()
+    wf.config = merge_dict(deepcopy(config._sections), wf.config)
+    wf._set_needed_outputs(flatgraph)
+    execgraph = generate_expanded_graph(deepcopy(flatgraph))
+    for node in execgraph.nodes():
+        node.config = merge_dict(deepcopy(wf.config), node.config)
+        node.base_dir = wf.base_dir
+    wf._configure_exec_nodes(execgraph)
+    return execgraph
+
+
+def _chain(graph, before, after):
+    """Make the first nodes of the execution graph after wait for the last
+    nodes of before in graph
+    """
+    leaves = [node for node in before.nodes() if not before.out_degree(node)]
+    roots = [node for node in after.nodes() if not after.in_degree(node)]
+    for leaf in leaves:
+        for root in roots:
+            graph.add_edge(leaf, root, connect=[])
+
+
+def _merge(sequences):
+    """Compose lists of execution graphs into one graph, in which the
+    graphs of each list run one after the other
+    """
+    import networkx as nx
+    graph = nx.DiGraph()
+    for sequence in sequences:
+        previous = None
+        for execgraph in sequence:
+            if not execgraph.number_of_nodes():
+                continue
+            graph = nx.compose(graph, execgraph)
+            if previous is not None:
+                _chain(graph, previous, execgraph)
+            previous = execgraph
+    return graph
+
+
+def run_batch(configfiles, n_procs=None):
+    """Run several config files on a shared pool of n_procs workers
+
+    Parameters
+    ----------
+
+    configfiles : list of config files, directories or glob patterns
+    n_procs : maximum number of nodes running at the same time
+              (defaults to the number of cpus)
+
+    Returns
+    -------
+
+    dict with the number of configs, workflows and subjects, the elapsed
+    time and the throughput in subjects per hour
+    """
+    from copy import deepcopy
+    from nipype import config
+    from nipype.pipeline.plugins import MultiProcPlugin
+    from nipype.utils.misc import str2bool
+    from ..utils.function_cache import function_cache
+    from .base import load_json, load_config
+    from .registry import get_workflow
+
+    if n_procs is None:
+        from multiprocessing import cpu_count
+        n_procs = cpu_count()
+    configfiles = expand_config_files(configfiles)
+    if not configfiles:
+        raise ValueError('No config files found')
+
+    subjects = 0
+    # index of the first collected workflow of every config
+    starts = []
+    with _RunCollector() as collector:
+        for configfile in configfiles:
+            settings = load_json(configfile)
+            mwf = get_workflow(settings['uuid'])
+            c = load_config(configfile, mwf.config_ui)
+            if getattr(c, 'watch', False):
+                raise ValueError('%s watches for new data and never '
+                                 'finishes; run it with bips -r instead'
+                                 % configfile)
+            subjects += count_subjects(c)
+            print('Building %s' % configfile)
+            starts.append(len(collector.runs))
+            with function_cache(settings.get('function_cache_dir')):
+                mwf.workflow_main_function(configfile)
+    ends = starts[1:] + [len(collector.runs)]
+
+    seen = {}
+    for wf, _ in collector.runs:
+        if wf.base_dir is None:
+            raise ValueError('Workflow %s has no working_dir' % wf.name)
+        key = (os.path.abspath(wf.base_dir), wf.name)
+        if key in seen:
+            raise ValueError('Workflow %s is run twice in working_dir %s'
+                             % (wf.name, key[0]))
+        seen[key] = wf
+    for (wf, _), execgraph in zip(collector.runs, collector.graphs):
+        if str2bool(wf.config['execution']['create_report']):
+            wf._write_report_info(wf.base_dir, wf.name, execgraph)
+
+    t0 = time.time()
+    error = None
+    for updatehash in [False, True]:
+        graph = _merge([[collector.graphs[index]
+                         for index in range(start, end)
+                         if collector.runs[index][1] == updatehash]
+                        for start, end in zip(starts, ends)])
+        if not graph.number_of_nodes():
+            continue
+        for index, node in enumerate(graph.nodes()):
+            node.index = index
+        runner = MultiProcPlugin(plugin_args={'n_procs': n_procs})
+        try:
+            runner.run(graph, updatehash=updatehash,
+                       config=deepcopy(config._sections))
+        except RuntimeError as e:
+            error = e
+    elapsed = time.time() - t0
+
+    stats = {'configs': len(configfiles),
+             'workflows': len(collector.runs),
+             'subjects': subjects,
+             'elapsed': elapsed,
+             'subjects_per_hour': subjects * 3600. / max(elapsed, 1e-6)}
+    print('Ran %(workflows)d workflows from %(configs)d configs '
+          '(%(subjects)d subjects) in %(elapsed).1f s: '
+          '%(subjects_per_hour).1f subjects/hour' % stats)
+    if error is not None:
+        raise error
+    return stats
@@ -0,0 +1,235 @@
+"""Dry-run cost estimates for workflow configs
+
+``estimate(configfile)`` builds the workflow of a config, expands its
+iterables, runs only its datagrabbers (DataGrabber and ManifestGrabber nodes)
+to find the actual input files and reads the headers of those images. From
+that it predicts the number of nodes that will run (counting every MapNode
+iteration), the space the working directory will need and the cpu time of
+the run. Nothing is written to the working directory.
+
+Per-node cpu times and output sizes are taken from a profiling database (see
+profiling.py) when one is given; the history of a MapNode covers all of its
+iterations. Nodes without history are assumed to write one float32 copy of
+the largest input image of their subject per iteration and to take
+DEFAULT_NODE_SECONDS per 100 MB of that image.
+"""
+import os
+from copy import deepcopy
+
+DEFAULT_NODE_SECONDS = 60.
+REFERENCE_BYTES = 100 * 1024 ** 2
+
+
+def _flatten(value):
+    if isinstance(value, (list, tuple)):
+        files = []
+        for val in value:
+            files.extend(_flatten(val))
+        return files
+    if isinstance(value, basestring):
+        return [value]
+    return []
+
+
+def image_info(filename):
+    """Shape and size of an image, read from its header only
+
+    Returns None for files nibabel cannot read.
+    """
+    import numpy as np
+    from nibabel import load
+    try:
+        img = load(filename)
+    except Exception:
+        return None
+    shape = img.get_shape()
+    return {'shape': list(shape),
+            'volumes': shape[3] if len(shape) > 3 else 1,
+            'nbytes': int(np.prod(shape)) * img.get_data_dtype().itemsize,
+            'float_bytes': int(np.prod(shape)) * 4}
+
+
+def grabber_types():
+    """Interfaces whose nodes are run to find the input files
+    """
+    import nipype.interfaces.io as nio
+    from ..utils.manifest_grabber import ManifestGrabber
+    return (nio.DataGrabber, ManifestGrabber)
+
+
+def _node_inputs(graph, node):
+    """Values of the inputs of node that are connected to identity nodes
+
+    Iterable values are set on identity nodes in the expanded graph, so this
+    resolves e.g. the subject_id of a DataGrabber without running anything.
+    """
+    from nipype.interfaces.utility import IdentityInterface
+    from nipype.pipeline.utils import evaluate_connect_function
+    values = {}
+    for src in graph.predecessors(node):
+        if not isinstance(src._interface, IdentityInterface):
+            continue
+        src_inputs = src.inputs.get()
+        for sourceinfo, dest in graph.get_edge_data(src, node)['connect']:
+            if isinstance(sourceinfo, tuple):
+                value = evaluate_connect_function(sourceinfo[1], sourceinfo[2],
+                                                  src_inputs[sourceinfo[0]])
+            else:
+                value = src_inputs[sourceinfo]
+            values[dest] = value
+    return values
+
+
+def _grab(graph, node):
+    """Run the datagrabber interface of node and return its image info
+    """
+    dg = deepcopy(node._interface)
+    dg.inputs.set(**_node_inputs(graph, node))
+    info = {'files': {}, 'missing': False}
+    try:
+        outputs = dg.run().outputs.get()
+    except Exception:
+        info['missing'] = True
+        return info
+    for field, value in outputs.items():
+        info['files'][field] = [image_info(f) for f in _flatten(value)]
+    return info
+
+
+def _upstream_grabbers(graph, node, grabbers):
+    """DataGrabber nodes upstream of node
+    """
+    found = []
+    seen = set([node])
+    stack = [node]
+    while stack:
+        for src in graph.predecessors(stack.pop()):
+            if src in seen:
+                continue
+            seen.add(src)
+            if src in grabbers:
+                found.append(src)
+            else:
+                stack.append(src)
+    return found
+
+
+def read_history(profile_db):
+    """Mean cpu time and output size per node name from a profile db
+
+    Nodes run by distributed plugins have no cpu time recorded; their wall
+    time is used instead. MapNodes count as a whole, as in the graph,
+    without their subnodes (which run in <mapnode dir>/mapflow).
+    """
+    from .profiling import connect
+    conn = connect(profile_db)
+    history = {}
+    for name, cpu, nbytes in conn.execute(
+            'SELECT name, AVG(COALESCE(cpu_user + cpu_sys, wall)), '
+            'AVG(output_bytes) FROM nodes WHERE cached=0 AND '
+            'output_dir NOT LIKE ? GROUP BY name',
+            ('%' + os.sep + 'mapflow' + os.sep + '%',)):
+        history[name] = {'cpu_seconds': cpu, 'output_bytes': nbytes}
+    conn.close()
+    return history
+
+
+def build_workflow(configfile):
+    """Build (but do not run) the workflow of a config file
+    """
+    from .base import load_json, load_config
+    from .batch import _RunCollector
+    from .registry import get_workflow
+    mwf = get_workflow(load_json(configfile)['uuid'])
+    c = load_config(configfile, mwf.config_ui)
+    if _takes_config(mwf.workflow_function):
+        return [mwf.workflow_function(c)]
+    # workflow_function needs more than the config; let main build it
+    with _RunCollector() as collector:
+        mwf.workflow_main_function(configfile)
+    return [wf for wf, _ in collector.runs]
+
+
+def _takes_config(function):
+    """Whether function can be called with the config alone
+    """
+    import inspect
+    spec = inspect.getargspec(function)
+    args = spec.args[1:] if inspect.ismethod(function) else spec.args
+    required = len(args) - len(spec.defaults or [])
+    return required <= 1 and (bool(args) or spec.varargs is not None)
+
+
+def estimate(configfile, profile_db=None):
+    """Estimate node count, working directory size and cpu time of a config
+
+    Returns a dict with the totals and a per node name breakdown.
+    """
+    import nipype.pipeline.engine as pe
+    from nipype.interfaces.utility import IdentityInterface
+    from nipype.pipeline.utils import generate_expanded_graph
+
+    history = {}
+    if profile_db and os.path.exists(profile_db):
+        history = read_history(profile_db)
+
+    totals = {'nodes': 0, 'bytes': 0., 'cpu_seconds': 0., 'missing': 0,
+              'input_bytes': 0, 'per_name': {}}
+    grabber_interfaces = grabber_types()
+    for wf in build_workflow(configfile):
+        graph = generate_expanded_graph(deepcopy(wf._create_flat_graph()))
+        grabbers = dict([(node, _grab(graph, node)) for node in graph.nodes()
+                         if isinstance(node._interface, grabber_interfaces)])
+        for info in grabbers.values():
+            totals['missing'] += info['missing']
+            for images in info['files'].values():
+                totals['input_bytes'] += sum([img['nbytes'] for img in images
+                                              if img])
+        for node in graph.nodes():
+            if isinstance(node._interface, IdentityInterface):
+                continue
+            width = 1
+            largest = 0
+            for dg in _upstream_grabbers(graph, node, grabbers):
+                for images in grabbers[dg]['files'].values():
+                    width = max(width, len(images))
+                    largest = max([largest] + [img['float_bytes']
+                                               for img in images if img])
+            if not isinstance(node, pe.MapNode):
+                width = 1
+            name = node.name
+            if name in history and history[name]['cpu_seconds'] is not None:
+                # already the total over the iterations of a MapNode
+                seconds = history[name]['cpu_seconds']
+                nbytes = history[name]['output_bytes'] or 0.
+            else:
+                seconds = width * DEFAULT_NODE_SECONDS * max(largest, 1) / \
+                    REFERENCE_BYTES
+                nbytes = width * largest
+            stats = totals['per_name'].setdefault(name, {'nodes': 0,
+                                                         'bytes': 0.,
+                                                         'cpu_seconds': 0.})
+            for key, val in [('nodes', width), ('bytes', nbytes),
+                             ('cpu_seconds', seconds)]:
+                stats[key] += val
+                totals[key] += val
+    return totals
+
+
+def print_estimate(configfile, profile_db=None, top=10):
+    est = estimate(configfile, profile_db)
+    print('Config: %s' % configfile)
+    print('Nodes to run:      %d' % est['nodes'])
+    print('Input data:        %.2f GB' % (est['input_bytes'] / 1024. ** 3))
+    print('Working directory: %.2f GB' % (est['bytes'] / 1024. ** 3))
+    print('CPU time:          %.1f hours' % (est['cpu_seconds'] / 3600.))
+    if est['missing']:
+        print('WARNING: %d datagrabbers found no files' % est['missing'])
+    print('\n%-35s %8s %10s %10s' % ('node', 'count', 'GB', 'cpu hours'))
+    per_name = sorted(est['per_name'].items(),
+                      key=lambda item: -item[1]['cpu_seconds'])
+    for name, stats in per_name[:top]:
+        print('%-35s %8d %10.2f %10.2f' % (name, stats['nodes'],
+                                          stats['bytes'] / 1024. ** 3,
+                                          stats['cpu_seconds'] / 3600.))
+    return est
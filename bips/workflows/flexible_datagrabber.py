@@ -21,6 +21,8 @@ def get_view():
         Item(name='field_template'),
         Item(name='template_args')),
         Item(name='sort'),
+        Item(name='use_index'),
+        Item(name='index_file'),
         Item(name='check'),
         buttons=[OKButton, CancelButton],
         resizable=True,
@@ -69,6 +71,10 @@ class Data(HasTraits):
     template_args = traits.Dict({"a":"b"},usedefault=True) 
     field_template = traits.Dict({"key":["hi"]},usedefault=True)
     sort = traits.Bool(True)
+    use_index = traits.Bool(False, desc="Answer templates from a cached index \
+                            of base_directory instead of globbing it on every run")
+    index_file = traits.File(desc="File index of base_directory. \
+                             Defaults to one in ~/.bips/file_index")
 
     if use_view:
         check = traits.Button("Check")
@@ -111,13 +117,24 @@ class Data(HasTraits):
                 self._wk.connect(it,f.name,self._dg,f.name)
         self._dg.inputs.trait_set(**set_dict)
         
-    def create_dataflow(self):
+    def _grabber_interface(self):
         import nipype.interfaces.io as nio
+        if self.use_index:
+            from bips.utils.indexed_datagrabber import IndexedDataGrabber
+            dg = IndexedDataGrabber(outfields=self.outfields,
+                                    infields=self._get_infields(),
+                                    sort_filelist=self.sort)
+            if self.index_file:
+                dg.inputs.index_file = self.index_file
+            return dg
+        return nio.DataGrabber(outfields=self.outfields,
+                               infields=self._get_infields(),
+                               sort_filelist=self.sort)
+
+    def create_dataflow(self):
         import nipype.pipeline.engine as pe
         self._wk = pe.Workflow(name='custom_datagrabber')
-        self._dg = pe.Node(nio.DataGrabber(outfields = self.outfields, 
-                                     infields = self._get_infields(),sort_filelist=self.sort),
-                                     name='datagrabber') 
+        self._dg = pe.Node(self._grabber_interface(), name='datagrabber')
         self._set_inputs()
         self._dg.inputs.base_directory = self.base_directory
         self._dg.inputs.field_template = self.field_template
@@ -155,9 +172,270 @@ class Data(HasTraits):
                     foo.append(tmp)
                 self.set(**{key:foo})
 
+    def _field_values(self):
+        """Values of all fields for every combination of the iterables
+        """
+        from itertools import product
+        fixed = dict([(f.name, f.values) for f in self.fields
+                      if not f.iterable])
+        iterables = [f for f in self.fields if f.iterable]
+        for values in product(*[f.values for f in iterables]):
+            yield dict(fixed, **dict(zip([f.name for f in iterables],
+                                         values)))
+
+    def _fill_templates(self, values):
+        """Glob patterns of every outfield for one combination of values
+
+        Expands template_args the way nipype's DataGrabber does: list
+        valued arguments give one pattern per element.
+        """
+        patterns = {}
+        for key, args in self.template_args.items():
+            template = os.path.join(os.path.abspath(self.base_directory),
+                                    self.field_template.get(key,
+                                                            self.template))
+            if not args:
+                patterns[key] = [template]
+                continue
+            patterns[key] = []
+            for arglist in args:
+                arglist = [values.get(arg, arg) if isinstance(arg, basestring)
+                           else arg for arg in arglist]
+                lengths = set([len(arg) for arg in arglist
+                               if isinstance(arg, list)])
+                if len(lengths) > 1:
+                    raise ValueError('incompatible number of arguments for %s'
+                                     % key)
+                for i in range(max(lengths or [1])):
+                    argtuple = tuple([arg[i] if isinstance(arg, list) else arg
+                                      for arg in arglist])
+                    patterns[key].append(template % argtuple if argtuple
+                                         else template)
+        return patterns
+
+    def validate(self, n_procs=16):
+        """Check which files the templates find, without running nipype
+
+        The templates of all iterable values are globbed in parallel (using
+        the file index when use_index is set).
+
+        Returns a list with a dict per combination of iterable values:
+        'values' maps field names to values and 'fields' maps each outfield
+        to a list of (pattern, files, status) tuples, where status is one of
+        'ok', 'missing' (no match) or 'multiple' (several matches).
+        """
+        from glob import glob
+        from multiprocessing.pool import ThreadPool
+        index = None
+        if self.use_index:
+            from bips.utils.file_index import FileIndex
+            index = FileIndex(self.base_directory, self.index_file or None)
+            glob = index.glob
+
+        def check(values):
+            try:
+                patterns = self._fill_templates(values)
+            except (ValueError, TypeError) as e:
+                return {'values': values, 'error': str(e), 'fields': {}}
+            fields = {}
+            for key, key_patterns in patterns.items():
+                fields[key] = []
+                for pattern in key_patterns:
+                    files = sorted(glob(pattern))
+                    status = 'ok'
+                    if not files:
+                        status = 'missing'
+                    elif len(files) > 1:
+                        status = 'multiple'
+                    fields[key].append((pattern, files, status))
+            return {'values': values, 'fields': fields}
+
+        pool = ThreadPool(n_procs)
+        try:
+            report = pool.map(check, list(self._field_values()))
+        finally:
+            pool.close()
+            pool.join()
+        if index is not None:
+            index.save()
+        return report
+
     def _check_fired(self):
-        dg = self.create_dataflow()
-        dg.run()
+        print_report(self.validate())
+
+
+def get_manifest_view():
+    from traitsui.api import View, Item, Group
+    from traitsui.menu import OKButton, CancelButton
+    view = View(Group(Item(name='fields'),
+        Item(name='manifest_file'),
+        Item(name='columns'),
+        Item(name='check_files')),
+        Item(name='check'),
+        buttons=[OKButton, CancelButton],
+        resizable=True,
+        width=1050)
+    return view
+
+
+class ManifestData(Data):
+    """Datagrabber reading file names from a CSV/TSV table
+
+    Each iterable field names a table column that identifies a subject (or
+    session, run, ...); its values restrict the run to those values, and
+    are all values in the table when left empty. Non iterable fields
+    restrict their column to their values. Every outfield is read from the
+    column named like it, unless columns maps it to another one.
+
+    The table is read and validated once when the workflow is built; no
+    directories are globbed.
+    """
+    manifest_file = traits.File(desc="CSV or TSV table with a header row and \
+                                absolute file names")
+    columns = traits.Dict(desc="Column of each outfield, if not named like \
+                          the outfield")
+    check_files = traits.Bool(True, usedefault=True,
+                              desc="Check that all files in the table exist")
+
+    if use_view:
+        view = get_manifest_view()
+
+    def _columns(self):
+        columns = dict([(key, key) for key in self.outfields])
+        columns.update(self.columns)
+        return columns
+
+    def _filters(self):
+        return dict([(f.name, f.values) for f in self.fields
+                     if not f.iterable and f.values != ['']])
+
+    def _iterable_values(self, rows):
+        """Iterable fields with the values they take in this run
+        """
+        from bips.utils.manifest_grabber import unique_values
+        iterables = []
+        for f in self.fields:
+            if f.iterable:
+                values = [val for val in f.values if val != '']
+                if not values:
+                    values = unique_values(rows, f.name)
+                iterables.append((f.name, values))
+        return iterables
+
+    def read(self):
+        """Validate the table and return its rows
+        """
+        from bips.utils.manifest_grabber import check_table
+        keys = [f.name for f in self.fields]
+        _, rows = check_table(self.manifest_file, keys,
+                              sorted(set(self._columns().values())),
+                              self.check_files)
+        return rows
+
+    def create_dataflow(self):
+        import nipype.interfaces.utility as niu
+        import nipype.pipeline.engine as pe
+        from bips.utils.manifest_grabber import ManifestGrabber
+        iterables = self._iterable_values(self.read())
+        self._wk = pe.Workflow(name='custom_datagrabber')
+        self._dg = pe.Node(ManifestGrabber(
+            infields=[name for name, _ in iterables],
+            outfields=self.outfields), name='datagrabber')
+        self._dg.inputs.manifest_file = os.path.abspath(self.manifest_file)
+        self._dg.inputs.columns = self._columns()
+        self._dg.inputs.filters = self._filters()
+        for name, values in iterables:
+            it = pe.Node(niu.IdentityInterface(fields=[name]),
+                         name=name + "_iterable")
+            it.iterables = (name, values)
+            self._wk.connect(it, name, self._dg, name)
+        if not iterables:
+            self._wk.add_nodes([self._dg])
+        return self._wk
+
+    def validate(self, n_procs=16):
+        """Check the files the table lists for every iterable value
+
+        Returns a report like Data.validate, with the column of each
+        outfield in place of its glob pattern. Problems with the table
+        itself are reported as an error.
+        """
+        from itertools import product
+        from bips.utils.manifest_grabber import select_files
+        try:
+            rows = self.read()
+        except (ValueError, IOError, OSError) as e:
+            return [{'values': {}, 'error': str(e), 'fields': {}}]
+        iterables = self._iterable_values(rows)
+        columns = self._columns()
+        filters = self._filters()
+        report = []
+        for combination in product(*[values for _, values in iterables]):
+            values = dict(zip([name for name, _ in iterables], combination))
+            files = select_files(rows, values, columns, filters)
+            fields = {}
+            for key, column in columns.items():
+                status = 'ok'
+                if not files[key]:
+                    status = 'missing'
+                elif len(files[key]) > 1:
+                    status = 'multiple'
+                fields[key] = [(column, files[key], status)]
+            report.append({'values': values, 'fields': fields})
+        return report
+
+
+def print_report(report, verbose=False):
+    """Print a validation report of Data.validate
+
+    Shows the combinations with missing files, ambiguous matches or errors
+    (all combinations if verbose) and returns the number of problems.
+    """
+    problems = 0
+    for row in report:
+        statuses = [status for entries in row['fields'].values()
+                    for _, _, status in entries]
+        bad = 'error' in row or 'missing' in statuses
+        problems += bad
+        if not (bad or verbose or 'multiple' in statuses):
+            continue
+        iterables = ', '.join(['%s=%s' % (key, val) for key, val in
+                               sorted(row['values'].items())
+                               if not isinstance(val, list)])
+        print(iterables)
+        if 'error' in row:
+            print('    error: %s' % row['error'])
+        for key, entries in sorted(row['fields'].items()):
+            for pattern, files, status in entries:
+                print('    %-15s %-8s %3d  %s' % (key, status, len(files),
+                                                 pattern))
+    counts = {}
+    for row in report:
+        for entries in row['fields'].values():
+            for _, _, status in entries:
+                counts[status] = counts.get(status, 0) + 1
+    print('%d combinations, templates: %d ok, %d missing, %d multiple '
+          'matches, %d errors' % (len(report), counts.get('ok', 0),
+                         counts.get('missing', 0), counts.get('multiple', 0),
+                         len([row for row in report if 'error' in row])))
+    return problems
+
+
+def validate_config(configfile, n_procs=16, verbose=False):
+    """Validate every datagrabber of a config file
+
+    Returns the number of combinations with missing files or errors.
+    """
+    from .base import load_json, load_config
+    from .registry import get_workflow
+    mwf = get_workflow(load_json(configfile)['uuid'])
+    c = load_config(configfile, mwf.config_ui)
+    problems = 0
+    for name, item in sorted(c.get().items()):
+        if isinstance(item, Data):
+            print('Datagrabber: %s' % name)
+            problems += print_report(item.validate(n_procs), verbose)
+    return problems
 
 if __name__ == "__main__":    
     a = Data(['func','struct'])
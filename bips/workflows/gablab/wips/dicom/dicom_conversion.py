@@ -40,6 +40,19 @@ class config(BaseWorkflowConfig):
     no_moco = traits.Bool(False,desc="only convert non-moco files")
     use_heuristic = traits.Bool(False)
     heuristic_file = traits.File(desc="heuristic file")
+    conversion_procs = traits.Int(0, usedefault=True,
+        desc="series of a subject converted at the same time (0: number of "
+             "cpus); with the MultiProc plugin these are threads, which "
+             "only overlap file reads and compression, so prefer more "
+             "plugin processes there")
+
+    #Watch Folder
+    watch = traits.Bool(False,
+        desc="keep converting series as they arrive instead of running once")
+    watch_quiet = traits.Int(60, usedefault=True,
+        desc="seconds without new dicoms after which a series is complete")
+    watch_idle = traits.Int(0, usedefault=True,
+        desc="stop once no dicoms arrived for this many seconds (0: never)")
 
 def create_config():
     c = config()
@@ -76,7 +89,12 @@ def create_view():
             Item('use_heuristic',enabled_when="not info_only"), 
             Item('no_moco',enabled_when="not info_only and not use_heuristic"),
             Item('heuristic_file',enabled_when="use_heuristic"),
-            Item('embed_meta',enabled_when='not info_only')),
+            Item('embed_meta',enabled_when='not info_only'),
+            Item('conversion_procs',enabled_when='not info_only')),
+        Group(Item('watch'),
+            Item('watch_quiet',enabled_when='watch'),
+            Item('watch_idle',enabled_when='watch'),
+            label='Watch Folder', show_border=True),
         buttons = [OKButton, CancelButton],
         resizable=True,
         width=1050)
@@ -142,24 +160,28 @@ def get_dicom_info(c):
 def isMoco(dcmfile):
     """Determine if a dicom file is a mocoseries
     """
-    import subprocess
-    print dcmfile
-    cmd = ['mri_probedicom', '--i', dcmfile, '--t', '8', '103e']
-    proc  = subprocess.Popen(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    return stdout.strip().startswith('MoCoSeries')
+    from bips.workflows.gablab.wips.scripts.dicom_index import (read_header,
+                                                               is_moco)
+    return is_moco(read_header(dcmfile))
 
 
 def convert_dicoms(sid, dicom_dir_template, outputdir, queue=None, heuristic_func=None,
-                   extension = None,embed=False,no_moco=False):
+                   extension = None,embed=False,no_moco=False,n_procs=None):
 
     import os
+    import inspect
     from nipype.utils.filemanip import load_json,save_json
-    from glob import glob
+    from bips.workflows.gablab.wips.scripts.dicom_index import (DicomIndex,
+                                                               is_moco)
+    from bips.workflows.gablab.wips.scripts.dicom_utils import (convert_many,
+                                                               series_name)
     sdir = dicom_dir_template%sid
     tdir = os.path.join(outputdir, sid)
+    if not os.path.exists(tdir):
+        os.makedirs(tdir)
+    # headers of the session, read only for new or changed files
+    index = DicomIndex(os.path.join(tdir,'dicom_index.sqlite'))
+    index.update_dir(sdir)
     infofile =  os.path.join(tdir,'%s.auto.txt' % sid)
     editfile =  os.path.join(tdir,'%s.edit.txt' % sid)
     if os.path.exists(editfile) and heuristic_func:
@@ -168,72 +190,52 @@ def convert_dicoms(sid, dicom_dir_template, outputdir, queue=None, heuristic_fun
         pass
     else:
         infofile =  os.path.join(tdir,'%s.auto.txt' % sid)
-        info = heuristic_func(sdir, os.path.join(tdir,'dicominfo.txt'))
+        # heuristics taking a third argument get the header index
+        if len(inspect.getargspec(heuristic_func).args) > 2:
+            info = heuristic_func(sdir, os.path.join(tdir,'dicominfo.txt'),
+                                  index)
+        else:
+            info = heuristic_func(sdir, os.path.join(tdir,'dicominfo.txt'))
         save_json(infofile, info)
 
+    # the session is scanned once (by the index) and grouped by the run
+    # number in the file names, i.e. what glob('*-%d-*' % run) finds
+    runs = index.runs(sdir)
+    jobs = []
     if heuristic_func:
-        import dicom
-        import dcmstack
         for key in info:
             if not os.path.exists(os.path.join(tdir,key)):
                 os.mkdir(os.path.join(tdir,key))
             for idx, ext in enumerate(info[key]):
-                src = glob(os.path.join(sdir,'*-%d-*'%ext))
-                print key
-                dcm = dcmstack.DicomStack()
-                added_success = True
-                for f in src:
-                    try:
-                        dcm.add_dcm(dicom.read_file(f,force=True))
-                        
-                    except:
-                        added_success = False
-                        print "error adding %s to stack"%f
-                if added_success:
-                    a = dcm.to_nifti(embed_meta = embed)
-                    a.to_filename(os.path.join(tdir,key,key+'%03d'%(idx+1)))
-                #convertcmd = ['dcmstack', sdir,'--dest-dir', os.path.join(tdir,key),
-                #              '--file-ext', '*-%d-*'%ext, '--force-read', '-v', '--output-name', key+'%03d'%(idx+1)]
-                #if embed:
-                #    convertcmd.append('--embed-meta')
-                #convertcmd = ' '.join(convertcmd)
-                #print convertcmd
-                #os.system(convertcmd)
+                jobs.append((runs.get(str(ext), []),
+                             os.path.join(tdir,key,key+'%03d.nii.gz'%(idx+1))))
     else:
-        if not no_moco:
-            convertcmd = ['dcmstack', sdir, '--dest-dir', os.path.join(outputdir,sid),
-                          '--force-read','-v']
-            if embed:
-                convertcmd.append('--embed-meta')
-            convertcmd = ' '.join(convertcmd)
-            print convertcmd
-            os.system(convertcmd)
-        else:
-            import numpy as np
-            def isMoco(dcmfile):
-                """Determine if a dicom file is a mocoseries
-                """
-                import subprocess
-                print dcmfile
-                cmd = ['mri_probedicom', '--i', dcmfile, '--t', '8', '103e']
-                proc  = subprocess.Popen(cmd,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-                stdout, stderr = proc.communicate()
-                return stdout.strip().startswith('MoCoSeries')
-
-            foo = np.genfromtxt(os.path.join(tdir,'dicominfo.txt'),dtype=str)
-            for f in foo:
-                if not isMoco(glob(os.path.join(sdir,f[1]))[0]):
-                    convertcmd = ['dcmstack', sdir, '--dest-dir', os.path.join(outputdir,sid),
-                          '--force-read','-v','--file-ext','*-%s-*'%f[2]]
-                    if embed:
-                        convertcmd.append('--embed-meta')
-                    convertcmd = ' '.join(convertcmd)
-                    print convertcmd
-                    os.system(convertcmd)
-                else:
-                    print "skipping moco run %s"%f[1]
+        # MoCo series are told apart by the SeriesDescription in the index
+        for number, src in sorted(index.series(sdir).items()):
+            row = index.headers(src[:1])[0]
+            if no_moco and is_moco(row):
+                print "skipping moco series %s" % number
+                continue
+            jobs.append((src, os.path.join(tdir, series_name(
+                row['protocol_name'], number))))
+
+    # series are independent, convert the changed ones in parallel; whole
+    # sessions are split into stacks (echoes, ...) like the dcmstack command
+    todo = []
+    for src, out in jobs:
+        if not src:
+            print "no dicoms for %s" % out
+            continue
+        fingerprint = index.fingerprint(src, embed)
+        if index.is_converted(out, fingerprint):
+            print "%s is up to date" % out
+            continue
+        todo.append((src, out, fingerprint))
+    outputs = convert_many([(src, out, embed) for src, out, _ in todo],
+                           n_procs, group=not heuristic_func)
+    for (src, out, fingerprint), result in zip(todo, outputs):
+        if result:
+            index.set_converted(out, fingerprint)
     return 1
 
 
@@ -244,7 +246,8 @@ def convert_wkflw(c,heuristic_func=None):
     infosource=pe.Node(util.IdentityInterface(fields=['subject_id']),name='subject_names')
     convert = pe.Node(util.Function(input_names=['sid', 'dicom_dir_template',
                                                  'outputdir', 'queue',
-                                                 'heuristic_func','extension','embed','no_moco'],
+                                                 'heuristic_func','extension','embed','no_moco',
+                                                 'n_procs'],
                                     output_names=['out'],
                                     function=convert_dicoms),
                       name='converter')
@@ -261,6 +264,7 @@ def convert_wkflw(c,heuristic_func=None):
     convert.inputs.extension= None
     convert.inputs.embed=c.embed_meta
     convert.inputs.no_moco = c.no_moco
+    convert.inputs.n_procs = c.conversion_procs or None
     wk.base_dir = c.working_dir
     return wk
 
@@ -281,6 +285,13 @@ def main(config_file):
         print "USING HEURISTIC: ", heuristic_func
     else:
         heuristic_func=None
+    if c.watch:
+        from bips.workflows.gablab.wips.scripts.dicom_watch import watch_dicoms
+        watch_dicoms(c.subjects, os.path.join(c.base_dir,c.dicom_dir_template),
+                     c.sink_dir, quiet=c.watch_quiet, idle=c.watch_idle,
+                     embed=c.embed_meta, no_moco=c.no_moco,
+                     n_procs=c.conversion_procs or None)
+        return 1
     if c.info_only:
         try:
             get_dicom_info(c)
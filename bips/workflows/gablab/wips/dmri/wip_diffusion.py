@@ -196,6 +196,7 @@ def create_prep(use_fieldmap):
     from nipype.workflows.smri.freesurfer import create_getmask_flow
     import nipype.interfaces.fsl as fsl          # fsl
     import nipype.interfaces.utility as util     # utility
+    from bips.utils.function_cache import CachedFunction
     import nipype.pipeline.engine as pe          # pypeline engine
     fsl.FSLCommand.set_default_output_type('NIFTI')
     import bips.utils.reportsink.io as io
@@ -300,7 +301,7 @@ def create_prep(use_fieldmap):
         function=get_flirt_motion_parameters),
         name="get_motion_parameters",iterfield="flirt_out_mats")
 
-    plotmotion = pe.MapNode(util.Function(input_names=["motion_parameters"],
+    plotmotion = pe.MapNode(CachedFunction(input_names=["motion_parameters"],
                                           output_names=["fname_t","fname_r"],
                                           function=plot_motion),
         name="plot_motion",iterfield="motion_parameters")
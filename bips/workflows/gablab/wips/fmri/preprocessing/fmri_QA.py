@@ -320,6 +320,7 @@ def QA_workflow(QAc,c=foo, name='QA'):
     """
     import nipype.pipeline.engine as pe
     import nipype.interfaces.utility as util
+    from bips.utils.function_cache import CachedFunction
 
     from nipype.interfaces.freesurfer import ApplyVolTransform
     from nipype.interfaces import freesurfer as fs
@@ -398,7 +399,7 @@ def QA_workflow(QAc,c=foo, name='QA'):
     
     # Define Nodes
     
-    plot_m = pe.MapNode(util.Function(input_names=['motion_parameters'],
+    plot_m = pe.MapNode(CachedFunction(input_names=['motion_parameters'],
                                       output_names=['fname_t','fname_r'],
                                       function=plot_motion),
                         name="motion_plots",
@@ -412,7 +413,7 @@ def QA_workflow(QAc,c=foo, name='QA'):
                                       function=tsdiffana), 
                         name='tsdiffana', iterfield=["img"])
                         
-    art_info = pe.MapNode(util.Function(input_names = ['art_file','intensity_file','stats_file'],
+    art_info = pe.MapNode(CachedFunction(input_names = ['art_file','intensity_file','stats_file'],
                                       output_names = ['table','out','intensity_plot'],
                                       function=art_output), 
                         name='art_output', iterfield=["art_file","intensity_file","stats_file"])
@@ -187,6 +187,7 @@ def QA_workflow(c, prep_c,name='QA'):
     """
     import nipype.pipeline.engine as pe
     import nipype.interfaces.utility as util
+    from bips.utils.function_cache import CachedFunction
     from ...scripts.QA_utils import (tsnr_roi,
                                                                     art_output)
     from ......utils.reportsink.io import JSONSink
@@ -198,7 +199,7 @@ def QA_workflow(c, prep_c,name='QA'):
     
     #workflow.connect(infosource, 'subject_id', inputspec, 'subject_id')
    
-    art_info = pe.MapNode(util.Function(input_names = ['art_file','intensity_file','stats_file'],
+    art_info = pe.MapNode(CachedFunction(input_names = ['art_file','intensity_file','stats_file'],
                                       output_names = ['table','out','intensity_plot'],
                                       function=art_output), 
                         name='art_output', iterfield=["art_file","intensity_file","stats_file"])
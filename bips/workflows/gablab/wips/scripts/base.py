@@ -159,6 +159,7 @@ def create_prep(name='preproc'):
     from modular_nodes import create_mod_smooth, mod_realign, mod_despike
     import nipype.pipeline.engine as pe
     import nipype.interfaces.utility as util
+    from bips.utils.function_cache import CachedFunction
 
     preproc = pe.Workflow(name=name)
 
@@ -289,7 +290,7 @@ def create_prep(name='preproc'):
                           name='highpass')
 
     # Calculate the z-score of output
-    zscore = pe.MapNode(interface=util.Function(input_names=['image','outliers'],
+    zscore = pe.MapNode(interface=CachedFunction(input_names=['image','outliers'],
                                              output_names=['z_img'],
                                              function=z_image),
                         name='z_score',
@@ -618,13 +619,14 @@ def create_rest_prep(name='preproc',fieldmap=False,extra_args={}):
     from modular_nodes import mod_filter, mod_regressor
     import nipype.pipeline.engine as pe
     import nipype.interfaces.utility as util
+    from bips.utils.function_cache import CachedFunction
     if fieldmap:
         preproc = create_prep_fieldmap()
     else:
         preproc = create_prep()
 
     #add outliers and noise components
-    addoutliers = pe.MapNode(util.Function(input_names=['motion_params',
+    addoutliers = pe.MapNode(CachedFunction(input_names=['motion_params',
                                                      'composite_norm',
                                                      "compcorr_components","global_signal",
                                                      "art_outliers",
@@ -0,0 +1,282 @@
+"""Persistent index of dicom header fields
+
+The header fields the conversion workflows group series by are kept in a
+SQLite database per subject, keyed by file path, size and mtime. Updating
+the index only reads the headers (never the pixel data) of files that are
+new or changed since the last update, in parallel, and forgets files that
+are gone, so re-running on an unchanged session does not open a single
+dicom. The index also remembers which outputs were converted from which
+files, so unchanged series need not be converted again.
+"""
+import fnmatch
+import hashlib
+import os
+import re
+import sqlite3
+
+# every '-<number>-' in a file name, as glob('*-%d-*' % number) sees it
+_run_number = re.compile(r'(?=-(\d+)-)')
+
+# column, dicom keyword
+FIELDS = [('patient_name', 'PatientName'),
+          ('series_number', 'SeriesNumber'),
+          ('protocol_name', 'ProtocolName'),
+          ('series_description', 'SeriesDescription'),
+          ('image_type', 'ImageType'),
+          ('instance_number', 'InstanceNumber'),
+          ('tr', 'RepetitionTime'),
+          ('te', 'EchoTime')]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER,
+                                    mtime REAL, readable INTEGER,
+                                    %s);
+CREATE TABLE IF NOT EXISTS conversions (output TEXT PRIMARY KEY,
+                                        fingerprint TEXT);
+""" % ', '.join(['%s TEXT' % column for column, _ in FIELDS])
+
+COLUMNS = ['path', 'size', 'mtime', 'readable'] + \
+    [column for column, _ in FIELDS]
+
+
+def _text(value):
+    if value is None:
+        return None
+    if hasattr(value, 'to_eng_string'):
+        return value.to_eng_string()
+    if isinstance(value, (list, tuple)):
+        return '\\'.join([str(val) for val in value])
+    return str(value)
+
+
+def read_header(path):
+    """The indexed fields of a dicom file as strings (None when missing),
+    or None if the file is not a dicom
+    """
+    import dicom
+    try:
+        dcm = dicom.read_file(path, force=True, stop_before_pixels=True)
+        return dict([(column, _text(getattr(dcm, keyword, None)))
+                     for column, keyword in FIELDS])
+    except Exception:
+        return None
+
+
+def is_moco(header):
+    """Whether the header (from read_header or the index) is of a MoCo
+    series, i.e. its SeriesDescription starts with MoCoSeries
+    """
+    return bool(header) and \
+        (header['series_description'] or '').strip().startswith('MoCoSeries')
+
+
+def _read_chunk(paths):
+    return [read_header(path) for path in paths]
+
+
+def read_headers(paths, n_procs=None, chunksize=500):
+    """read_header of every path, in order, by a pool of n_procs processes
+    (threads inside daemonic processes, which cannot have children)
+    """
+    from multiprocessing import Pool, cpu_count, current_process
+    if n_procs is None:
+        n_procs = cpu_count()
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    if n_procs < 2 or len(chunks) < 2:
+        return _read_chunk(paths)
+    if current_process().daemon:
+        # e.g. a node run by the MultiProc plugin; reading headers is
+        # mostly waiting for the disk, which threads do in parallel
+        from multiprocessing.pool import ThreadPool as Pool
+    pool = Pool(min(n_procs, len(chunks)))
+    try:
+        results = pool.map(_read_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [header for chunk in results for header in chunk]
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+class DicomIndex(object):
+    """Header fields of the dicoms of a subject
+
+    Parameters
+    ----------
+
+    db_file : the SQLite database (created if needed)
+    n_procs : processes reading headers (defaults to the number of cpus)
+    """
+
+    def __init__(self, db_file, n_procs=None):
+        self.db_file = os.path.abspath(db_file)
+        self.n_procs = n_procs
+        self._cache = None
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def _rows(self):
+        # kept until the next update, lookups happen once per series
+        if self._cache is None:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT %s FROM headers'
+                                    % ', '.join(COLUMNS)).fetchall()
+            finally:
+                conn.close()
+            self._cache = dict([(row[0], dict(zip(COLUMNS, row)))
+                                for row in rows])
+        return self._cache
+
+    def update(self, paths):
+        """Index the new and changed files of paths and forget indexed files
+        that no longer exist; returns the number of headers read
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        self._cache = None
+        known = self._rows()
+        stats = {}
+        for path in paths:
+            # files may vanish while a session is being transferred
+            try:
+                stats[path] = _stat(path)
+            except OSError:
+                pass
+        paths = [path for path in paths if path in stats]
+        stale = [path for path in paths if path not in known or
+                 (known[path]['size'], known[path]['mtime']) != stats[path]]
+        gone = [path for path in known if path not in stats and
+                not os.path.exists(path)]
+        if not stale and not gone:
+            return 0
+        headers = read_headers(stale, self.n_procs)
+        rows = []
+        for path, header in zip(stale, headers):
+            size, mtime = stats[path]
+            header = header or {}
+            rows.append([path, size, mtime, int(bool(header))] +
+                        [header.get(column) for column, _ in FIELDS])
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('DELETE FROM headers WHERE path = ?',
+                                 [(path,) for path in gone])
+                conn.executemany('INSERT OR REPLACE INTO headers (%s) '
+                                 'VALUES (%s)'
+                                 % (', '.join(COLUMNS),
+                                    ', '.join('?' * len(COLUMNS))), rows)
+        finally:
+            conn.close()
+        self._cache = None
+        return len(stale)
+
+    def update_dir(self, dcmdir, pattern='*'):
+        """Index the files of dcmdir matching pattern and return their paths
+
+        Hidden files (such as the temporary files of rsync) are skipped
+        unless pattern starts with a dot, as glob would.
+        """
+        dcmdir = os.path.abspath(dcmdir)
+        names = fnmatch.filter(os.listdir(dcmdir), pattern)
+        if not pattern.startswith('.'):
+            names = [name for name in names if not name.startswith('.')]
+        paths = [os.path.join(dcmdir, name) for name in sorted(names)]
+        paths = [path for path in paths if os.path.isfile(path)]
+        self.update(paths)
+        return paths
+
+    def headers(self, paths=None):
+        """Indexed fields of paths (default: all readable files, by path),
+        in order; None for files that are not dicoms
+        """
+        rows = self._rows()
+        if paths is None:
+            return [rows[path] for path in sorted(rows)
+                    if rows[path]['readable']]
+        return [rows[path] if rows[path]['readable'] else None
+                for path in [os.path.abspath(path) for path in paths]]
+
+    def match(self, pattern, dcmdir=None):
+        """Readable indexed files (below dcmdir) whose name matches pattern
+        """
+        if dcmdir is not None:
+            dcmdir = os.path.abspath(dcmdir)
+        return [row['path'] for row in self.headers()
+                if fnmatch.fnmatch(os.path.basename(row['path']), pattern)
+                and (dcmdir is None or
+                     os.path.dirname(row['path']) == dcmdir)]
+
+    def runs(self, dcmdir=None):
+        """{run number: readable files} by the '-<number>-' parts of their
+        names, so runs[str(n)] are the dicoms glob('*-%d-*' % n) finds
+        """
+        runs = {}
+        for path in self.match('*', dcmdir):
+            name = os.path.basename(path)
+            for number in set(_run_number.findall(name)):
+                runs.setdefault(number, []).append(path)
+        return runs
+
+    def series(self, dcmdir=None):
+        """{series number: files ordered by instance number}
+        """
+        series = {}
+        for row in self.headers():
+            if dcmdir is not None and \
+                    os.path.dirname(row['path']) != os.path.abspath(dcmdir):
+                continue
+            if row['series_number'] is None:
+                continue
+            series.setdefault(int(row['series_number']), []).append(row)
+        for number, rows in series.items():
+            rows.sort(key=lambda row: (int(row['instance_number'] or 0),
+                                       row['path']))
+            series[number] = [row['path'] for row in rows]
+        return series
+
+    def fingerprint(self, paths, *args):
+        """Hash of the paths, their sizes and mtimes, and args
+        """
+        rows = self._rows()
+        md5 = hashlib.md5()
+        for path in sorted([os.path.abspath(path) for path in paths]):
+            row = rows.get(path)
+            if row is None:
+                size, mtime = _stat(path)
+            else:
+                size, mtime = row['size'], row['mtime']
+            md5.update(('%s %d %r\n' % (path, size, mtime)).encode('utf-8'))
+        md5.update(repr(args).encode('utf-8'))
+        return md5.hexdigest()
+
+    def is_converted(self, output, fingerprint):
+        """Whether output exists and was converted from files with this
+        fingerprint
+        """
+        if not os.path.exists(output):
+            return False
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT fingerprint FROM conversions '
+                               'WHERE output = ?', (output,)).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row[0] == fingerprint
+
+    def set_converted(self, output, fingerprint):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO conversions '
+                             '(output, fingerprint) VALUES (?, ?)',
+                             (output, fingerprint))
+        finally:
+            conn.close()
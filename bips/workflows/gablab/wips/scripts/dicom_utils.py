@@ -1,7 +1,14 @@
 import os
 
-def parse_dcm_dir(dcmdir,outfile=os.path.abspath('dicominfo.json')):
-    import dicom
+def parse_dcm_dir(dcmdir,outfile=os.path.abspath('dicominfo.json'),
+                  n_procs=None,chunksize=500,index_file=None):
+    """Summarize the dicoms of a directory by series in a json file
+
+    Headers are read in parallel by n_procs processes (default: number of
+    cpus) in chunks of chunksize files and sorted in file order, so the
+    result does not depend on n_procs. With an index_file (see
+    dicom_index.DicomIndex) only new or changed files are read.
+    """
     from glob import glob
     from nipype.utils.filemanip import save_json
 
@@ -16,8 +23,12 @@ def parse_dcm_dir(dcmdir,outfile=os.path.abspath('dicominfo.json')):
     # items are dicts with keys "dicoms": list of dicoms
     # "TE" and "TR" floats
     # if for some reason there is a mismatch, raise error for now
-    for d in files: 
-        sortdcm(d,info)
+    if index_file:
+        headers = indexed_readdcms(files,index_file,n_procs)
+    else:
+        headers = readdcms(files,n_procs,chunksize)
+    for d, data in zip(files, headers):
+        _sortdcm(d,data,info)
 
     save_json(outfile,info)
     return outfile    
@@ -26,7 +37,8 @@ def readdcm(dcm):
     import dicom
    
     out = {}   
-    dicm = dicom.read_file(dcm,force=True)
+    # the header is all we need, skip reading the pixel data
+    dicm = dicom.read_file(dcm,force=True,stop_before_pixels=True)
 
     out["PatientName"] = dicm.PatientName
     out["SeriesNumber"] = dicm.SeriesNumber.real
@@ -36,8 +48,59 @@ def readdcm(dcm):
 
     return out
 
+def _readdcm_chunk(files):
+    out = []
+    for dcm in files:
+        data = readdcm(dcm)
+        # plain strings travel back from the workers
+        data["PatientName"] = str(data["PatientName"])
+        data["ProtocolName"] = str(data["ProtocolName"])
+        out.append(data)
+    return out
+
+def readdcms(files,n_procs=None,chunksize=500):
+    """readdcm of every file, in order, read by a pool of n_procs processes
+    (threads inside daemonic processes, which cannot have children)
+    """
+    from multiprocessing import Pool, cpu_count, current_process
+    if n_procs is None:
+        n_procs = cpu_count()
+    chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+    if n_procs < 2 or len(chunks) < 2:
+        return _readdcm_chunk(files)
+    if current_process().daemon:
+        # e.g. a node run by the MultiProc plugin; reading headers is
+        # mostly waiting for the disk, which threads do in parallel
+        from multiprocessing.pool import ThreadPool as Pool
+    pool = Pool(min(n_procs, len(chunks)))
+    try:
+        results = pool.map(_readdcm_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [data for chunk in results for data in chunk]
+
+def indexed_readdcms(files,index_file,n_procs=None):
+    """readdcm of every file, in order, from a dicom header index
+    """
+    from bips.workflows.gablab.wips.scripts.dicom_index import DicomIndex
+    index = DicomIndex(index_file,n_procs)
+    index.update(files)
+    out = []
+    for dcm, row in zip(files, index.headers(files)):
+        if row is None:
+            raise IOError('%s is not a dicom file' % dcm)
+        out.append({"PatientName": row["patient_name"],
+                    "SeriesNumber": int(row["series_number"]),
+                    "ProtocolName": row["protocol_name"],
+                    "TR": row["tr"],
+                    "TE": row["te"]})
+    return out
+
 def sortdcm(dcm,info):
-    data = readdcm(dcm)
+    return _sortdcm(dcm,readdcm(dcm),info)
+
+def _sortdcm(dcm,data,info):
     if not "PatientName" in info.keys():
         info["PatientName"] = data["PatientName"]
     if not data["PatientName"] == info["PatientName"]:
@@ -61,3 +124,109 @@ def sortdcm(dcm,info):
 
     info[keyname]["dicoms"].append(dcm)
     return info
+
+def series_name(protocol_name,series_number):
+    """File name dcmstack gives a series: <series number>-<protocol>.nii.gz
+    """
+    import string
+    name = ''.join([char if char in string.ascii_letters + string.digits +
+                    '-_.' else '_' for char in protocol_name or ''])
+    return '%03d-%s.nii.gz' % (int(series_number), name)
+
+def _write_stack(stack,out_file,embed=False,meta_file=None):
+    import dcmstack
+    if meta_file:
+        nii = stack.to_nifti(embed_meta=True)
+        nii_wrp = dcmstack.NiftiWrapper(nii)
+        with open(meta_file, 'w') as fp:
+            fp.write(nii_wrp.meta_ext.to_json())
+        if not embed:
+            nii_wrp.remove_extension()
+    else:
+        nii = stack.to_nifti(embed_meta=embed)
+    nii.to_filename(out_file)
+    return out_file
+
+def convert_series(dicoms,out_file,embed=False,meta_file=None):
+    """Stack dicoms into a nifti file, and their meta data into the json
+    file meta_file if given
+
+    Returns out_file, or None (and writes nothing) if any of the dicoms
+    could not be added to the stack.
+    """
+    import dicom
+    import dcmstack
+    dcm = dcmstack.DicomStack()
+    added_success = True
+    for f in dicoms:
+        try:
+            dcm.add_dcm(dicom.read_file(f,force=True))
+        except Exception:
+            added_success = False
+            print("error adding %s to stack" % f)
+    if not added_success:
+        return None
+    return _write_stack(dcm,out_file,embed,meta_file)
+
+def convert_groups(dicoms,out_file,embed=False,meta_file=None):
+    """Split dicoms into stacks the way the dcmstack command does (by
+    dcmstack.parse_and_group, e.g. one stack per echo) and convert each
+
+    The first stack goes to out_file, the others to out_file with -002,
+    -003, ... before the .nii.gz, each with its own meta data file (meta_file
+    likewise suffixed) if meta_file is given. Returns out_file, or None if
+    any stack could not be converted.
+    """
+    import dcmstack
+    groups = dcmstack.parse_and_group(dicoms,force=True)
+    if not groups:
+        return None
+    base = out_file[:-len('.nii.gz')]
+    for idx, key in enumerate(sorted(groups)):
+        out = out_file
+        meta = meta_file
+        if idx:
+            out = '%s-%03d.nii.gz' % (base, idx + 1)
+            if meta_file:
+                meta = out + meta_file[len(out_file):]
+        try:
+            _write_stack(dcmstack.stack_group(groups[key]),out,embed,meta)
+        except Exception as e:
+            print("error stacking %s: %s" % (out, e))
+            return None
+    return out_file
+
+def _convert_job(args):
+    group, job = args
+    convert = convert_groups if group else convert_series
+    try:
+        return convert(*job)
+    except Exception as e:
+        print("error converting %s: %s" % (job[1], e))
+        return None
+
+def convert_many(jobs,n_procs=None,group=False):
+    """convert_series(*job) (convert_groups(*job) if group) of every job,
+    running n_procs (default: number of cpus) conversions at a time; returns
+    the outputs in job order
+
+    Daemonic processes (e.g. a Function node run by the MultiProc plugin)
+    cannot have children, there the conversions run in n_procs threads,
+    which overlap reading the dicoms and compressing the niftis but not
+    the work done in Python.
+    """
+    from multiprocessing import Pool, cpu_count, current_process
+    if not n_procs:
+        n_procs = cpu_count()
+    jobs = [(group, job) for job in jobs]
+    if n_procs < 2 or len(jobs) < 2:
+        return [_convert_job(job) for job in jobs]
+    if current_process().daemon:
+        from multiprocessing.pool import ThreadPool as Pool
+    pool = Pool(min(n_procs, len(jobs)))
+    try:
+        # one series per task, series differ a lot in size
+        return pool.map(_convert_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,123 @@
+"""Convert dicoms series by series while a session is being transferred
+
+The dicom directories of the subjects are polled. New files are added to
+the header index of their subject (see dicom_index) and grouped into series
+by SeriesNumber. A series counts as complete once no file has been added to
+it for quiet seconds, or for settle seconds once a later series of the
+session has started (scanners send series one after the other). Complete
+series are converted right away, in parallel, into the subject's output
+directory as <series>-<protocol>.nii.gz with the dcmstack meta data in
+<series>-<protocol>.nii.gz.json; series holding several stacks (e.g. echoes)
+get one file per stack, as with the dcmstack command. A series that receives
+more files after it was converted is converted again.
+"""
+import os
+import time
+
+from .dicom_index import DicomIndex, is_moco
+from .dicom_utils import convert_many, series_name
+
+
+class SeriesWatcher(object):
+    """Convert the complete series of one session directory
+
+    Parameters
+    ----------
+
+    dcmdir : directory the dicoms of the session arrive in
+    outdir : output directory of the subject
+    quiet : seconds without new files after which a series is complete
+    settle : the same, once a later series has started
+    embed : embed the meta data in the nifti files
+    no_moco : skip MoCo series
+    n_procs : series converted at the same time (default: number of cpus)
+    """
+
+    def __init__(self, dcmdir, outdir, quiet=60, settle=10, embed=False,
+                 no_moco=False, n_procs=None):
+        self.dcmdir = os.path.abspath(dcmdir)
+        self.outdir = os.path.abspath(outdir)
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        self.quiet = quiet
+        self.settle = settle
+        self.embed = embed
+        self.no_moco = no_moco
+        self.n_procs = n_procs
+        self.index = DicomIndex(os.path.join(self.outdir,
+                                             'dicom_index.sqlite'), n_procs)
+        # series number: (number of files, when that number was first seen)
+        self._seen = {}
+        self.last_change = time.time()
+
+    def ready(self, now=None):
+        """[(series number, files)] of the series that are complete
+        """
+        if now is None:
+            now = time.time()
+        if not os.path.isdir(self.dcmdir):
+            return []
+        self.index.update_dir(self.dcmdir)
+        series = self.index.series(self.dcmdir)
+        for number, files in series.items():
+            if self._seen.get(number, (None,))[0] != len(files):
+                self._seen[number] = (len(files), now)
+                self.last_change = now
+        newest = max(series) if series else None
+        ready = []
+        for number, files in sorted(series.items()):
+            quiet = now - self._seen[number][1]
+            if quiet >= self.quiet or \
+                    (number != newest and quiet >= self.settle):
+                ready.append((number, files))
+        return ready
+
+    def poll(self, now=None):
+        """Convert the complete series that changed since their last
+        conversion and return the new outputs
+        """
+        todo = []
+        for number, files in self.ready(now):
+            row = self.index.headers(files[:1])[0]
+            if self.no_moco and is_moco(row):
+                continue
+            out = os.path.join(self.outdir,
+                               series_name(row['protocol_name'], number))
+            fingerprint = self.index.fingerprint(files, self.embed)
+            if self.index.is_converted(out, fingerprint):
+                continue
+            todo.append((files, out, fingerprint))
+        outputs = convert_many([(files, out, self.embed, out + '.json')
+                                for files, out, _ in todo], self.n_procs,
+                               group=True)
+        converted = []
+        for (files, out, fingerprint), result in zip(todo, outputs):
+            if result:
+                self.index.set_converted(out, fingerprint)
+                converted.append(out)
+                print('converted %d dicoms to %s' % (len(files), out))
+        return converted
+
+
+def watch_dicoms(sids, dicom_dir_template, outputdir, interval=10, quiet=60,
+                 settle=10, idle=0, embed=False, no_moco=False, n_procs=None):
+    """Convert the series of the sessions of sids as they arrive
+
+    The dicoms of subject sid arrive in dicom_dir_template % sid and are
+    converted into outputdir/sid. The directories are polled every interval
+    seconds until every session has been without new files for idle seconds
+    (forever if idle is 0). Returns {sid: converted files}.
+    """
+    watchers = dict([(sid, SeriesWatcher(dicom_dir_template % sid,
+                                         os.path.join(outputdir, sid), quiet,
+                                         settle, embed, no_moco, n_procs))
+                     for sid in sids])
+    converted = dict([(sid, []) for sid in sids])
+    while True:
+        now = time.time()
+        for sid, watcher in sorted(watchers.items()):
+            converted[sid].extend(watcher.poll(now))
+        if idle and all([now - watcher.last_change >= max(idle, quiet)
+                         for watcher in watchers.values()]):
+            return converted
+        time.sleep(interval)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_equal
+
+from bips.workflows.gablab.wips.scripts.dicom_index import DicomIndex
+
+
+def _write(path, text):
+    with open(path, 'w') as fp:
+        fp.write(text)
+
+
+def _session():
+    tmpdir = tempfile.mkdtemp()
+    dcmdir = os.path.join(tmpdir, 'dicoms')
+    os.mkdir(dcmdir)
+    for name in ['a-1-1.dcm', 'a-1-2.dcm', 'a-2-1.dcm']:
+        _write(os.path.join(dcmdir, name), name)
+    index = DicomIndex(os.path.join(tmpdir, 'index.sqlite'), n_procs=1)
+    return tmpdir, dcmdir, index
+
+
+def test_update_reads_new_and_changed_files_only():
+    tmpdir, dcmdir, index = _session()
+    try:
+        paths = index.update_dir(dcmdir)
+        assert_equal(len(paths), 3)
+        assert_equal(index.update(paths), 0)
+        _write(paths[0], 'a longer file than before')
+        assert_equal(index.update(paths), 1)
+        os.remove(paths[1])
+        assert_equal(index.update(paths), 0)
+        assert_equal(sorted(index._rows()), [paths[0], paths[2]])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_update_skips_vanished_and_hidden_files():
+    tmpdir, dcmdir, index = _session()
+    try:
+        _write(os.path.join(dcmdir, '.a-3-1.dcm.tmp'), 'partial')
+        paths = index.update_dir(dcmdir)
+        assert_equal([os.path.basename(path) for path in paths],
+                     ['a-1-1.dcm', 'a-1-2.dcm', 'a-2-1.dcm'])
+        missing = os.path.join(dcmdir, 'a-4-1.dcm')
+        assert_equal(index.update(paths + [missing]), 0)
+        assert_equal(missing in index._rows(), False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_fingerprint():
+    tmpdir, dcmdir, index = _session()
+    try:
+        paths = index.update_dir(dcmdir)
+        fingerprint = index.fingerprint(paths, False)
+        assert_equal(index.fingerprint(paths[::-1], False), fingerprint)
+        assert_equal(index.fingerprint(paths, True) == fingerprint, False)
+        assert_equal(index.fingerprint(paths[:2], False) == fingerprint,
+                     False)
+        _write(paths[0], 'a longer file than before')
+        index.update(paths)
+        assert_equal(index.fingerprint(paths, False) == fingerprint, False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_conversions():
+    tmpdir, dcmdir, index = _session()
+    try:
+        paths = index.update_dir(dcmdir)
+        fingerprint = index.fingerprint(paths)
+        out = os.path.join(tmpdir, 'out.nii.gz')
+        _write(out, '')
+        assert_equal(index.is_converted(out, fingerprint), False)
+        index.set_converted(out, fingerprint)
+        assert_equal(index.is_converted(out, fingerprint), True)
+        assert_equal(index.is_converted(out, 'other'), False)
+        os.remove(out)
+        assert_equal(index.is_converted(out, fingerprint), False)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_equal
+
+from bips.workflows.gablab.wips.scripts.dicom_watch import SeriesWatcher
+
+
+def _write_dicom(path, series, instance):
+    from dicom.dataset import Dataset, FileDataset
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = '1.2.3.%d.%d' % (series, instance)
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2'
+    dcm = FileDataset(path, {}, file_meta=meta, preamble='\0' * 128)
+    dcm.SeriesNumber = series
+    dcm.InstanceNumber = instance
+    dcm.ProtocolName = 'test'
+    dcm.save_as(path)
+
+
+def _numbers(ready):
+    return [number for number, _ in ready]
+
+
+def test_series_are_ready_once_quiet():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dcmdir = os.path.join(tmpdir, 'dicoms')
+        os.mkdir(dcmdir)
+        watcher = SeriesWatcher(dcmdir, os.path.join(tmpdir, 'out'),
+                                quiet=60, settle=10, n_procs=1)
+        for instance in [1, 2]:
+            _write_dicom(os.path.join(dcmdir, 'a-1-%d.dcm' % instance), 1,
+                         instance)
+        assert_equal(watcher.ready(0), [])
+        # the newest series waits for quiet seconds
+        assert_equal(watcher.ready(30), [])
+        # earlier series only for settle seconds once a later one started
+        _write_dicom(os.path.join(dcmdir, 'a-2-1.dcm'), 2, 1)
+        ready = watcher.ready(31)
+        assert_equal(_numbers(ready), [1])
+        assert_equal([os.path.basename(path) for path in ready[0][1]],
+                     ['a-1-1.dcm', 'a-1-2.dcm'])
+        assert_equal(_numbers(watcher.ready(90)), [1])
+        assert_equal(_numbers(watcher.ready(91)), [1, 2])
+        # new files start the wait over
+        _write_dicom(os.path.join(dcmdir, 'a-2-2.dcm'), 2, 2)
+        assert_equal(_numbers(watcher.ready(100)), [1])
+        assert_equal(watcher.last_change, 100)
+        assert_equal(_numbers(watcher.ready(160)), [1, 2])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_missing_directory():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        watcher = SeriesWatcher(os.path.join(tmpdir, 'dicoms'),
+                                os.path.join(tmpdir, 'out'), n_procs=1)
+        assert_equal(watcher.ready(0), [])
+    finally:
+        shutil.rmtree(tmpdir)
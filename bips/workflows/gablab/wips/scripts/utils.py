@@ -306,6 +306,7 @@ def create_compcorr(name='CompCor'):
     """
     import nipype.pipeline.engine as pe
     import nipype.interfaces.utility as util
+    from bips.utils.function_cache import CachedFunction
     from nipype.algorithms.misc import TSNR
     import nipype.interfaces.fsl as fsl
     compproc = pe.Workflow(name=name)
@@ -347,7 +348,7 @@ def create_compcorr(name='CompCor'):
     acomp = extract_csf_mask()
 
     # compcor actually extracts the components
-    compcor = pe.MapNode(util.Function(input_names=['realigned_file',
+    compcor = pe.MapNode(CachedFunction(input_names=['realigned_file',
                                                     'noise_mask_file',
                                                     'num_components',
                                                     'csf_mask_file',
@@ -564,6 +565,7 @@ def art_mean_workflow(name="take_mean_art"):
     # define workflow
     import nipype.pipeline.engine as pe
     import nipype.interfaces.utility as util
+    from bips.utils.function_cache import CachedFunction
     import nipype.algorithms.rapidart as ra     # rapid artifact detection
     wkflw = pe.Workflow(name=name)
 
@@ -573,7 +575,7 @@ def art_mean_workflow(name="take_mean_art"):
                                                        'realignment_parameters']),
                             name='inputspec')
 
-    meanimg = pe.Node(util.Function(input_names=['image','art_file'],
+    meanimg = pe.Node(CachedFunction(input_names=['image','art_file'],
                                        output_names=['mean_image'],
                                        function=weight_mean),
                                        name='weighted_mean')
@@ -19,6 +19,7 @@ def configuration(parent_package='',top_path=None):
     config.add_subpackage('utils')
 
     # List all data directories to be loaded here
+    config.add_data_dir('scripts/tests')
     return config
 
 if __name__ == '__main__':
@@ -0,0 +1,398 @@
+"""Per-node profiling of bips runs
+
+While a ``profile_run`` is active every nipype node that runs in this process
+or in a forked worker (Linear and MultiProc plugins) records its wall time,
+cpu time, peak RSS, input and output sizes and whether it was a cache hit into
+a SQLite database. The peak RSS is sampled while the node runs, over the
+process running it and the processes it starts (Linux only). Nodes run by
+distributed plugins (PBS, SGE, ...) get their wall time from the nipype
+result file once the workflow has finished. The edges of the execution graph
+are stored as well, so that ``profile_report`` can show the critical path of
+a run.
+
+A MapNode is recorded as a whole and every one of its subnodes is recorded
+under the name of the MapNode; the report counts the subnodes, and uses the
+MapNode only for the critical path.
+"""
+import os
+import re
+import resource
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, uuid TEXT,
+                                 config TEXT, started REAL, finished REAL);
+CREATE TABLE IF NOT EXISTS nodes (run_id INTEGER, uuid TEXT, subject TEXT,
+                                  name TEXT, node TEXT, output_dir TEXT,
+                                  hostname TEXT, started REAL, wall REAL,
+                                  cpu_user REAL, cpu_sys REAL, peak_rss REAL,
+                                  input_bytes INTEGER, output_bytes INTEGER,
+                                  cached INTEGER);
+CREATE TABLE IF NOT EXISTS edges (run_id INTEGER, source TEXT, target TEXT);
+CREATE INDEX IF NOT EXISTS nodes_run ON nodes (run_id, uuid, subject, name);
+"""
+
+_subject_param = re.compile(r'^_(subject_id|subjects|subject|sid)_(.+)$')
+
+# the run being profiled in this process (inherited by forked workers)
+_active = {}
+
+
+def connect(db):
+    conn = sqlite3.connect(db, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _file_bytes(value, seen=None):
+    """Total size of the existing files referenced by a (nested) value
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return sum([_file_bytes(val, seen) for val in value])
+    if isinstance(value, basestring) and value not in seen \
+            and os.path.isfile(value):
+        seen.add(value)
+        return os.path.getsize(value)
+    return 0
+
+
+def _subject(node):
+    params = getattr(node, 'parameterization', None) or []
+    # MapNode subnodes have none, but run below their MapNode
+    for param in params or node.output_dir().split(os.sep):
+        match = _subject_param.match(param)
+        if match:
+            return match.group(2)
+    return ','.join(params)
+
+
+def _mapnode_dir(output_dir):
+    """Output directory of the MapNode of a subnode, or None
+    """
+    parent = os.path.dirname(output_dir)
+    if os.path.basename(parent) == 'mapflow':
+        return os.path.dirname(parent)
+    return None
+
+
+def _node_name(node):
+    """Name of a node, that of its MapNode for subnodes
+    """
+    mapnode_dir = _mapnode_dir(node.output_dir())
+    if mapnode_dir is not None:
+        return os.path.basename(mapnode_dir)
+    return node.name
+
+
+def _mapnode_dirs(conn, run_id):
+    """Output directories of the MapNodes of a run whose subnodes were
+    recorded, i.e. that would count twice
+    """
+    dirs = set()
+    for output_dir, in conn.execute('SELECT output_dir FROM nodes '
+                                    'WHERE run_id=?', (run_id,)):
+        mapnode_dir = _mapnode_dir(output_dir or '')
+        if mapnode_dir is not None:
+            dirs.add(mapnode_dir)
+    return dirs
+
+
+def _result_file(node):
+    return os.path.join(node.output_dir(), 'result_%s.pklz' % node.name)
+
+
+def _rss_tree(pid):
+    """Resident memory in MB of a process and its descendants, or None
+    without /proc
+    """
+    children = {}
+    rss = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as fp:
+                # the fields after the command name, which may hold spaces
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+        rss[int(name)] = int(fields[21])
+    if pid not in rss:
+        return None
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total * resource.getpagesize() / 1024. ** 2
+
+
+class _RssSampler(object):
+    """Peak of _rss_tree of this process, sampled every interval seconds
+    between start and stop
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        rss = _rss_tree(os.getpid())
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return self.peak
+
+
+def _cpu():
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF,
+                                                 resource.RUSAGE_CHILDREN]]
+    return (sum([u.ru_utime for u in usage]),
+            sum([u.ru_stime for u in usage]))
+
+
+def _insert_node(conn, row):
+    conn.execute('INSERT INTO nodes VALUES (%s)' % ','.join(['?'] * 15), row)
+
+
+def _profiled_node_run(run):
+    def profiled_run(node, updatehash=False):
+        if not _active:
+            return run(node, updatehash=updatehash)
+        t0 = time.time()
+        user0, sys0 = _cpu()
+        sampler = _RssSampler()
+        sampler.start()
+        try:
+            return run(node, updatehash=updatehash)
+        finally:
+            wall = time.time() - t0
+            user1, sys1 = _cpu()
+            peak_rss = sampler.stop()
+            result_file = _result_file(node)
+            cached = os.path.exists(result_file) and \
+                os.path.getmtime(result_file) < t0
+            outputs = None
+            if getattr(node, 'result', None) is not None \
+                    and node.result.outputs is not None:
+                outputs = node.result.outputs.get()
+            conn = connect(_active['db'])
+            _insert_node(conn, (_active['run_id'], _active['uuid'],
+                                _subject(node), _node_name(node),
+                                node.fullname,
+                                node.output_dir(), socket.gethostname(),
+                                t0, wall, user1 - user0, sys1 - sys0,
+                                peak_rss, _file_bytes(node.inputs.get()),
+                                _file_bytes(outputs), int(cached)))
+            conn.commit()
+            conn.close()
+    return profiled_run
+
+
+def _record_graph(execgraph):
+    """Store the edges of an execution graph and fill in nodes that were not
+    run in a profiled process from their result files
+    """
+    from nipype.utils.filemanip import loadpkl
+    conn = connect(_active['db'])
+    run_id = _active['run_id']
+    recorded = set([row[0] for row in conn.execute(
+        'SELECT output_dir FROM nodes WHERE run_id=?', (run_id,))])
+    for source, target in execgraph.edges():
+        conn.execute('INSERT INTO edges VALUES (?,?,?)',
+                     (run_id, source.output_dir(), target.output_dir()))
+    for node in execgraph.nodes():
+        if node.output_dir() in recorded:
+            continue
+        result_file = _result_file(node)
+        if not os.path.exists(result_file):
+            continue
+        try:
+            result = loadpkl(result_file)
+            runtime = result.runtime
+            wall = getattr(runtime, 'duration', None)
+        except Exception:
+            continue
+        _insert_node(conn, (run_id, _active['uuid'], _subject(node),
+                            node.name, node.fullname, node.output_dir(),
+                            getattr(runtime, 'hostname', None), None, wall,
+                            None, None, None, None, None, None))
+    conn.commit()
+    conn.close()
+
+
+class profile_run(object):
+    """Context manager that profiles all nipype nodes run inside it
+
+    Parameters
+    ----------
+
+    db : SQLite database file
+    uuid : uuid of the workflow being run
+    configfile : config file of the run
+    """
+
+    def __init__(self, db, uuid, configfile):
+        self.db = os.path.abspath(db)
+        self.uuid = uuid
+        self.configfile = os.path.abspath(configfile)
+
+    def __enter__(self):
+        import nipype.pipeline.engine as pe
+        conn = connect(self.db)
+        cursor = conn.execute('INSERT INTO runs (uuid, config, started) '
+                              'VALUES (?,?,?)',
+                              (self.uuid, self.configfile, time.time()))
+        self.run_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        _active.update(db=self.db, run_id=self.run_id, uuid=self.uuid)
+
+        wf_run = pe.Workflow.run
+
+        def run(wf, *args, **kwargs):
+            execgraph = wf_run(wf, *args, **kwargs)
+            if execgraph is not None:
+                _record_graph(execgraph)
+            return execgraph
+
+        self._saved = (pe.Node.run, pe.Workflow.run)
+        pe.Node.run = _profiled_node_run(pe.Node.run)
+        pe.Workflow.run = run
+        return self
+
+    def __exit__(self, *args):
+        import nipype.pipeline.engine as pe
+        pe.Node.run, pe.Workflow.run = self._saved
+        _active.clear()
+        conn = connect(self.db)
+        conn.execute('UPDATE runs SET finished=? WHERE run_id=?',
+                     (time.time(), self.run_id))
+        conn.commit()
+        conn.close()
+
+
+def critical_path(conn, run_id):
+    """Longest chain of dependent nodes of a run, weighted by wall time
+
+    Returns a list of (node, subject, wall) tuples.
+    """
+    nodes = {}
+    for output_dir, node, subject, wall in conn.execute(
+            'SELECT output_dir, node, subject, wall FROM nodes '
+            'WHERE run_id=?', (run_id,)):
+        nodes[output_dir] = (node, subject, wall or 0.)
+    children = {}
+    indegree = dict([(key, 0) for key in nodes])
+    for source, target in conn.execute(
+            'SELECT source, target FROM edges WHERE run_id=?', (run_id,)):
+        if source in nodes and target in nodes:
+            children.setdefault(source, []).append(target)
+            indegree[target] += 1
+    # longest path in a DAG, processing nodes in topological order
+    best = dict([(key, (val[2], None)) for key, val in nodes.items()])
+    queue = [key for key, val in indegree.items() if not val]
+    while queue:
+        key = queue.pop()
+        for child in children.get(key, []):
+            length = best[key][0] + nodes[child][2]
+            if length > best[child][0]:
+                best[child] = (length, key)
+            indegree[child] -= 1
+            if not indegree[child]:
+                queue.append(child)
+    if not best:
+        return []
+    key = max(best, key=lambda k: best[k][0])
+    path = []
+    while key is not None:
+        path.append(nodes[key])
+        key = best[key][1]
+    return path[::-1]
+
+
+def profile_report(db, top=10, run_id=None):
+    """Print the slowest nodes and the critical path of a profiled run
+
+    Parameters
+    ----------
+
+    db : SQLite database written by profile_run
+    top : number of nodes to show
+    run_id : run to report on (defaults to the latest run)
+    """
+    conn = connect(db)
+    if run_id is None:
+        run_id = conn.execute('SELECT MAX(run_id) FROM runs').fetchone()[0]
+    if run_id is None:
+        print('No runs in %s' % db)
+        return
+    uuid, config, started, finished = conn.execute(
+        'SELECT uuid, config, started, finished FROM runs WHERE run_id=?',
+        (run_id,)).fetchone()
+    print('Run %d: %s (%s)' % (run_id, config, uuid))
+    if finished:
+        print('Elapsed: %.1f s' % (finished - started))
+
+    # MapNodes whose subnodes are listed would count twice
+    mapnode_dirs = _mapnode_dirs(conn, run_id)
+    rows = [row[1:] for row in conn.execute(
+        'SELECT output_dir, node, name, subject, wall, cpu_user, cpu_sys, '
+        'peak_rss, cached FROM nodes WHERE run_id=? ORDER BY wall DESC',
+        (run_id,)) if row[0] not in mapnode_dirs]
+
+    print('\nSlowest nodes')
+    print('%-50s %-15s %9s %9s %9s %7s' % ('node', 'subject', 'wall (s)',
+                                           'cpu (s)', 'rss (MB)', 'cached'))
+    for node, _, subject, wall, user, system, rss, cached in rows[:top]:
+        cpu = '%9.1f' % (user + system) if user is not None else '%9s' % '-'
+        rss = '%9.0f' % rss if rss is not None else '%9s' % '-'
+        print('%-50s %-15s %9.1f %s %s %7s' % (node, subject, wall or 0., cpu,
+                                               rss, bool(cached)))
+
+    print('\nTotal time per node name')
+    totals = {}
+    for _, name, _, wall, _, _, _, cached in rows:
+        count, total, hits = totals.get(name, (0, 0., 0))
+        totals[name] = (count + 1, total + (wall or 0.), hits + (cached or 0))
+    for name, (count, total, hits) in sorted(
+            totals.items(), key=lambda item: -item[1][1])[:top]:
+        print('%-35s %5d runs %10.1f s %5d cached' % (name, count, total,
+                                                      hits))
+
+    print('\nCritical path')
+    total = 0.
+    for node, subject, wall in critical_path(conn, run_id):
+        total += wall
+        print('%-50s %-15s %9.1f' % (node, subject, wall))
+    print('%-66s %9.1f' % ('total', total))
+    conn.close()
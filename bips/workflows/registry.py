@@ -0,0 +1,308 @@
+"""Workflow registry
+
+The registry maps workflow uuids to their MetaWorkflow objects. Importing a
+workflow module pulls in traits, nipype and whatever else the workflow needs,
+so the registry can also be populated from a manifest: a json file that
+records the uuid, tags, help and defining module of every workflow. Entries
+loaded from the manifest only import their module when the MetaWorkflow
+object itself is requested, which keeps listing, info and uuid lookup free of
+nipype imports.
+
+The manifest is rebuilt with ``bips --build-manifest`` and is ignored whenever
+one of the workflow modules has changed since it was written.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+from .search import WorkflowIndex
+
+_workflow = {}
+_index = {}
+# bumped whenever workflows are added or replaced, so that caches built from
+# the registry know when to rebuild
+_version = [0]
+
+# workflow modules, relative to bips.workflows
+WORKFLOW_MODULES = [
+    'gablab.wips.dicom.dicom_conversion',
+    'gablab.wips.fmri.first_level.first_level_QA',
+    'gablab.wips.fmri.first_level.first_level',
+    'gablab.wips.fmri.first_level.fixed_effects',
+    'gablab.wips.fmri.first_level.first_level_ev',
+    'gablab.wips.fmri.first_level.spm_first_level',
+    'gablab.wips.fmri.first_level.stim_mot',
+    'gablab.wips.fmri.group_analysis.fsl_one_sample_t_test',
+    'gablab.wips.fmri.group_analysis.fsl_multiple_regression',
+    'gablab.wips.fmri.group_analysis.one_sample_t_surface',
+    'gablab.wips.fmri.group_analysis.spm_group_analysis',
+    'gablab.wips.fmri.misc.compare_realignment_nodes',
+    'gablab.wips.fmri.misc.seg_stats_individual',
+    'gablab.wips.fmri.misc.better_surface_localizer',
+    'gablab.wips.fmri.misc.group_segstats',
+    'gablab.wips.fmri.misc.flirt_reg',
+    'gablab.wips.fmri.preprocessing.fmri_preprocessing',
+    'gablab.wips.fmri.preprocessing.fmri_QA',
+    'gablab.wips.fmri.preprocessing.spm_preprocessing',
+    'gablab.wips.fmri.preprocessing.preproc_QA_json',
+    'gablab.wips.fmri.preprocessing.FIR_filter',
+    'gablab.wips.fmri.preprocessing.preproc_no_freesurfer',
+    'gablab.wips.fmri.preprocessing.group_preproc_QA',
+    'gablab.wips.fmri.preprocessing.fmri_extras',
+    'gablab.wips.fmri.preprocessing.simple_resting',
+    'gablab.wips.fmri.resting.wip_resting_correlation_QA',
+    'gablab.wips.fmri.resting.map_correlations',
+    'gablab.wips.fmri.resting.seed_based_connectivity',
+    'gablab.wips.fmri.resting.seed_based_connectivity2',
+    'gablab.wips.fmri.viz.synced_corr_display_h5',
+    'gablab.wips.smri.test_freesurfer',
+    'gablab.wips.smri.normalize_structural',
+    'gablab.wips.smri.normalize_functionals',
+    'gablab.wips.smri.kelly_kapowski',
+    'gablab.wips.smri.freesurfer_brain_masks',
+    'gablab.wips.smri.wip_divide_parcellations',
+    'gablab.wips.utils.take_mean_image',
+    'gablab.wips.utils.plot_contours',
+    'gablab.wips.utils.change_datatype',
+    ]
+
+# MetaWorkflow traits stored in the manifest
+MANIFEST_FIELDS = ['uuid', 'help', 'tags', 'uses_outputs_of',
+                   'required_software', 'url', 'supercedes', 'script_dir']
+
+WORKFLOW_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_FILE = os.environ.get('BIPS_MANIFEST',
+                               os.path.join(WORKFLOW_DIR,
+                                            'workflow_manifest.json'))
+
+
+def _full_name(module):
+    return 'bips.workflows.' + module
+
+
+def _module_source(module):
+    """Return the source file of a workflow module without importing it
+    """
+    path = os.path.join(WORKFLOW_DIR, *module.split('.'))
+    for ext in ['.py', '.pyc']:
+        if os.path.exists(path + ext):
+            return path + ext
+    return None
+
+
+def _module_hash(module):
+    filename = _module_source(module)
+    if filename is None:
+        return None
+    with open(filename, 'rb') as fp:
+        return hashlib.md5(fp.read()).hexdigest()
+
+
+def _defining_module(wf):
+    for attr in ['workflow_main_function', 'config_ui', 'workflow_function']:
+        func = getattr(wf, attr, None)
+        if getattr(func, '__module__', None):
+            return func.__module__
+    return None
+
+
+def _help_title(help):
+    """First non-empty line of a MetaWorkflow help string
+    """
+    lines = [line.strip() for line in help.split('\n') if line.strip()]
+    if lines:
+        return lines[0]
+    return ''
+
+
+def register_workflow(wf):
+    entry = _workflow.setdefault(wf.uuid, {})
+    if entry.get('object') is not None or 'record' not in entry:
+        # a new or replaced workflow, not one loaded from the manifest
+        entry.pop('record', None)
+        _version[0] += 1
+    entry['object'] = wf
+    entry['module'] = _defining_module(wf)
+    _index.clear()
+
+
+def import_workflow_modules():
+    """Import every workflow module, registering all MetaWorkflows
+    """
+    for module in WORKFLOW_MODULES:
+        __import__(_full_name(module))
+
+
+def _load_object(uuid):
+    entry = _workflow[uuid]
+    if entry.get('object') is None:
+        __import__(entry['module'])
+    if entry.get('object') is None:
+        raise ValueError('Module %s did not register workflow %s. Rebuild the '
+                         'manifest with bips --build-manifest'
+                         % (entry['module'], uuid))
+    return entry['object']
+
+
+def workflow_record(uuid):
+    """Return the manifest record of a workflow
+
+    Unlike get_workflow this never imports the workflow module when the
+    registry was loaded from a manifest.
+    """
+    entry = _workflow[uuid]
+    if 'record' in entry:
+        return entry['record']
+    wf = entry['object']
+    record = dict([(field, getattr(wf, field)) for field in MANIFEST_FIELDS])
+    record['supercedes'] = [str(val) for val in wf.supercedes]
+    record['module'] = entry['module']
+    record['desc'] = _help_title(wf.help)
+    entry['record'] = record
+    return record
+
+
+def read_manifest(filename=MANIFEST_FILE):
+    """Read a manifest, returning None if it is missing or out of date
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename) as fp:
+            manifest = json.load(fp)
+    except ValueError:
+        return None
+    if sorted(manifest.get('modules', {})) != sorted(WORKFLOW_MODULES):
+        return None
+    for module, md5 in manifest['modules'].items():
+        if _module_hash(module) != md5:
+            return None
+    return manifest
+
+
+def write_manifest(filename=MANIFEST_FILE):
+    """Import all workflow modules and write the registry manifest
+
+    The file is written to a temporary file first and renamed, so that
+    concurrent bips processes never read a partial manifest.
+    """
+    import_workflow_modules()
+    manifest = {'modules': dict([(module, _module_hash(module))
+                                 for module in WORKFLOW_MODULES]),
+                'workflows': [workflow_record(uuid)
+                              for uuid in sorted(_workflow)]}
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                   suffix='.json')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.rename(tmpname, filename)
+    return filename
+
+
+def load_workflows(filename=MANIFEST_FILE):
+    """Populate the registry
+
+    Uses the manifest if it is up to date; otherwise imports every workflow
+    module and tries to save a fresh manifest for the next call.
+    """
+    manifest = read_manifest(filename)
+    if manifest is not None:
+        for record in manifest['workflows']:
+            record = dict([(str(key), val) for key, val in record.items()])
+            entry = _workflow.setdefault(str(record['uuid']), {})
+            entry.setdefault('object', None)
+            entry['module'] = str(record['module'])
+            entry['record'] = record
+        _index.clear()
+        _version[0] += 1
+        return
+    import_workflow_modules()
+    try:
+        write_manifest(filename)
+    except (IOError, OSError):
+        pass
+
+
+def registry_version():
+    """Number that changes whenever the workflows in the registry change
+    """
+    return _version[0]
+
+
+def get_index():
+    """Return the search index of the registry, building it if needed
+    """
+    if 'index' not in _index:
+        _index['index'] = WorkflowIndex([workflow_record(uuid)
+                                         for uuid in _workflow])
+    return _index['index']
+
+
+def query_workflows(query_str, mode='and'):
+    """Search the registry by uuid prefix, tags and help text
+
+    See search.WorkflowIndex.query; returns a ranked list of (uuid, score).
+    """
+    return get_index().query(query_str, mode)
+
+
+def _find_uuid(uuid):
+    if uuid in _workflow:
+        return uuid
+    wf_found = get_index().lookup(uuid)
+    if not len(wf_found):
+        raise ValueError('No workflow with uuid %s found' % uuid)
+    if len(wf_found) > 1:
+        raise Exception('Multiple workflows found with partial uuid %s' % uuid)
+    return wf_found[0]
+
+
+def get_workflow(uuid):
+    return _load_object(_find_uuid(uuid))
+
+
+def get_workflows():
+    for uuid in _workflow:
+        _load_object(uuid)
+    return sorted(_workflow.items())
+
+
+def list_workflows(query_str=None, mode='and'):
+    if query_str is None:
+        uuids = sorted(_workflow)
+    else:
+        uuids = [uuid for uuid, _ in query_workflows(query_str, mode)]
+    for uuid in uuids:
+        print('%s %s' % (uuid, workflow_record(uuid)['desc']))
+
+
+def display_workflow_info(uuid):
+    import pprint
+    pprint.pprint(workflow_record(_find_uuid(uuid)))
+
+
+def configure_workflow(uuid):
+    from .base import create_bips_config
+    create_bips_config(get_workflow(uuid))
+
+
+def run_workflow(configfile):
+    with open(configfile) as fp:
+        config = json.load(fp)
+    uuid = str(config['uuid'])
+    wf = get_workflow(uuid)
+    if config.get('n_shards', 1) > 1:
+        from .shard import run_sharded
+        run_sharded(configfile)
+        return
+    from ..utils.function_cache import function_cache
+    with function_cache(config.get('function_cache_dir')):
+        if not config.get('profiling'):
+            wf.workflow_main_function(configfile)
+            return
+        from .profiling import profile_run
+        db = config.get('profile_db') or \
+            os.path.join(config['working_dir'], 'bips_profile.db')
+        with profile_run(db, uuid, configfile):
+            wf.workflow_main_function(configfile)
@@ -0,0 +1,162 @@
+"""In-memory search index over the workflow registry
+
+The index is built from the manifest records of the registry (see
+registry.workflow_record), so building and querying it never imports a
+workflow module.
+"""
+import re
+
+_word = re.compile(r'[a-z0-9]+')
+
+# score of a query term matching the various fields of a workflow
+UUID_SCORE = 8
+TAG_SCORE = 4
+TAG_PREFIX_SCORE = 2
+HELP_SCORE = 1
+
+
+def _words(text):
+    return _word.findall(text.lower())
+
+
+class UuidTrie(object):
+    """Prefix tree over workflow uuids
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, uuid):
+        node = self._root
+        for char in uuid:
+            node = node.setdefault(char, {})
+        node[None] = uuid
+
+    def search(self, prefix):
+        """Return all uuids starting with prefix
+        """
+        node = self._root
+        for char in prefix:
+            if char not in node:
+                return []
+            node = node[char]
+        found = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for key, val in node.items():
+                if key is None:
+                    found.append(val)
+                else:
+                    stack.append(val)
+        return sorted(found)
+
+
+class WorkflowIndex(object):
+    """Search index over uuids, tags, help text and uses_outputs_of edges
+
+    Parameters
+    ----------
+
+    records : list of workflow records (dicts with at least uuid, tags,
+              help, desc and uses_outputs_of)
+    """
+
+    def __init__(self, records):
+        self.trie = UuidTrie()
+        self.records = {}
+        self.tag_map = {}
+        self.word_map = {}
+        self.used_by = {}
+        for record in records:
+            uuid = record['uuid']
+            self.records[uuid] = record
+            self.trie.insert(uuid)
+            for tag in record['tags']:
+                self.tag_map.setdefault(tag.lower(), set()).add(uuid)
+            for word in _words(record['help']):
+                self.word_map.setdefault(word, set()).add(uuid)
+            for parent in record['uses_outputs_of']:
+                self.used_by.setdefault(parent, set()).add(uuid)
+        self.tags = sorted(self.tag_map)
+
+    def lookup(self, prefix):
+        """Return all uuids starting with prefix
+        """
+        return self.trie.search(prefix)
+
+    def uses_outputs_of(self, uuid):
+        """Workflows whose outputs the workflow uuid uses
+        """
+        return sorted(self.records[uuid]['uses_outputs_of'])
+
+    def used_by_workflows(self, uuid):
+        """Workflows that use the outputs of the workflow uuid
+        """
+        return sorted(self.used_by.get(uuid, []))
+
+    def match_tags(self, prefix):
+        """Return all tags containing the string prefix
+        """
+        prefix = prefix.lower()
+        return [tag for tag in self.tags if prefix in tag]
+
+    def _score_term(self, term):
+        """Return {uuid: score} for a single query term
+
+        ``uses:<uuid>`` matches the workflows that use the outputs of
+        <uuid> (which may be a partial uuid).
+        """
+        scores = {}
+
+        def add(uuids, score):
+            for uuid in uuids:
+                scores[uuid] = scores.get(uuid, 0) + score
+
+        if term.startswith('uses:'):
+            for parent in self.lookup(term[len('uses:'):]):
+                add(self.used_by_workflows(parent), TAG_SCORE)
+            return scores
+        add(self.lookup(term), UUID_SCORE)
+        add(self.tag_map.get(term, []), TAG_SCORE)
+        for tag in self.tags:
+            if tag != term and tag.startswith(term):
+                add(self.tag_map[tag], TAG_PREFIX_SCORE)
+        for word in _words(term):
+            add(self.word_map.get(word, []), HELP_SCORE)
+        return scores
+
+    def query(self, query_str, mode='and'):
+        """Search the index
+
+        Parameters
+        ----------
+
+        query_str : whitespace separated terms; each is matched against
+                    uuid prefixes, tags, tag prefixes and help text
+        mode : 'and' to return workflows matching every term, 'or' for
+               workflows matching any term
+
+        Returns
+        -------
+
+        list of (uuid, score) tuples, best match first
+        """
+        if mode not in ['and', 'or']:
+            raise ValueError('Unknown query mode %s' % mode)
+        terms = query_str.lower().split()
+        if not terms:
+            return [(uuid, 0) for uuid in sorted(self.records)]
+        total = None
+        for term in terms:
+            scores = self._score_term(term)
+            if total is None:
+                total = scores
+            elif mode == 'and':
+                total = dict([(uuid, total[uuid] + score)
+                              for uuid, score in scores.items()
+                              if uuid in total])
+            else:
+                for uuid, score in scores.items():
+                    total[uuid] = total.get(uuid, 0) + score
+        return sorted(total.items(), key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,239 @@
+"""Split the subjects of a config into shards that run as separate jobs
+
+A config with ``n_shards`` > 1 is split into that many configs, each running
+a subset of the subjects, so that every shard builds and schedules a small
+graph in its own head process and a failing head only affects its shard.
+Shard i runs in <working_dir>/shard<i> of the original config: shards run
+at the same time, and nodes that are not iterated over subjects would
+otherwise be run by several shards in the same directory at once. Nodes
+that ran in a shard are cache hits when the same shard runs again, so the
+shard of every value is recorded next to the shard configs and kept when
+the config is sharded again into the same number of shards; only new
+values are balanced.
+
+The sharded values are the ``subjects`` list of the config or, for configs
+without one, the first iterable field of its datagrabbers. With
+``shard_by='size'`` each subject is weighted by the header size of the
+images its datagrabbers find, so that shards have about the same amount of
+data; otherwise all subjects weigh the same.
+"""
+import json
+import os
+import subprocess
+import sys
+
+SUBMIT_COMMANDS = {'PBS': 'qsub', 'PBSGraph': 'qsub', 'SGE': 'qsub',
+                   'Condor': 'condor_qsub', 'CondorDAGMan': 'condor_qsub'}
+
+
+def balance(values, n_shards, weights=None, assigned=None):
+    """Split values into n_shards lists with about equal total weight
+
+    Values in assigned ({value: shard}) stay in their shard, so that adding
+    values moves none of the others out of the working directory of their
+    shard. The other values are assigned heaviest first to the lightest
+    shard; each shard keeps the original order of its values. Shards may
+    be empty.
+    """
+    if weights is None:
+        weights = [1.] * len(values)
+    assigned = assigned or {}
+    loads = [0.] * n_shards
+    members = [[] for _ in range(n_shards)]
+    new = []
+    for i, value in enumerate(values):
+        shard = assigned.get(value)
+        if shard is None or not 0 <= shard < n_shards:
+            new.append(i)
+            continue
+        loads[shard] += weights[i]
+        members[shard].append(i)
+    for i in sorted(new, key=lambda i: -weights[i]):
+        shard = loads.index(min(loads))
+        loads[shard] += weights[i]
+        members[shard].append(i)
+    return [[values[i] for i in sorted(shard)] for shard in members]
+
+
+def _read_assignment(filename, n_shards):
+    """{value: shard} of the shards last written for the same number of
+    shards, empty if there are none
+    """
+    try:
+        with open(filename) as fp:
+            assignment = json.load(fp)
+    except (IOError, ValueError):
+        return {}
+    if assignment.get('n_shards') != n_shards:
+        return {}
+    return dict([(value, shard)
+                 for value, shard in assignment.get('shards', [])])
+
+
+def shard_field(config):
+    """Name and values of the field to shard a config dict on
+
+    Returns (None, name, values) for the subjects list of the config and
+    (datagrabber, name, values) for an iterable datagrabber field.
+    """
+    if config.get('subjects'):
+        return None, 'subjects', list(config['subjects'])
+    for key, item in sorted(config.items()):
+        if isinstance(item, dict) and isinstance(item.get('fields'), list):
+            for field in item['fields']:
+                values = [val for val in field.get('values') or []
+                          if val != '']
+                if field.get('iterable') and values:
+                    return key, field['name'], values
+    return None, None, []
+
+
+def _grabber_sizes(configfile, iterable, values):
+    """Bytes of input images per value of an iterable, from image headers
+    """
+    from copy import deepcopy
+    from nipype.pipeline.utils import generate_expanded_graph
+    from .estimate import build_workflow, grabber_types, _grab
+    sizes = dict([(value, 0.) for value in values])
+    prefixes = ['_%s_' % name for name in [iterable, 'subject_id']]
+    grabber_interfaces = grabber_types()
+    for wf in build_workflow(configfile):
+        graph = generate_expanded_graph(deepcopy(wf._create_flat_graph()))
+        for node in graph.nodes():
+            if not isinstance(node._interface, grabber_interfaces):
+                continue
+            value = None
+            for param in getattr(node, 'parameterization', None) or []:
+                for prefix in prefixes:
+                    if param.startswith(prefix) and \
+                            param[len(prefix):] in sizes:
+                        value = param[len(prefix):]
+            if value is None:
+                continue
+            for images in _grab(graph, node)['files'].values():
+                sizes[value] += sum([img['nbytes'] for img in images if img])
+    return sizes
+
+
+def _restrict(config, grabber, name, shard_values, shard=0):
+    """Copy of a config dict running only shard_values in the working
+    directory of shard
+    """
+    from copy import deepcopy
+    config = deepcopy(config)
+    keep = set(shard_values)
+    if grabber is None and name == 'subjects':
+        config['subjects'] = list(shard_values)
+    # restrict every datagrabber iterating over the same values
+    for item in config.values():
+        if isinstance(item, dict) and isinstance(item.get('fields'), list):
+            for field in item['fields']:
+                if field.get('iterable') and keep.intersection(
+                        field.get('values') or []):
+                    field['values'] = [value for value in field['values']
+                                       if value in keep]
+    if config.get('working_dir'):
+        config['working_dir'] = os.path.join(config['working_dir'],
+                                             'shard%03d' % shard)
+    config['n_shards'] = 1
+    return config
+
+
+def write_shards(configfile, n_shards=None, shard_by=None, out_dir=None):
+    """Write one config per shard and return their file names
+
+    n_shards and shard_by default to the values in the config. The shards
+    are written to <config>_shards/ next to the config unless out_dir is
+    given.
+    """
+    from .base import load_json
+    configfile = os.path.abspath(configfile)
+    config = load_json(configfile)
+    n_shards = n_shards or config.get('n_shards') or 1
+    shard_by = shard_by or config.get('shard_by') or 'count'
+    grabber, name, values = shard_field(config)
+    if not values:
+        raise ValueError('%s has no subjects or iterable datagrabber field '
+                         'to shard' % configfile)
+    weights = None
+    if shard_by == 'size':
+        sizes = _grabber_sizes(configfile, name, values)
+        if not any(sizes.values()):
+            print('No image sizes found, sharding %s by count' % configfile)
+        else:
+            # subjects without images still cost their graph overhead
+            floor = max(sizes.values()) * 0.01
+            weights = [max(sizes[value], floor) for value in values]
+
+    if out_dir is None:
+        out_dir = os.path.splitext(configfile)[0] + '_shards'
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    base = os.path.splitext(os.path.basename(configfile))[0]
+    assignment_file = os.path.join(out_dir, '%s_assignment.json' % base)
+    shards = balance(values, n_shards, weights,
+                     _read_assignment(assignment_file, n_shards))
+    with open(assignment_file, 'w') as fp:
+        json.dump({'n_shards': n_shards,
+                   'shards': [[value, i] for i, shard_values
+                              in enumerate(shards)
+                              for value in shard_values]}, fp, indent=4)
+    filenames = []
+    for i, shard_values in enumerate(shards):
+        filename = os.path.join(out_dir, '%s_shard%03d.json' % (base, i))
+        if not shard_values:
+            # the values of an earlier run of this shard are gone
+            if os.path.exists(filename):
+                os.remove(filename)
+            continue
+        with open(filename, 'w') as fp:
+            json.dump(_restrict(config, grabber, name, shard_values, i), fp,
+                      indent=4)
+        filenames.append(filename)
+        print('%s: %d values of %s' % (filename, len(shard_values), name))
+    return filenames
+
+
+def launch_shards(filenames):
+    """Start the head process of every shard
+
+    Shards of configs that run through a cluster plugin are submitted as
+    jobs with that plugin's submit command (and its qsub_args); all others
+    are started as local background processes. Each head process then runs
+    its nodes with the plugin of its config.
+    """
+    from .base import load_json
+    bips = [sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                         'bips')]
+    if not os.path.exists(bips[1]):
+        bips = ['bips']
+    processes = []
+    for filename in filenames:
+        config = load_json(filename)
+        log = os.path.splitext(filename)[0] + '.log'
+        command = bips + ['-r', filename]
+        submit = SUBMIT_COMMANDS.get(config.get('plugin'))
+        if config.get('run_using_plugin') and submit:
+            script = os.path.splitext(filename)[0] + '.sh'
+            with open(script, 'w') as fp:
+                fp.write('#!/bin/sh\n%s > %s 2>&1\n' % (' '.join(command),
+                                                          log))
+            qsub_args = (config.get('plugin_args') or {}).get('qsub_args', '')
+            subprocess.check_call('%s %s %s' % (submit, qsub_args, script),
+                                  shell=True)
+        else:
+            with open(log, 'w') as fp:
+                processes.append(subprocess.Popen(command, stdout=fp,
+                                                  stderr=subprocess.STDOUT))
+        print('Launched %s (log: %s)' % (filename, log))
+    return processes
+
+
+def run_sharded(configfile, launch=True):
+    """Write the shards of a config and optionally launch them
+    """
+    filenames = write_shards(configfile)
+    if launch:
+        launch_shards(filenames)
+    return filenames
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+
+import networkx as nx
+from numpy.testing import assert_equal
+
+from bips.workflows.batch import _merge, expand_config_files
+
+
+def _graph(*edges):
+    graph = nx.DiGraph()
+    for source, target in edges:
+        graph.add_edge(source, target)
+    return graph
+
+
+def test_workflows_of_a_config_run_in_order():
+    info = _graph(('info_grab', 'info'))
+    convert = _graph(('grab', 'convert'), ('grab', 'qa'))
+    other = _graph(('other_grab', 'other'))
+    graph = _merge([[info, convert], [other]])
+    assert_equal(sorted(graph.edges()),
+                 [('grab', 'convert'), ('grab', 'qa'), ('info', 'grab'),
+                  ('info_grab', 'info'), ('other_grab', 'other')])
+    # the other config does not wait
+    assert_equal(graph.in_degree('other_grab'), 0)
+
+
+def test_empty_graphs_are_skipped():
+    first = _graph(('a', 'b'))
+    last = _graph(('c', 'd'))
+    graph = _merge([[first, nx.DiGraph(), last]])
+    assert_equal(graph.has_edge('b', 'c'), True)
+    assert_equal(_merge([[nx.DiGraph()], []]).number_of_nodes(), 0)
+
+
+def test_expand_config_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ['b.json', 'a.json', 'c.txt']:
+            open(os.path.join(tmpdir, name), 'w').close()
+        single = os.path.join(tmpdir, 'c.txt')
+        assert_equal(expand_config_files([tmpdir, single]),
+                     [os.path.join(tmpdir, 'a.json'),
+                      os.path.join(tmpdir, 'b.json'), single])
+        assert_equal(expand_config_files([os.path.join(tmpdir, 'b*')]),
+                     [os.path.join(tmpdir, 'b.json')])
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,39 @@
+from numpy.testing import assert_equal, assert_raises
+
+from bips.workflows.search import WorkflowIndex
+
+
+def _index():
+    records = [{'uuid': 'aaa111', 'tags': ['fMRI', 'preprocessing'],
+                'help': 'Motion correction and smoothing',
+                'desc': '', 'uses_outputs_of': []},
+               {'uuid': 'aab222', 'tags': ['fMRI', 'first_level'],
+                'help': 'First level model', 'desc': '',
+                'uses_outputs_of': ['aaa111']},
+               {'uuid': 'bbb333', 'tags': ['dMRI'],
+                'help': 'Diffusion preprocessing', 'desc': '',
+                'uses_outputs_of': []}]
+    return WorkflowIndex(records)
+
+
+def test_lookup_and_edges():
+    index = _index()
+    assert_equal(index.lookup('aa'), ['aaa111', 'aab222'])
+    assert_equal(index.lookup('c'), [])
+    assert_equal(index.used_by_workflows('aaa111'), ['aab222'])
+    assert_equal(index.uses_outputs_of('aab222'), ['aaa111'])
+    assert_equal(index.match_tags('mri'), ['dmri', 'fmri'])
+
+
+def test_query():
+    index = _index()
+    assert_equal([uuid for uuid, _ in index.query('fmri')],
+                 ['aaa111', 'aab222'])
+    assert_equal([uuid for uuid, _ in index.query('fmri preprocessing')],
+                 ['aaa111'])
+    assert_equal([uuid for uuid, _ in
+                  index.query('fmri preprocessing', mode='or')],
+                 ['aaa111', 'aab222', 'bbb333'])
+    assert_equal([uuid for uuid, _ in index.query('uses:aaa')], ['aab222'])
+    assert_equal(len(index.query('')), 3)
+    assert_raises(ValueError, index.query, 'fmri', 'xor')
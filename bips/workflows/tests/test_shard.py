@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_equal
+
+from bips.workflows.shard import _restrict, balance, write_shards
+
+
+def test_balance():
+    assert_equal(balance(['a', 'b', 'c', 'd', 'e'], 2),
+                 [['a', 'c', 'e'], ['b', 'd']])
+    assert_equal(balance(['a', 'b', 'c', 'd'], 2, [3., 1., 1., 1.]),
+                 [['a'], ['b', 'c', 'd']])
+    assert_equal(balance(['a'], 3), [['a'], [], []])
+
+
+def test_balance_keeps_assigned_values():
+    shards = balance(['a', 'b', 'c', 'd'], 2)
+    assigned = dict([(value, i) for i, shard in enumerate(shards)
+                     for value in shard])
+    new_shards = balance(['a', 'aa', 'b', 'c', 'd'], 2, assigned=assigned)
+    for i, shard in enumerate(shards):
+        assert_equal([value for value in new_shards[i] if value != 'aa'],
+                     shard)
+    # out of range shards are assigned again
+    assert_equal(balance(['a', 'b'], 2, assigned={'a': 5, 'b': 0}),
+                 [['b'], ['a']])
+
+
+def _config():
+    return {'subjects': ['s1', 's2', 's3'], 'working_dir': '/work',
+            'n_shards': 2,
+            'datagrabber': {'fields': [{'name': 'subject_id',
+                                        'iterable': True,
+                                        'values': ['s1', 's2', 's3']},
+                                       {'name': 'run', 'iterable': False,
+                                        'values': ['1']}]}}
+
+
+def test_restrict():
+    config = _restrict(_config(), None, 'subjects', ['s2'], 1)
+    assert_equal(config['subjects'], ['s2'])
+    assert_equal(config['datagrabber']['fields'][0]['values'], ['s2'])
+    assert_equal(config['datagrabber']['fields'][1]['values'], ['1'])
+    assert_equal(config['working_dir'], os.path.join('/work', 'shard001'))
+    assert_equal(config['n_shards'], 1)
+
+
+def _subjects(filenames):
+    subjects = {}
+    for filename in filenames:
+        with open(filename) as fp:
+            subjects[os.path.basename(filename)] = json.load(fp)['subjects']
+    return subjects
+
+
+def test_resharding_keeps_subjects_in_their_shard():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        configfile = os.path.join(tmpdir, 'config.json')
+        config = _config()
+        with open(configfile, 'w') as fp:
+            json.dump(config, fp)
+        before = _subjects(write_shards(configfile))
+        config['subjects'].insert(0, 's0')
+        with open(configfile, 'w') as fp:
+            json.dump(config, fp)
+        after = _subjects(write_shards(configfile))
+        for name, subjects in before.items():
+            assert_equal([subject for subject in after[name]
+                          if subject != 's0'], subjects)
+        assert_equal(sorted(sum(after.values(), [])),
+                     ['s0', 's1', 's2', 's3'])
+    finally:
+        shutil.rmtree(tmpdir)
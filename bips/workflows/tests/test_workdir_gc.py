@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import time
+
+from numpy.testing import assert_equal
+
+from bips.workflows.workdir_gc import collect, index_sink, match_sink, \
+    scan_dir
+
+
+class _Outputs(dict):
+    """Stands in for the outputs of a node result
+    """
+
+    def get(self):
+        return dict(self)
+
+
+class _Result(object):
+
+    def __init__(self, outputs):
+        self.outputs = _Outputs(outputs)
+
+
+def _write(path, text, mtime=None):
+    with open(path, 'w') as fp:
+        fp.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def _node(node_dir, name, outputs):
+    from nipype.utils.filemanip import savepkl
+    os.makedirs(node_dir)
+    savepkl(os.path.join(node_dir, 'result_%s.pklz' % name),
+            _Result(outputs))
+
+
+def _working_dir():
+    """A subject with an output that was sunk, an intermediate one and a
+    scratch file
+    """
+    tmpdir = tempfile.mkdtemp()
+    unit = os.path.join(tmpdir, 'work', 'wf', '_subject_id_s1')
+    sink = os.path.join(tmpdir, 'sink', 's1')
+    os.makedirs(sink)
+    mtime = time.time() - 100
+    out = os.path.join(unit, 'smooth', 'out.nii')
+    mid = os.path.join(unit, 'realign', 'mid.nii')
+    _node(os.path.dirname(out), 'smooth', {'out_file': out})
+    _node(os.path.dirname(mid), 'realign', {'out_file': mid})
+    _write(out, 'smoothed', mtime)
+    _write(mid, 'realigned', mtime)
+    _write(os.path.join(unit, 'smooth', 'scratch.txt'), 'scratch')
+    _write(os.path.join(sink, 'out.nii'), 'smoothed')
+    return tmpdir, out, mid, mtime
+
+
+def test_report_changes_nothing():
+    tmpdir, out, mid, _ = _working_dir()
+    try:
+        stats, freed = collect(os.path.join(tmpdir, 'work'),
+                               os.path.join(tmpdir, 'sink'), n_procs=1)
+        assert_equal(freed, 0)
+        assert_equal(stats['smooth']['sunk'] > 0, True)
+        assert_equal(stats['smooth']['disposable'] > 0, True)
+        assert_equal(stats['smooth']['intermediate'], 0)
+        assert_equal(stats['realign']['intermediate'] > 0, True)
+        assert_equal(stats['realign']['sunk'], 0)
+        assert_equal(os.path.islink(out), False)
+        assert_equal(os.path.exists(os.path.join(os.path.dirname(out),
+                                                 'scratch.txt')), True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prune_links_sunk_files():
+    tmpdir, out, mid, mtime = _working_dir()
+    try:
+        copy = os.path.join(tmpdir, 'sink', 's1', 'out.nii')
+        _, freed = collect(os.path.join(tmpdir, 'work'),
+                           os.path.join(tmpdir, 'sink'), prune=True,
+                           n_procs=1)
+        assert_equal(freed > 0, True)
+        assert_equal(os.path.realpath(out), os.path.realpath(copy))
+        # downstream nodes see the mtime of the original
+        assert_equal(os.path.getmtime(out), mtime)
+        assert_equal(os.path.exists(os.path.join(os.path.dirname(out),
+                                                 'scratch.txt')), False)
+        assert_equal(os.path.exists(mid), True)
+        assert_equal(os.path.exists(os.path.join(os.path.dirname(mid),
+                                                 'result_realign.pklz')),
+                     True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prune_intermediates():
+    tmpdir, out, mid, _ = _working_dir()
+    try:
+        collect(os.path.join(tmpdir, 'work'), os.path.join(tmpdir, 'sink'),
+                prune=True, intermediates=True, n_procs=1)
+        assert_equal(os.path.exists(mid), False)
+        # so that nipype runs the node again
+        assert_equal(os.path.exists(os.path.join(os.path.dirname(mid),
+                                                 'result_realign.pklz')),
+                     False)
+        assert_equal(os.path.exists(os.path.join(os.path.dirname(out),
+                                                 'result_smooth.pklz')),
+                     True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_sink_copies():
+    tmpdir, out, mid, mtime = _working_dir()
+    try:
+        sink = os.path.join(tmpdir, 'sink', 's1')
+        # a renamed copy, an older file and a different file of the same
+        # size are not copies
+        _write(os.path.join(sink, 'renamed.nii'), 'realigned')
+        older = os.path.join(tmpdir, 'sink', 'older')
+        os.mkdir(older)
+        _write(os.path.join(older, 'mid.nii'), 'realigned', mtime - 10)
+        _write(os.path.join(sink, 'mid.nii'), 'realignex')
+        nodes, _ = scan_dir((os.path.dirname(os.path.dirname(out)), False))
+        outputs = [output for _, _, _, node_outputs in nodes
+                   for output in node_outputs]
+        copies = match_sink(outputs, index_sink(os.path.join(tmpdir,
+                                                             'sink')))
+        assert_equal(copies, {out: os.path.join(sink, 'out.nii')})
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,318 @@
+"""Garbage collection of nipype working directories
+
+Every file in the node directories of a workflow's working_dir is put in one
+of four classes:
+
+rerun
+    hash files, result/input pickles and reports. Nipype needs these to
+    decide that a node is a cache hit, so they are always kept.
+sunk
+    outputs whose content was also copied to sink_dir by a DataSink.
+disposable
+    files that no node result refers to (scratch files, copies of inputs).
+    No node reads these, so deleting them never forces a rerun.
+intermediate
+    outputs that downstream nodes read and that were not sunk.
+
+Files that share the stem (the name up to the first dot) of a referenced file
+in the same directory count as referenced too, so companions such as the
+.hdr of an .img or the SPM .mat of a volume are never disposable.
+
+Sink copies are hard links of the working file (DataSink with
+try_hard_link_datasink) or files with the same name, size and content that
+were written after it. Files renamed by DataSink substitutions are not
+recognized and count as intermediate.
+
+Pruning deletes disposable files and replaces sunk files by symbolic links to
+their copy in sink_dir. DataSink copies files with shutil.copyfile, so a copy
+has the time it was made as its mtime; it is given the mtime of the working
+file first, so that with nipype's default timestamp hashing the inputs of
+downstream nodes look unchanged and a rerun with an unchanged config is
+still a cache hit. (A copy of several working files with different mtimes
+is linked from the first only; hard links free nothing and are kept.)
+
+Intermediates are only deleted when ``intermediates`` is set. The hash file
+and result pickle of their node are deleted with them, so nipype reruns the
+node (and the nodes reading its outputs) the next time the workflow runs.
+"""
+from fnmatch import fnmatch
+import hashlib
+import os
+from glob import glob
+
+RERUN_PATTERNS = ['_0x*.json', 'result_*.pklz', '_inputs.pklz', '_node.pklz',
+                  'command.txt']
+# the rerun files whose removal makes nipype run a node again
+RESULT_PATTERNS = ['_0x*.json', 'result_*.pklz']
+CLASSES = ['rerun', 'sunk', 'disposable', 'intermediate']
+
+
+def _md5(filename, blocksize=2 ** 20):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        block = fp.read(blocksize)
+        while block:
+            md5.update(block)
+            block = fp.read(blocksize)
+    return md5.hexdigest()
+
+
+def _flatten(value):
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        files = []
+        for val in value:
+            files.extend(_flatten(val))
+        return files
+    if isinstance(value, basestring) and os.path.exists(value):
+        return [os.path.realpath(value)]
+    return []
+
+
+def _is_node_dir(path):
+    return bool(glob(os.path.join(path, 'result_*.pklz')))
+
+
+def _node_name(node_dir):
+    results = glob(os.path.join(node_dir, 'result_*.pklz'))
+    if results:
+        return os.path.basename(results[0])[len('result_'):-len('.pklz')]
+    return os.path.basename(node_dir)
+
+
+def _referenced_files(node_dir):
+    """Files referenced by the outputs of the node in node_dir
+    """
+    from nipype.utils.filemanip import loadpkl
+    referenced = set()
+    for resultfile in glob(os.path.join(node_dir, 'result_*.pklz')):
+        try:
+            result = loadpkl(resultfile)
+        except Exception:
+            # keep everything of nodes we cannot read
+            return None
+        if result.outputs is None:
+            continue
+        for path in _flatten(result.outputs.get()):
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    referenced.update([os.path.join(root, f) for f in files])
+            else:
+                referenced.add(path)
+    return referenced
+
+
+def _stem(path):
+    return os.path.join(os.path.dirname(path),
+                        os.path.basename(path).split('.')[0])
+
+
+def _node_files(node_dir):
+    """Files of a node directory, excluding those of nested node dirs
+    """
+    for root, dirs, files in os.walk(node_dir):
+        if root != node_dir and _is_node_dir(root):
+            dirs[:] = []
+            continue
+        dirs[:] = [d for d in dirs if d != '_report']
+        for f in files:
+            yield os.path.join(root, f)
+
+
+def index_sink(sink_dir):
+    """Map file size to (path, mtime, (device, inode)) of the files of that
+    size in sink_dir
+    """
+    sizes = {}
+    if not sink_dir or not os.path.isdir(sink_dir):
+        return sizes
+    for root, _, files in os.walk(sink_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            if os.path.isfile(path) and not os.path.islink(path):
+                st = os.stat(path)
+                sizes.setdefault(st.st_size, []).append(
+                    (path, st.st_mtime, (st.st_dev, st.st_ino)))
+    return sizes
+
+
+def _link(src, dst):
+    """Replace dst by a symbolic link to src
+    """
+    tmp = dst + '.bips_gc'
+    os.symlink(src, tmp)
+    os.rename(tmp, dst)
+
+
+def _forget_results(node_dir):
+    """Delete the hash file and result pickle of the node in node_dir,
+    so that nipype runs it again; returns the bytes freed
+    """
+    freed = 0
+    for pattern in RESULT_PATTERNS:
+        for path in glob(os.path.join(node_dir, pattern)):
+            freed += os.path.getsize(path)
+            os.remove(path)
+    return freed
+
+
+def scan_dir(args):
+    """Classify the files of the node directories below a directory,
+    deleting the disposable ones if prune
+
+    Returns the bytes freed and a list of (node dir, node name,
+    {class: bytes}, outputs), where outputs are the referenced files that
+    are either sunk or intermediate, as (path, size, bytes used, mtime,
+    (device, inode), number of links).
+    """
+    unit, prune = args
+    nodes = []
+    freed = 0
+    node_dirs = [root for root, _, _ in os.walk(unit) if _is_node_dir(root)]
+    for node_dir in node_dirs:
+        referenced = _referenced_files(node_dir)
+        if referenced is not None:
+            stems = set([_stem(path) for path in referenced])
+        node_stats = dict([(c, 0) for c in CLASSES])
+        outputs = []
+        for path in _node_files(node_dir):
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            used = st.st_blocks * 512 if hasattr(st, 'st_blocks') \
+                else st.st_size
+            name = os.path.basename(path)
+            if referenced is None or any([fnmatch(name, pattern)
+                                          for pattern in RERUN_PATTERNS]):
+                node_stats['rerun'] += used
+                continue
+            realpath = os.path.realpath(path)
+            if realpath not in referenced and _stem(realpath) not in stems:
+                node_stats['disposable'] += used
+                if prune:
+                    os.remove(path)
+                    freed += used
+                continue
+            outputs.append((path, st.st_size, used, st.st_mtime,
+                            (st.st_dev, st.st_ino), st.st_nlink))
+        nodes.append((node_dir, _node_name(node_dir), node_stats, outputs))
+    return nodes, freed
+
+
+def match_sink(outputs, sink_index, pool=None):
+    """Map the paths of outputs (as from scan_dir) to their copy in the
+    sink index, if any
+
+    A copy is a hard link of the output or a file with the same name, size
+    and content that is not older than the output. Every file is read at
+    most once, by pool if given.
+    """
+    copies = {}
+    candidates = {}
+    for path, size, _, mtime, inode, _ in outputs:
+        same_size = sink_index.get(size, [])
+        linked = [copy for copy, _, copy_inode in same_size
+                  if copy_inode == inode]
+        if linked:
+            copies[path] = linked[0]
+            continue
+        name = os.path.basename(path)
+        same_name = [copy for copy, copy_mtime, _ in same_size
+                     if os.path.basename(copy) == name and
+                     copy_mtime >= mtime]
+        if same_name:
+            candidates[path] = same_name
+    to_hash = sorted(set(list(candidates) +
+                         [copy for same_name in candidates.values()
+                          for copy in same_name]))
+    if pool is not None:
+        md5s = dict(zip(to_hash, pool.map(_md5, to_hash, chunksize=1)))
+    else:
+        md5s = dict([(path, _md5(path)) for path in to_hash])
+    for path, same_name in candidates.items():
+        for copy in same_name:
+            if md5s[copy] == md5s[path]:
+                copies[path] = copy
+                break
+    return copies
+
+
+def collect(working_dir, sink_dir=None, prune=False, intermediates=False,
+            n_procs=None):
+    """Classify and optionally prune a working directory
+
+    The directories below each workflow directory (usually one per subject
+    iterable) are scanned in parallel, and the outputs and sink files that
+    may be copies of each other are hashed in parallel, once each.
+
+    Returns {node name: {class: bytes}} and the bytes freed.
+    """
+    from multiprocessing import Pool
+    sink_index = index_sink(sink_dir)
+    units = []
+    for wf_dir in sorted(glob(os.path.join(working_dir, '*'))):
+        if os.path.isdir(wf_dir):
+            units.extend([d for d in sorted(glob(os.path.join(wf_dir, '*')))
+                          if os.path.isdir(d)])
+    pool = Pool(n_procs)
+    try:
+        results = pool.map(scan_dir, [(unit, prune) for unit in units])
+        nodes = [node for unit_nodes, _ in results for node in unit_nodes]
+        copies = match_sink([output for _, _, _, outputs in nodes
+                             for output in outputs], sink_index, pool)
+    finally:
+        pool.close()
+        pool.join()
+    freed = sum([unit_freed for _, unit_freed in results])
+    # the mtime every linked sink copy was given
+    link_mtimes = {}
+    stats = {}
+    for node_dir, name, node_stats, outputs in nodes:
+        total = stats.setdefault(name, dict([(c, 0) for c in CLASSES]))
+        node_intermediates = []
+        for path, _, used, mtime, _, nlink in outputs:
+            copy = copies.get(path)
+            if copy is None:
+                node_stats['intermediate'] += used
+                node_intermediates.append((path, used))
+                continue
+            node_stats['sunk'] += used
+            # hard links free nothing, and a copy can only carry the
+            # mtime of one output
+            if not prune or nlink > 1 or \
+                    link_mtimes.setdefault(copy, mtime) != mtime:
+                continue
+            os.utime(copy, (os.path.getatime(copy), mtime))
+            _link(copy, path)
+            freed += used
+        if prune and intermediates and node_intermediates:
+            freed += _forget_results(node_dir)
+            for path, used in node_intermediates:
+                os.remove(path)
+                freed += used
+        for c in CLASSES:
+            total[c] += node_stats[c]
+    return stats, freed
+
+
+def gc_workflow(configfile, prune=False, intermediates=False, n_procs=None,
+                top=10):
+    """Report (and prune) the working directory of a config file
+    """
+    from .base import load_json
+    c = load_json(configfile)
+    stats, freed = collect(c['working_dir'], c.get('sink_dir'), prune,
+                           intermediates, n_procs)
+    gb = 1024. ** 3
+    print('%-35s %10s %10s %10s %12s' % ('node (GB)', 'rerun', 'sunk',
+                                          'disposable', 'intermediate'))
+    rows = sorted(stats.items(), key=lambda item: -sum(item[1].values()))
+    for name, node_stats in rows[:top]:
+        print('%-35s %10.2f %10.2f %10.2f %12.2f' % tuple(
+            [name] + [node_stats[c] / gb for c in CLASSES]))
+    totals = [sum([s[c] for s in stats.values()]) / gb for c in CLASSES]
+    print('%-35s %10.2f %10.2f %10.2f %12.2f' % tuple(['total'] + totals))
+    if prune:
+        print('Freed %.2f GB' % (freed / gb))
+    return stats, freed
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Benchmark the latency of the config editor of the web service
+
+Two ``BIPS`` roots are mounted on a local cherrypy server, one building the
+form of the workflow on every request (as ``edit_config`` used to) and one
+using the form cache, and ``/edit_config`` is requested n times from each.
+Reported are the first request (which builds the form either way) and the
+median and mean of the others, in milliseconds.
+
+Example
+-------
+
+  python tools/bench_forms.py -n 50 -u 7757e3168af611e1b9d5001e4fb1404c
+"""
+import argparse
+import json
+import os
+import socket
+import time
+
+DEFAULT_UUID = '7757e3168af611e1b9d5001e4fb1404c'
+
+
+class UncachedForms(object):
+    """Stand-in for the form cache rebuilding the form on every call
+    """
+
+    def render(self, uuid, config=None):
+        from bips.workflows import get_workflow
+        from bips.service.scripts.form_scripts import get_form
+        mwf = get_workflow(uuid)
+        if config is None:
+            config = mwf.config_ui()
+        return get_form(config, mwf)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def timed_requests(url, n):
+    import urllib2
+    times = []
+    for _ in range(n):
+        t0 = time.time()
+        urllib2.urlopen(url).read()
+        times.append(time.time() - t0)
+    return times
+
+
+def summarize(times):
+    rest = sorted(times[1:]) or times
+    return {'first': 1000 * times[0],
+            'median': 1000 * rest[len(rest) // 2],
+            'mean': 1000 * sum(rest) / len(rest),
+            'n': len(times)}
+
+
+def bench(n=20, uuids=None):
+    import cherrypy
+    from bips.service.base import BIPS
+    uuids = uuids or [DEFAULT_UUID]
+    port = free_port()
+    cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                            'server.socket_port': port,
+                            'log.screen': False,
+                            'engine.autoreload.on': False})
+    config = {'/': {'tools.lg_authority.on': False}}
+    uncached = BIPS()
+    uncached.forms = UncachedForms()
+    cherrypy.tree.mount(uncached, '/uncached', config=config)
+    cherrypy.tree.mount(BIPS(), '/cached', config=config)
+    cherrypy.engine.start()
+    results = {}
+    try:
+        for uuid in uuids:
+            results[uuid] = {}
+            for name in ['uncached', 'cached']:
+                url = 'http://127.0.0.1:%d/%s/edit_config?uuid=%s' % (
+                    port, name, uuid)
+                results[uuid][name] = summarize(timed_requests(url, n))
+    finally:
+        cherrypy.engine.exit()
+    return results
+
+
+def report(results):
+    print('%-34s %-9s %9s %9s %9s' % ('workflow', '', 'first', 'median',
+                                      'mean'))
+    for uuid, runs in sorted(results.items()):
+        for name in ['uncached', 'cached']:
+            run = runs[name]
+            print('%-34s %-9s %9.1f %9.1f %9.1f' % (uuid, name, run['first'],
+                                                    run['median'],
+                                                    run['mean']))
+        speedup = runs['uncached']['median'] / max(runs['cached']['median'],
+                                                   1e-3)
+        print('%-34s %-9s %8.1fx' % ('', 'speedup', speedup))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', dest='n', type=int, default=20,
+                        help='requests per workflow and variant')
+    parser.add_argument('-u', '--uuid', dest='uuids', action='append',
+                        help='workflow to benchmark (default: %s)'
+                             % DEFAULT_UUID)
+    parser.add_argument('--json', dest='json', metavar='FILE',
+                        help='also save the raw timings to FILE')
+    args = parser.parse_args()
+    os.environ.setdefault('ETS_TOOLKIT', 'null')
+    results = bench(args.n, args.uuids)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
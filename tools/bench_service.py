@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""Load test the cherrypy service
+
+The ``BIPS`` app is started in this process on a local port, with its own
+job queue, thumbnail cache and volume cache in a temporary FILE_DIR, and
+concurrent clients replay a random mix of requests against it:
+
+queryworkflows, tags, info
+    the workflow catalog (info of a random workflow)
+edit_config
+    the config form of a random workflow
+slice
+    a slice of a synthetic 4D NIfTI image
+upload_nifti
+    upload of a synthetic 4D NIfTI image (thumbnails are made by the job
+    queue in the background, as in the service)
+upload_dicom
+    upload of a zip of a synthetic DICOM series (converted by the job
+    queue in the background)
+
+Reported per endpoint are the number of requests, errors, latency
+percentiles in milliseconds and throughput. Only the local machine is used.
+
+Example
+-------
+
+  python tools/bench_service.py -n 2000 -c 16 --mix edit_config=1,info=1
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+import uuid
+import zipfile
+
+DEFAULT_MIX = ('queryworkflows=30,tags=10,info=20,edit_config=20,slice=15,'
+               'upload_nifti=4,upload_dicom=1')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        weights.append((name.strip(), float(weight)))
+    return weights
+
+
+def make_nifti(filename, shape=(64, 64, 32, 20)):
+    import numpy as np
+    import nibabel as nb
+    data = (np.random.RandomState(0).rand(*shape) * 1000).astype(np.int16)
+    img = nb.Nifti1Image(data, np.diag([3., 3., 4., 1.]))
+    img.get_header().set_zooms((3., 3., 4., 2.))
+    img.get_header().set_xyzt_units('mm', 'sec')
+    img.to_filename(filename)
+    return filename
+
+
+def make_dicom_zip(filename, n_slices=16, size=64):
+    """A zip of one synthetic MR series of n_slices size x size images
+    """
+    import numpy as np
+    from dicom.dataset import Dataset, FileDataset
+    tmpdir = tempfile.mkdtemp()
+    try:
+        series_uid = '1.2.826.0.1.3680043.2.1143.%d' % \
+            random.randint(0, 10 ** 9)
+        with zipfile.ZipFile(filename, 'w') as bundle:
+            for count in range(n_slices):
+                meta = Dataset()
+                meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+                meta.MediaStorageSOPInstanceUID = '%s.%d' % (series_uid,
+                                                             count + 1)
+                meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+                meta.ImplementationClassUID = '1.2.826.0.1.3680043.2.1143'
+                name = os.path.join(tmpdir, 'slice%03d.dcm' % count)
+                ds = FileDataset(name, {}, file_meta=meta,
+                                 preamble='\0' * 128)
+                ds.SOPClassUID = meta.MediaStorageSOPClassUID
+                ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+                ds.StudyInstanceUID = series_uid + '.0'
+                ds.SeriesInstanceUID = series_uid
+                ds.Modality = 'MR'
+                ds.PatientName = 'bench'
+                ds.PatientID = 'bench'
+                ds.SeriesNumber = 1
+                ds.SeriesDescription = 'bench'
+                ds.ProtocolName = 'bench'
+                ds.InstanceNumber = count + 1
+                ds.RepetitionTime = 2000
+                ds.EchoTime = 30
+                ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                ds.ImagePositionPatient = [0, 0, 4. * count]
+                ds.SliceThickness = 4.
+                ds.PixelSpacing = [3., 3.]
+                ds.Rows = ds.Columns = size
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = 'MONOCHROME2'
+                ds.BitsAllocated = 16
+                ds.BitsStored = 16
+                ds.HighBit = 15
+                ds.PixelRepresentation = 0
+                ds.is_little_endian = True
+                ds.is_implicit_VR = False
+                pixels = np.random.RandomState(count).randint(
+                    0, 1000, (size, size)).astype(np.uint16)
+                ds.PixelData = pixels.tostring()
+                ds.save_as(name)
+                bundle.write(name, os.path.basename(name))
+    finally:
+        shutil.rmtree(tmpdir)
+    return filename
+
+
+def multipart(filename, data, field='files[]'):
+    boundary = uuid.uuid4().hex
+    body = '\r\n'.join(['--' + boundary,
+                        'Content-Disposition: form-data; name="%s"; '
+                        'filename="%s"' % (field, filename),
+                        'Content-Type: application/octet-stream',
+                        '', data,
+                        '--' + boundary + '--', ''])
+    return body, 'multipart/form-data; boundary=%s' % boundary
+
+
+class Requests(object):
+    """Build the requests of every endpoint
+    """
+
+    def __init__(self, base_url, uuids, nifti, dicom_zip, slice_file):
+        self.base_url = base_url
+        self.uuids = uuids
+        self.nifti = open(nifti, 'rb').read()
+        self.dicom_zip = open(dicom_zip, 'rb').read()
+        self.slice_file = slice_file
+
+    def build(self, name, rand):
+        if name == 'queryworkflows':
+            return urllib2.Request(self.base_url + 'queryworkflows')
+        if name == 'tags':
+            return urllib2.Request(self.base_url + 'tags?query=')
+        if name == 'info':
+            return urllib2.Request(self.base_url + 'info?uuid=%s'
+                                   % rand.choice(self.uuids))
+        if name == 'edit_config':
+            return urllib2.Request(self.base_url + 'edit_config?uuid=%s'
+                                   % rand.choice(self.uuids))
+        if name == 'slice':
+            return urllib2.Request(self.base_url +
+                                   'slice?file=%s&axis=%d&volume=%d'
+                                   % (self.slice_file, rand.randint(0, 2),
+                                      rand.randint(0, 19)))
+        if name == 'upload_nifti':
+            body, content_type = multipart('bench_%s.nii.gz' %
+                                           uuid.uuid4().hex, self.nifti)
+            return urllib2.Request(self.base_url + 'uploadhandler', body,
+                                   {'Content-Type': content_type})
+        if name == 'upload_dicom':
+            body, content_type = multipart('bench_%s.zip' % uuid.uuid4().hex,
+                                           self.dicom_zip)
+            return urllib2.Request(self.base_url + 'dicomuploadhandler',
+                                   body, {'Content-Type': content_type})
+        raise ValueError('Unknown endpoint %s' % name)
+
+
+def client(requests, todo, lock, results, seed):
+    rand = random.Random(seed)
+    while True:
+        with lock:
+            if not todo:
+                return
+            name = todo.pop()
+        request = requests.build(name, rand)
+        t0 = time.time()
+        try:
+            urllib2.urlopen(request).read()
+            ok = True
+        except (urllib2.URLError, socket.error):
+            ok = False
+        results.append((name, time.time() - t0, ok))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = int(round(q / 100. * (len(values) - 1)))
+    return values[min(len(values) - 1, index)]
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for name in sorted(set([result[0] for result in results])):
+        times = [1000 * t for key, t, ok in results if key == name and ok]
+        errors = len([1 for key, _, ok in results if key == name and not ok])
+        entry = {'requests': len(times) + errors, 'errors': errors,
+                 'throughput': len(times) / elapsed}
+        if times:
+            for q in [50, 90, 99]:
+                entry['p%d' % q] = percentile(times, q)
+            entry['max'] = max(times)
+        summary[name] = entry
+    ok = len([1 for result in results if result[2]])
+    summary['total'] = {'requests': len(results),
+                        'errors': len(results) - ok,
+                        'throughput': ok / elapsed,
+                        'elapsed': elapsed}
+    return summary
+
+
+def bench(n_requests=1000, concurrency=8, mix=DEFAULT_MIX, threads=10,
+          workers=2, seed=0):
+    import cherrypy
+    import bips.service.base as service
+    from bips.workflows import get_index
+    from bips.service.jobs import JobQueue
+    from bips.service.thumbnails import ThumbnailCache
+    from bips.service.volumes import VolumeCache
+
+    file_dir = tempfile.mkdtemp()
+    service.FILE_DIR = file_dir
+    # start the workers before cherrypy starts its threads
+    jobs = JobQueue(os.path.join(file_dir, '.jobs'), workers)
+    try:
+        data_dir = os.path.join(file_dir, '.bench')
+        os.mkdir(data_dir)
+        nifti = make_nifti(os.path.join(data_dir, 'bench.nii.gz'))
+        dicom_zip = make_dicom_zip(os.path.join(data_dir, 'bench.zip'))
+        shutil.copy(nifti, os.path.join(file_dir, 'slice.nii.gz'))
+        app = service.BIPS(jobs,
+                           ThumbnailCache(os.path.join(file_dir,
+                                                       '.thumbnails')),
+                           volumes=VolumeCache(tmp_dir=os.path.join(
+                               file_dir, '.volumes')))
+        port = free_port()
+        cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                                'server.socket_port': port,
+                                'server.thread_pool': threads,
+                                'log.screen': False,
+                                'engine.autoreload.on': False})
+        cherrypy.tree.mount(app, '/', config={
+            '/': {'tools.lg_authority.on': False}})
+        cherrypy.engine.start()
+        try:
+            requests = Requests('http://127.0.0.1:%d/' % port,
+                                sorted(get_index().records), nifti,
+                                dicom_zip, 'slice.nii.gz')
+            rand = random.Random(seed)
+            weights = parse_mix(mix)
+            total = sum([weight for _, weight in weights])
+            todo = []
+            for _ in range(n_requests):
+                pick = rand.uniform(0, total)
+                for name, weight in weights:
+                    pick -= weight
+                    if pick <= 0:
+                        break
+                todo.append(name)
+            results = []
+            lock = threading.Lock()
+            clients = [threading.Thread(target=client,
+                                        args=(requests, todo, lock, results,
+                                              seed + count))
+                       for count in range(concurrency)]
+            t0 = time.time()
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            elapsed = time.time() - t0
+        finally:
+            cherrypy.engine.exit()
+    finally:
+        jobs.close()
+        shutil.rmtree(file_dir)
+    return summarize(results, elapsed)
+
+
+def report(summary):
+    print('%-16s %8s %7s %9s %9s %9s %9s %9s' % ('endpoint', 'requests',
+                                                 'errors', 'p50', 'p90',
+                                                 'p99', 'max', 'req/s'))
+    for name, entry in sorted(summary.items()):
+        if name == 'total':
+            continue
+        if 'p50' in entry:
+            print('%-16s %8d %7d %9.1f %9.1f %9.1f %9.1f %9.1f' %
+                  (name, entry['requests'], entry['errors'], entry['p50'],
+                   entry['p90'], entry['p99'], entry['max'],
+                   entry['throughput']))
+        else:
+            print('%-16s %8d %7d %9s %9s %9s %9s %9.1f' %
+                  (name, entry['requests'], entry['errors'], '-', '-', '-',
+                   '-', entry['throughput']))
+    entry = summary['total']
+    print('%-16s %8d %7d %49.1f' % ('total', entry['requests'],
+                                    entry['errors'], entry['throughput']))
+    print('elapsed %.1f s' % entry['elapsed'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', dest='n_requests', type=int, default=1000,
+                        help='number of requests')
+    parser.add_argument('-c', dest='concurrency', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('--mix', dest='mix', default=DEFAULT_MIX,
+                        help='endpoint=weight,... (default: %s)' % DEFAULT_MIX)
+    parser.add_argument('--threads', dest='threads', type=int, default=10,
+                        help='cherrypy server threads')
+    parser.add_argument('--workers', dest='workers', type=int, default=2,
+                        help='job queue workers')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='seed of the request mix')
+    parser.add_argument('--json', dest='json', metavar='FILE',
+                        help='also save the results to FILE')
+    args = parser.parse_args()
+    os.environ.setdefault('ETS_TOOLKIT', 'null')
+    summary = bench(args.n_requests, args.concurrency, args.mix,
+                    args.threads, args.workers, args.seed)
+    report(summary)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(summary, fp, indent=1, sort_keys=True)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Benchmark start-up and import times of bips
+
+Every measurement runs in a fresh python interpreter so that the numbers
+include the cost of importing traits, nipype and friends. Measured are
+
+* cold import of every workflow module (fresh interpreter, nothing imported)
+* warm import of every workflow module (bips.workflows.base already
+  imported, i.e. the cost the module itself adds)
+* registry load: ``import bips.workflows`` with and without an up to date
+  manifest, and ``bips.workflows.get_workflows()``
+* the ``bips -l`` and ``bips -i`` entry points
+* time to first response of the cherrypy ``BIPS`` root
+
+Nothing is executed, so no FSL/FreeSurfer installation or display is needed.
+
+Example
+-------
+
+  python tools/bench_startup.py -n 3 --json startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.path.pardir, 'bin')
+
+_timer = """
+import json, sys, time
+t0 = time.time()
+%s
+print('__bench__' + json.dumps(dict(total=time.time() - t0, **result)))
+"""
+
+_cold_import = """
+__import__(%r)
+result = {}
+"""
+
+_warm_import = """
+import bips.workflows.base
+t1 = time.time()
+__import__(%r)
+result = {'module': time.time() - t1}
+"""
+
+_registry = """
+import bips.workflows
+t1 = time.time()
+bips.workflows.get_workflows()
+result = {'import': t1 - t0, 'get_workflows': time.time() - t1}
+"""
+
+_service = """
+import urllib2
+import cherrypy
+from bips.service.base import BIPS, MEDIA_DIR
+t1 = time.time()
+cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                        'server.socket_port': %d,
+                        'log.screen': False,
+                        'engine.autoreload.on': False})
+cherrypy.tree.mount(BIPS(), '/', config={'/': {'tools.lg_authority.on': False}})
+t2 = time.time()
+cherrypy.engine.start()
+while True:
+    try:
+        urllib2.urlopen('http://127.0.0.1:%d/').read()
+        break
+    except urllib2.URLError:
+        time.sleep(0.01)
+t3 = time.time()
+cherrypy.engine.exit()
+result = {'import': t1 - t0, 'mount': t2 - t1, 'first_response': t3 - t2}
+"""
+
+
+def run_python(code, env=None, args=None):
+    """Run code in a fresh interpreter and return the reported timings
+    """
+    if args is None:
+        cmd = [sys.executable, '-c', _timer % code]
+    else:
+        cmd = [sys.executable] + args
+    t0 = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    wall = time.time() - t0
+    if proc.returncode:
+        return {'error': stderr.strip().split('\n')[-1], 'wall': wall}
+    result = {'wall': wall}
+    for line in stdout.split('\n'):
+        if line.startswith('__bench__'):
+            result.update(json.loads(line[len('__bench__'):]))
+    return result
+
+
+def repeat(n, code, env=None, args=None):
+    """Run a measurement n times and keep the fastest run
+    """
+    runs = [run_python(code, env, args) for _ in range(n)]
+    ok = [run for run in runs if 'error' not in run]
+    if not ok:
+        return runs[0]
+    return min(ok, key=lambda run: run['wall'])
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench(n=1, modules=None):
+    from bips.workflows.registry import WORKFLOW_MODULES, write_manifest
+
+    if modules is None:
+        modules = WORKFLOW_MODULES
+    tmpdir = tempfile.mkdtemp()
+    manifest = os.path.join(tmpdir, 'workflow_manifest.json')
+    write_manifest(manifest)
+    lazy_env = dict(os.environ, BIPS_MANIFEST=manifest,
+                    ETS_TOOLKIT='null', MPLBACKEND='Agg')
+    lazy_env.pop('DISPLAY', None)
+    eager_env = dict(lazy_env,
+                     BIPS_MANIFEST=os.path.join(tmpdir, 'missing',
+                                                'workflow_manifest.json'))
+    results = {'modules': {}}
+    try:
+        for module in modules:
+            name = 'bips.workflows.' + module
+            results['modules'][module] = {
+                'cold': repeat(n, _cold_import % name, lazy_env),
+                'warm': repeat(n, _warm_import % name, lazy_env)}
+        results['registry_manifest'] = repeat(n, _registry, lazy_env)
+        results['registry_eager'] = repeat(n, _registry, eager_env)
+        bips_bin = os.path.join(BIN_DIR, 'bips')
+        results['bips_list'] = repeat(n, None, lazy_env, [bips_bin, '-l'])
+        results['bips_info'] = repeat(n, None, lazy_env,
+                                      [bips_bin, '-i', '7757e'])
+        port = free_port()
+        results['bips_server'] = repeat(n, _service % (port, port), lazy_env)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def _fmt(run, key='wall'):
+    if 'error' in run:
+        return '   error'
+    return '%8.3f' % run[key]
+
+
+def report(results):
+    print('%-56s %8s %8s' % ('module', 'cold', 'warm'))
+    modules = sorted(results['modules'].items(),
+                     key=lambda item: -item[1]['warm'].get('module', 0))
+    for module, runs in modules:
+        print('%-56s %s %s' % (module, _fmt(runs['cold'], 'total'),
+                               _fmt(runs['warm'], 'module')))
+        for run in runs.values():
+            if 'error' in run:
+                print('    %s' % run['error'])
+    print('')
+    for key in ['registry_manifest', 'registry_eager']:
+        run = results[key]
+        if 'error' in run:
+            print('%-28s error: %s' % (key, run['error']))
+        else:
+            print('%-28s import %7.3f  get_workflows %7.3f' %
+                  (key, run['import'], run['get_workflows']))
+    for key in ['bips_list', 'bips_info']:
+        print('%-28s wall %9.3f' % (key, results[key]['wall']))
+    run = results['bips_server']
+    if 'error' in run:
+        print('%-28s error: %s' % ('bips_server', run['error']))
+    else:
+        print('%-28s import %7.3f  mount %7.3f  first response %7.3f' %
+              ('bips_server', run['import'], run['mount'],
+               run['first_response']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', dest='n', type=int, default=1,
+                        help='repetitions per measurement (fastest is kept)')
+    parser.add_argument('-m', '--module', dest='modules', action='append',
+                        help='only benchmark this workflow module '
+                             '(e.g. gablab.wips.fmri.viz.synced_corr_display_h5)')
+    parser.add_argument('--json', dest='json', metavar='FILE',
+                        help='also save the raw timings to FILE')
+    args = parser.parse_args()
+    results = bench(args.n, args.modules)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)